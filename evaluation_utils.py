@@ -0,0 +1,651 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+STATUSES = ('E', 'R', 'N', 'NA')
+
+
+def empty_status_counts():
+    return {status: 0 for status in STATUSES}
+
+
+class AttributeRecord:
+    """One evaluated attribute"""
+    __slots__ = ('description', 'status', 'score', 'weight', 'notes_ar', 'report_notes_ar', 'is_na')
+
+    def __init__(self, raw):
+        # Text fields may be null in the source file
+        self.description = raw.get('attribute_en') or ''
+        self.status = raw.get('status', 'N')
+        self.score = raw.get('score', 0)
+        self.weight = raw.get('weight', 1)
+        self.notes_ar = raw.get('notes_ar') or ''
+        self.report_notes_ar = raw.get('report_notes_ar') or ''
+        # A '-' score marks an attribute that does not apply: it counts as NA and carries no weight
+        self.is_na = self.score == '-'
+
+    @property
+    def effective_status(self):
+        return 'NA' if self.is_na else self.status
+
+
+class SubPillarRecord:
+    """A sub-pillar with its attributes; aggregates are filled in by Evaluation"""
+    __slots__ = ('name_ar', 'name_en', 'attributes', 'status_counts', 'dominant_status', 'weight', 'score_total')
+
+    def __init__(self, raw, attributes=None):
+        self.name_en = raw.get('sub_pillar_en', '')
+        self.name_ar = raw.get('sub_pillar_ar') or self.name_en or ''
+        if attributes is None:
+            attributes = [AttributeRecord(attribute) for attribute in raw.get('attributes', [])]
+        self.attributes = attributes
+        self.status_counts = empty_status_counts()
+        self.dominant_status = 'E'
+        self.weight = 0
+        self.score_total = 0.0
+
+
+class PillarRecord:
+    """A pillar with its sub-pillars (indexed by English name); aggregates are filled in by Evaluation"""
+    __slots__ = ('name_ar', 'name_en', 'score', 'sub_pillars', 'sub_pillar_index', 'status_counts', 'weight')
+
+    def __init__(self, raw, sub_pillars=None):
+        self.name_en = raw.get('pillar_en', '')
+        self.name_ar = raw.get('pillar_ar') or self.name_en or ''
+        self.score = raw.get('pillar_score', 0)
+        if sub_pillars is None:
+            sub_pillars = [SubPillarRecord(sub_pillar) for sub_pillar in raw.get('sub_pillars', [])]
+        self.sub_pillars = sub_pillars
+        self.sub_pillar_index = {}
+        for sub_pillar in self.sub_pillars:
+            self.sub_pillar_index.setdefault(sub_pillar.name_en, sub_pillar)
+        self.status_counts = empty_status_counts()
+        self.weight = 0
+
+
+# -------------------------------------------------
+# Columnar scoring
+# -------------------------------------------------
+def build_attribute_frame(columns):
+    """Typed attribute frame from column lists: one row per attribute.
+
+    Expected columns: pillar and sub_pillar (integer positions), status, score (raw, '-'
+    for not applicable) and weight. Scores become floats with an NA mask, and statuses
+    become categoricals, plus the effective status (NA for not applicable attributes).
+    """
+    statuses = columns['status']
+    categories = list(STATUSES) + sorted(set(statuses).difference(STATUSES), key=str)
+    category_codes = {status: code for code, status in enumerate(categories)}
+    status_codes = np.fromiter((category_codes[status] for status in statuses), dtype=np.int8, count=len(statuses))
+
+    na = np.fromiter((score == '-' for score in columns['score']), dtype=bool, count=len(statuses))
+    scores = _to_float([0.0 if is_na else score for score, is_na in zip(columns['score'], na)], 0.0)
+    effective_codes = np.where(na, category_codes['NA'], status_codes).astype(np.int8)
+
+    return pd.DataFrame({
+        'pillar': np.asarray(columns['pillar'], dtype=np.int32),
+        'sub_pillar': np.asarray(columns['sub_pillar'], dtype=np.int32),
+        'status': pd.Categorical.from_codes(status_codes, categories),
+        'effective_status': pd.Categorical.from_codes(effective_codes, categories),
+        'score': scores,
+        'weight': _to_float(columns['weight'], 1.0),
+        'na': na,
+    })
+
+
+def _to_float(values, default):
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').fillna(default).to_numpy(np.float64)
+
+
+def aggregate_attributes(frame, by, group_count=None):
+    """Per-group status counts, applicable weight, score total and dominant status.
+
+    `by` names an integer position column (pillar, sub_pillar, center...); groups are
+    0..group_count-1, so groups without attributes are included with zero counts. The
+    result has one column per status plus 'weight', 'score_total' and 'dominant_status'
+    (the most frequent status, ties resolved in E, R, N, NA order).
+    """
+    categories = list(frame['effective_status'].cat.categories)
+    counts, weights, score_totals, dominant = _aggregate(frame, by, group_count)
+    result = {category: counts[:, code] for code, category in enumerate(categories)}
+    result.update({'weight': weights, 'score_total': score_totals, 'dominant_status': dominant})
+    return pd.DataFrame(result)
+
+
+def _aggregate(frame, by, group_count=None):
+    """aggregate_attributes() as NumPy arrays: (counts[group, status], weights, score totals, dominant status)"""
+    return aggregate_codes(
+        frame[by].to_numpy(np.int64),
+        frame['effective_status'].cat.codes.to_numpy(np.int64),
+        frame['effective_status'].cat.categories,
+        ~frame['na'].to_numpy(),
+        frame['weight'].to_numpy(),
+        frame['score'].to_numpy(),
+        group_count
+    )
+
+
+def aggregate_codes(codes, status_codes, categories, applicable, weights, scores, group_count=None):
+    """Group aggregates over plain arrays (group code, status code, applicable mask, weight, score per attribute).
+
+    Used by the attribute frame and directly on memory-mapped snapshot columns.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    status_codes = np.asarray(status_codes, dtype=np.int64)
+    if group_count is None:
+        group_count = int(codes.max()) + 1 if len(codes) else 0
+    categories = np.asarray(categories, dtype=object)
+
+    counts = np.bincount(codes * len(categories) + status_codes,
+                         minlength=group_count * len(categories)).reshape(group_count, len(categories))
+    weight_totals = np.bincount(codes, weights=weights * applicable, minlength=group_count)
+    score_totals = np.bincount(codes, weights=scores * applicable, minlength=group_count)
+    dominant = categories[counts.argmax(axis=1)] if group_count else np.empty(0, dtype=object)
+    return counts, weight_totals, score_totals, dominant
+
+
+def overall_score(pillar_scores, pillar_weights):
+    """Overall percentage: pillar scores weighted by the applicable weight of each pillar"""
+    pillar_scores = np.asarray(pillar_scores, dtype=np.float64)
+    pillar_weights = np.asarray(pillar_weights, dtype=np.float64)
+    total_weight = pillar_weights.sum()
+    return float((pillar_scores * pillar_weights).sum() / total_weight * 100) if total_weight > 0 else 0
+
+
+class Evaluation:
+    """Evaluation data compiled once into indexed records and a columnar attribute frame.
+
+    Records keep names and notes, indexed by pillar / sub-pillar English name. Scores,
+    status counts and weights at every level come from vectorized group-bys over the
+    attribute frame. Derived views (pillar analyses, prompt summaries) are memoized per
+    evaluation through view(). `data` may be any iterable of raw pillar dicts or
+    PillarRecords, so pillars can be compiled as they are streamed in. content_hash is
+    the SHA-256 of the source file when the evaluation was loaded through a ParseCache;
+    center and visit_date are set by the loaders when the file carried them.
+    """
+
+    def __init__(self, data):
+        self.pillars = []
+        self.pillar_index = {}
+        sub_pillars = []
+        columns = {'pillar': [], 'sub_pillar': [], 'status': [], 'score': [], 'weight': []}
+
+        for raw_pillar in data:
+            pillar = raw_pillar if isinstance(raw_pillar, PillarRecord) else PillarRecord(raw_pillar)
+            pillar_position = len(self.pillars)
+            self.pillars.append(pillar)
+            self.pillar_index.setdefault(pillar.name_en, pillar)
+            for sub_pillar in pillar.sub_pillars:
+                sub_pillar_position = len(sub_pillars)
+                sub_pillars.append(sub_pillar)
+                for attribute in sub_pillar.attributes:
+                    columns['pillar'].append(pillar_position)
+                    columns['sub_pillar'].append(sub_pillar_position)
+                    columns['status'].append(attribute.status)
+                    columns['score'].append(attribute.score)
+                    columns['weight'].append(attribute.weight)
+
+        self.frame = build_attribute_frame(columns)
+        self._apply_aggregates(sub_pillars)
+        self._views = {}
+        self.content_hash = None
+        self.center = None
+        self.visit_date = None
+
+    def _apply_aggregates(self, sub_pillars):
+        categories = list(self.frame['effective_status'].cat.categories)
+
+        counts, weights, score_totals, dominant = _aggregate(self.frame, 'sub_pillar', len(sub_pillars))
+        for position, sub_pillar in enumerate(sub_pillars):
+            sub_pillar.status_counts = _status_counts(zip(categories, counts[position]))
+            sub_pillar.dominant_status = dominant[position]
+            sub_pillar.weight = float(weights[position])
+            sub_pillar.score_total = float(score_totals[position])
+
+        counts, weights, _, _ = _aggregate(self.frame, 'pillar', len(self.pillars))
+        for position, pillar in enumerate(self.pillars):
+            pillar.status_counts = _status_counts(zip(categories, counts[position]))
+            pillar.weight = float(weights[position])
+
+        status_codes = self.frame['effective_status'].cat.codes.to_numpy()
+        totals = np.bincount(status_codes, minlength=len(categories))
+        self.status_counts = _status_counts(zip(categories, totals))
+
+        applicable = ~self.frame['na'].to_numpy()
+        scores = self.frame['score'].to_numpy()
+        self.status_scores = {
+            status: scores[applicable & (status_codes == code)].tolist()
+            for code, status in enumerate(categories) if status != 'NA'
+        }
+        self.status_scores.setdefault('NA', [])
+
+        self.overall_score = overall_score(
+            _to_float([pillar.score for pillar in self.pillars], 0.0),
+            [pillar.weight for pillar in self.pillars]
+        )
+
+    def pillar(self, name_en):
+        return self.pillar_index.get(name_en)
+
+    def sub_pillar(self, pillar_name_en, sub_pillar_name_en):
+        pillar = self.pillar_index.get(pillar_name_en)
+        return pillar.sub_pillar_index.get(sub_pillar_name_en) if pillar else None
+
+    def attribute_columns(self):
+        """Attribute columns for cross-center tables: pillar position, effective status code, applicable
+        mask, score, weight and description, with the status categories and pillar names they refer to"""
+        return {
+            'pillar': self.frame['pillar'].to_numpy(),
+            'status': self.frame['effective_status'].cat.codes.to_numpy(),
+            'categories': list(self.frame['effective_status'].cat.categories),
+            'applicable': ~self.frame['na'].to_numpy(),
+            'score': self.frame['score'].to_numpy(),
+            'weight': self.frame['weight'].to_numpy(),
+            'description': [attribute.description for pillar in self.pillars
+                            for sub_pillar in pillar.sub_pillars for attribute in sub_pillar.attributes],
+            'pillar_en': [pillar.name_en for pillar in self.pillars],
+        }
+
+    def view(self, key, build):
+        """Return the derived view stored under key, building it on first use"""
+        if key not in self._views:
+            self._views[key] = build()
+        return self._views[key]
+
+
+def _status_counts(status_counts):
+    """Plain {status: count} dict from (status, count) pairs, always including E, R, N and NA"""
+    counts = empty_status_counts()
+    for status, count in status_counts:
+        if count or status in STATUSES:
+            counts[status] = int(count)
+    return counts
+
+
+class EvaluationBuilder:
+    """Build an Evaluation from flat attribute rows (one NDJSON line per attribute).
+
+    Each row carries its pillar_en / pillar_ar / pillar_score and sub_pillar_en /
+    sub_pillar_ar next to the attribute fields; rows of a pillar need not be contiguous.
+    """
+
+    def __init__(self):
+        self.pillars = []
+        self._pillar_index = {}
+        self._sub_pillar_index = {}
+
+    def add_attribute(self, row):
+        pillar_key = row.get('pillar_en', '')
+        pillar = self._pillar_index.get(pillar_key)
+        if pillar is None:
+            pillar = PillarRecord(row, sub_pillars=[])
+            self._pillar_index[pillar_key] = pillar
+            self.pillars.append(pillar)
+
+        sub_pillar_key = (pillar_key, row.get('sub_pillar_en', ''))
+        sub_pillar = self._sub_pillar_index.get(sub_pillar_key)
+        if sub_pillar is None:
+            sub_pillar = SubPillarRecord(row, attributes=[])
+            self._sub_pillar_index[sub_pillar_key] = sub_pillar
+            pillar.sub_pillars.append(sub_pillar)
+            pillar.sub_pillar_index.setdefault(sub_pillar.name_en, sub_pillar)
+
+        sub_pillar.attributes.append(AttributeRecord(row))
+
+    def build(self):
+        return Evaluation(self.pillars)
+
+
+def build_scoreboard(evaluations):
+    """Per-center scoreboard from {center: Evaluation}, best overall score first.
+
+    Each evaluation already carries its aggregates, so this is one row per center; pillar
+    columns hold each pillar's score as a percentage.
+    """
+    if not evaluations:
+        return pd.DataFrame()
+
+    scoreboard = pd.DataFrame({
+        'center': list(evaluations),
+        'overall_score': [evaluation.overall_score for evaluation in evaluations.values()],
+    })
+    for status in STATUSES:
+        scoreboard[status] = [evaluation.status_counts.get(status, 0) for evaluation in evaluations.values()]
+
+    pillar_scores = pd.DataFrame([
+        {pillar.name_ar: float(pillar.score) * 100 for pillar in evaluation.pillars}
+        for evaluation in evaluations.values()
+    ])
+    return pd.concat([scoreboard, pillar_scores], axis=1).sort_values('overall_score', ascending=False,
+                                                                       ignore_index=True)
+
+
+def summarize_portfolio(scoreboard):
+    """Portfolio-level aggregate of a scoreboard"""
+    if scoreboard.empty:
+        return None
+    scores = scoreboard['overall_score']
+    return {
+        'centers': len(scoreboard),
+        'mean_score': float(scores.mean()),
+        'median_score': float(scores.median()),
+        'min_score': float(scores.min()),
+        'max_score': float(scores.max()),
+        'status_counts': {status: int(scoreboard[status].sum()) for status in STATUSES}
+    }
+
+
+# -------------------------------------------------
+# Visit comparison
+# -------------------------------------------------
+# Lower is better; NA is not ranked, so moves to or from NA are neither better nor worse
+STATUS_RANK = {'E': 0, 'R': 1, 'N': 2}
+
+
+class AttributeChange:
+    """One attribute that differs between two visits; before or after is None when it was added or removed"""
+    __slots__ = ('pillar', 'sub_pillar', 'before', 'after')
+
+    def __init__(self, pillar, sub_pillar, before, after):
+        self.pillar = pillar
+        self.sub_pillar = sub_pillar
+        self.before = before
+        self.after = after
+
+    @property
+    def kind(self):
+        if self.before is None:
+            return 'added'
+        return 'removed' if self.after is None else 'changed'
+
+    @property
+    def description(self):
+        return (self.after or self.before).description
+
+    @property
+    def before_status(self):
+        return self.before.effective_status if self.before else None
+
+    @property
+    def after_status(self):
+        return self.after.effective_status if self.after else None
+
+    @property
+    def score_delta(self):
+        if self.before is None or self.after is None or self.before.is_na or self.after.is_na:
+            return None
+        return float(self.after.score) - float(self.before.score)
+
+    @property
+    def movement(self):
+        """Status steps worse (positive) or better (negative); 0 when not comparable"""
+        before = STATUS_RANK.get(self.before_status)
+        after = STATUS_RANK.get(self.after_status)
+        return after - before if before is not None and after is not None else 0
+
+
+class EvaluationDelta:
+    """Differences between two evaluations of a center.
+
+    changes holds only the attributes whose effective status or score differs (or that
+    exist in one visit only), most severe first: worsened by status steps and weight,
+    then improved, then score-only changes, then added / removed. transitions counts
+    status moves such as ('E', 'R'); pillars lists the score movement of each pillar.
+    """
+
+    def __init__(self, before, after, changes, unchanged):
+        self.before = before
+        self.after = after
+        self.unchanged = unchanged
+        self.changes = sorted(changes, key=_change_rank)
+
+        self.transitions = {}
+        for change in self.changes:
+            if change.kind == 'changed' and change.before_status != change.after_status:
+                key = (change.before_status, change.after_status)
+                self.transitions[key] = self.transitions.get(key, 0) + 1
+
+        # Pillars are matched by English name; repeated names are matched in order
+        previous_pillars = {}
+        for pillar in before.pillars:
+            previous_pillars.setdefault(pillar.name_en, []).append(pillar)
+        self.pillars = []
+        for pillar in after.pillars:
+            candidates = previous_pillars.get(pillar.name_en)
+            previous = candidates.pop(0) if candidates else None
+            self.pillars.append({
+                'name_ar': pillar.name_ar,
+                'name_en': pillar.name_en,
+                'before_score': float(previous.score) * 100 if previous else None,
+                'after_score': float(pillar.score) * 100,
+                'delta': (float(pillar.score) - float(previous.score)) * 100 if previous else None,
+                'status_deltas': {
+                    status: pillar.status_counts.get(status, 0) - (previous.status_counts.get(status, 0) if previous else 0)
+                    for status in STATUSES
+                },
+            })
+
+        self.overall_delta = after.overall_score - before.overall_score
+        self.status_deltas = {
+            status: after.status_counts.get(status, 0) - before.status_counts.get(status, 0) for status in STATUSES
+        }
+
+    @property
+    def worsened(self):
+        return [change for change in self.changes if change.movement > 0]
+
+    @property
+    def improved(self):
+        return [change for change in self.changes if change.movement < 0]
+
+
+def _change_rank(change):
+    weight = float((change.after or change.before).weight or 1)
+    if change.movement > 0:
+        return (0, -change.movement, -weight)
+    if change.movement < 0:
+        return (1, change.movement, -weight)
+    if change.kind == 'changed':
+        return (2, -abs(change.score_delta or 0) * weight, 0)
+    return (3, 0, -weight)
+
+
+def _attribute_key_index(evaluation):
+    """{(pillar_en, sub_pillar_en, description, occurrence): (pillar, sub_pillar, attribute)}"""
+    index = {}
+    occurrences = {}
+    for pillar in evaluation.pillars:
+        for sub_pillar in pillar.sub_pillars:
+            for attribute in sub_pillar.attributes:
+                key = (pillar.name_en, sub_pillar.name_en, attribute.description)
+                occurrence = occurrences.get(key, 0)
+                occurrences[key] = occurrence + 1
+                index[key + (occurrence,)] = (pillar, sub_pillar, attribute)
+    return index
+
+
+def compare_evaluations(before, after):
+    """Join the attributes of two visits on (pillar, sub-pillar, description) and report what changed.
+
+    The earlier visit is indexed once in a dict, so the join is linear in the number of
+    attributes. Repeated descriptions within a sub-pillar are matched in order.
+    """
+    before = as_evaluation(before)
+    after = as_evaluation(after)
+    previous = _attribute_key_index(before)
+
+    changes = []
+    unchanged = 0
+    for key, (pillar, sub_pillar, attribute) in _attribute_key_index(after).items():
+        match = previous.pop(key, None)
+        if match is None:
+            changes.append(AttributeChange(pillar, sub_pillar, None, attribute))
+            continue
+        old = match[2]
+        if old.effective_status != attribute.effective_status or (
+                not attribute.is_na and _score_value(old.score) != _score_value(attribute.score)):
+            changes.append(AttributeChange(pillar, sub_pillar, old, attribute))
+        else:
+            unchanged += 1
+    changes.extend(AttributeChange(pillar, sub_pillar, attribute, None)
+                   for pillar, sub_pillar, attribute in previous.values())
+    return EvaluationDelta(before, after, changes, unchanged)
+
+
+def _score_value(score):
+    try:
+        return float(score)
+    except (TypeError, ValueError):
+        return None
+
+
+# -------------------------------------------------
+# Portfolio benchmarking
+# -------------------------------------------------
+def portfolio_hash(evaluations):
+    """SHA-256 of a portfolio: its center labels and the content hash of each center's evaluation"""
+    digest = hashlib.sha256()
+    for label in sorted(evaluations):
+        content_hash = evaluations[label].content_hash or f"id:{id(evaluations[label])}"
+        digest.update(f"{label}\0{content_hash}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def flatten_attributes(evaluations):
+    """One row per attribute of every center of {center: Evaluation or Snapshot}.
+
+    Columns: center, pillar_en and description (categoricals), status (effective status,
+    categorical over STATUSES plus any other status found), applicable, score and weight.
+    Built by concatenating each center's attribute columns, so snapshots are read from
+    their memory-mapped columns without rebuilding the evaluation.
+    """
+    parts = [(center, evaluation.attribute_columns()) for center, evaluation in evaluations.items()]
+    categories = list(STATUSES) + sorted({category for _, columns in parts for category in columns['categories']}
+                                         .difference(STATUSES), key=str)
+    category_codes = {status: code for code, status in enumerate(categories)}
+
+    def concat(arrays, dtype):
+        return np.concatenate([np.asarray(array, dtype=dtype) for array in arrays]) if arrays else np.empty(0, dtype)
+
+    sizes = [len(columns['status']) for _, columns in parts]
+    status = concat([np.asarray([category_codes[category] for category in columns['categories']],
+                                dtype=np.int8)[np.asarray(columns['status'], dtype=np.int64)]
+                     for _, columns in parts], np.int8)
+    pillar_en = concat([np.asarray(columns['pillar_en'], dtype=object)[np.asarray(columns['pillar'], dtype=np.int64)]
+                        if len(columns['pillar_en']) else np.empty(0, dtype=object)
+                        for _, columns in parts], object)
+
+    return pd.DataFrame({
+        'center': pd.Categorical.from_codes(np.repeat(np.arange(len(parts), dtype=np.int32), sizes),
+                                            [center for center, _ in parts]),
+        'pillar_en': pd.Categorical(pillar_en),
+        'description': pd.Categorical(concat([np.asarray(columns['description'], dtype=object)
+                                              for _, columns in parts], object)),
+        'status': pd.Categorical.from_codes(status, categories),
+        'applicable': concat([columns['applicable'] for _, columns in parts], bool),
+        'score': concat([columns['score'] for _, columns in parts], np.float64),
+        'weight': concat([columns['weight'] for _, columns in parts], np.float64),
+    })
+
+
+def benchmark_portfolio(evaluations, top_attributes=15):
+    """League tables of a portfolio {center: Evaluation or Snapshot}.
+
+    Returns a dict with:
+    - scoreboard: build_scoreboard() plus each center's rank and overall percentile (share of
+      centers scoring at or below it)
+    - pillar_ranks: rank of every center in every pillar (1 is best; ties share the best rank)
+    - pillars: per pillar mean, median, min and max score and the best and worst center
+    - failing_attributes: the attributes rated N most often across the network, then R,
+      with how many centers evaluated them and how many rated them N
+    Ranks, percentiles and attribute counts are vectorized group-bys over the pillar table
+    and over flatten_attributes().
+    """
+    scoreboard = build_scoreboard(evaluations)
+    if scoreboard.empty:
+        return None
+    scores = scoreboard['overall_score']
+    scoreboard.insert(2, 'rank', scores.rank(ascending=False, method='min').astype(int))
+    scoreboard.insert(3, 'percentile', scores.rank(pct=True, method='max') * 100)
+
+    pillar_table = pd.DataFrame([
+        {'center': center, 'pillar_en': pillar.name_en, 'pillar_ar': pillar.name_ar, 'score': float(pillar.score) * 100}
+        for center, evaluation in evaluations.items() for pillar in evaluation.pillars
+    ])
+    # Repeated pillar names within a center are averaged
+    pillar_table = pillar_table.groupby(['pillar_en', 'center'], sort=False, as_index=False).agg(
+        pillar_ar=('pillar_ar', 'first'), score=('score', 'mean'))
+    pillar_table['rank'] = pillar_table.groupby('pillar_en')['score'].rank(ascending=False, method='min').astype(int)
+    pillar_names = dict(zip(pillar_table['pillar_en'], pillar_table['pillar_ar']))
+    pillar_ranks = pillar_table.pivot(index='center', columns='pillar_en', values='rank').rename(columns=pillar_names)
+    pillar_ranks.columns.name = None
+
+    by_pillar = pillar_table.groupby('pillar_en', sort=False)['score']
+    best = pillar_table.loc[by_pillar.idxmax(), ['pillar_en', 'center']].set_index('pillar_en')['center']
+    worst = pillar_table.loc[by_pillar.idxmin(), ['pillar_en', 'center']].set_index('pillar_en')['center']
+    pillars = by_pillar.agg(['mean', 'median', 'min', 'max']).assign(best_center=best, worst_center=worst)
+    pillars.insert(0, 'pillar_ar', [pillar_names[name] for name in pillars.index])
+
+    return {
+        'portfolio_hash': portfolio_hash(evaluations),
+        'scoreboard': scoreboard,
+        'pillar_ranks': pillar_ranks.reindex(scoreboard['center']).reset_index(),
+        'pillars': pillars.reset_index(),
+        'failing_attributes': failing_attributes(flatten_attributes(evaluations), top_attributes),
+        'summary': summarize_portfolio(scoreboard),
+    }
+
+
+def failing_attributes(attributes, limit=15):
+    """Attributes (pillar, description) rated N most often across centers, then R, from a flattened table"""
+    if attributes.empty:
+        return pd.DataFrame(columns=['pillar_en', 'description', 'evaluated', 'N', 'R', 'n_rate', 'centers_n'])
+    keys = attributes['pillar_en'].cat.codes.to_numpy(np.int64) * len(attributes['description'].cat.categories) \
+        + attributes['description'].cat.codes.to_numpy(np.int64)
+    groups, codes = np.unique(keys, return_inverse=True)
+    categories = list(attributes['status'].cat.categories)
+    applicable = attributes['applicable'].to_numpy()
+    counts, _, _, _ = aggregate_codes(codes, attributes['status'].cat.codes.to_numpy(np.int64), categories,
+                                      applicable, attributes['weight'].to_numpy(), attributes['score'].to_numpy(),
+                                      len(groups))
+    evaluated = np.bincount(codes, weights=applicable, minlength=len(groups)).astype(int)
+    n_count = counts[:, categories.index('N')]
+    r_count = counts[:, categories.index('R')]
+
+    # Distinct centers rating each attribute N
+    is_n = attributes['status'].cat.codes.to_numpy() == categories.index('N')
+    center_pairs = np.unique(codes[is_n] * len(attributes['center'].cat.categories)
+                             + attributes['center'].cat.codes.to_numpy(np.int64)[is_n])
+    centers_n = np.bincount(center_pairs // len(attributes['center'].cat.categories), minlength=len(groups))
+
+    description_count = len(attributes['description'].cat.categories)
+    result = pd.DataFrame({
+        'pillar_en': attributes['pillar_en'].cat.categories[groups // description_count],
+        'description': attributes['description'].cat.categories[groups % description_count],
+        'evaluated': evaluated,
+        'N': n_count,
+        'R': r_count,
+        'n_rate': np.divide(n_count, evaluated, out=np.zeros(len(groups)), where=evaluated > 0) * 100,
+        'centers_n': centers_n,
+    })
+    result = result[(result['N'] > 0) | (result['R'] > 0)]
+    return result.sort_values(['N', 'R', 'n_rate'], ascending=False).head(limit).reset_index(drop=True)
+
+
+def compile_evaluation(data):
+    """Compile the raw evaluation JSON (a list of pillars) into an Evaluation"""
+    return Evaluation(data)
+
+
+def as_evaluation(data):
+    """Accept raw evaluation JSON, an already compiled Evaluation, or a snapshot (anything with to_evaluation())"""
+    if isinstance(data, Evaluation):
+        return data
+    if hasattr(data, 'to_evaluation'):
+        return data.to_evaluation()
+    return compile_evaluation(data)
@@ -0,0 +1,221 @@
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from evaluation_utils import STATUSES, as_evaluation
+
+
+# visit_date is NULL for visits whose file does not carry a date
+_VISITS_TABLE = """
+CREATE TABLE IF NOT EXISTS {name} (
+    id INTEGER PRIMARY KEY,
+    content_hash TEXT NOT NULL UNIQUE,
+    center TEXT NOT NULL,
+    visit_date TEXT,
+    source TEXT,
+    ingested_at REAL NOT NULL,
+    overall_score REAL NOT NULL,
+    e_count INTEGER NOT NULL,
+    r_count INTEGER NOT NULL,
+    n_count INTEGER NOT NULL,
+    na_count INTEGER NOT NULL
+);
+"""
+
+_SCHEMA = _VISITS_TABLE.format(name='visits') + """
+CREATE INDEX IF NOT EXISTS idx_visits_center_date ON visits (center, visit_date);
+
+CREATE TABLE IF NOT EXISTS pillars (
+    visit_id INTEGER NOT NULL REFERENCES visits (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    pillar_en TEXT,
+    pillar_ar TEXT,
+    score REAL NOT NULL,
+    weight REAL NOT NULL,
+    e_count INTEGER NOT NULL,
+    r_count INTEGER NOT NULL,
+    n_count INTEGER NOT NULL,
+    na_count INTEGER NOT NULL,
+    PRIMARY KEY (visit_id, position)
+);
+
+CREATE TABLE IF NOT EXISTS attributes (
+    visit_id INTEGER NOT NULL REFERENCES visits (id) ON DELETE CASCADE,
+    center TEXT NOT NULL,
+    pillar_en TEXT,
+    sub_pillar_en TEXT,
+    attribute TEXT,
+    status TEXT NOT NULL,
+    score REAL,
+    weight REAL
+);
+CREATE INDEX IF NOT EXISTS idx_attributes_attribute_center ON attributes (attribute, center);
+CREATE INDEX IF NOT EXISTS idx_attributes_visit ON attributes (visit_id);
+"""
+
+# Status count columns of the visits and pillars rollups
+_COUNT_COLUMNS = tuple(f"{status.lower()}_count" for status in STATUSES)
+
+
+@contextlib.contextmanager
+def _transaction(conn):
+    """Use a connection for one transaction: commit on success, roll back on error, always close"""
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _allow_undated_visits(conn):
+    """Rebuild a visits table from a store that still declares visit_date NOT NULL.
+
+    Such stores recorded undated visits under their load date; those rows cannot be told
+    apart and are kept as they are. Run with foreign keys off, so dropping the old table
+    does not cascade to the pillar and attribute rows.
+    """
+    not_null = {row[1]: row[3] for row in conn.execute("PRAGMA table_info(visits)")}
+    if not not_null.get('visit_date'):
+        return
+    conn.executescript(
+        "BEGIN;"
+        + _VISITS_TABLE.format(name='visits_migrated')
+        + "INSERT INTO visits_migrated SELECT * FROM visits;"
+        "DROP TABLE visits;"
+        "ALTER TABLE visits_migrated RENAME TO visits;"
+        "CREATE INDEX IF NOT EXISTS idx_visits_center_date ON visits (center, visit_date);"
+        "COMMIT;"
+    )
+
+
+class VisitStore:
+    """Embedded SQLite history of ingested visits (VISIT_STORE_PATH, default .cache/visits.sqlite3).
+
+    Each visit is stored once per content hash with its rollups precomputed: overall
+    score and status counts on the visit row, score, weight and status counts per
+    pillar. Attribute rows keep the effective status and score for per-attribute
+    history. Trend queries only read the indexed rollup tables and leave out visits
+    without a date, which cannot be placed in the sequence.
+    """
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path or os.getenv('VISIT_STORE_PATH', '.cache/visits.sqlite3')
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        with _transaction(sqlite3.connect(self.db_path, timeout=30)) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            _allow_undated_visits(conn)
+
+    @classmethod
+    def from_env(cls):
+        """The configured store, or None when VISIT_STORE_PATH is set to an empty value"""
+        db_path = os.getenv('VISIT_STORE_PATH', '.cache/visits.sqlite3')
+        return cls(db_path) if db_path else None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA foreign_keys=ON")
+        return _transaction(conn)
+
+    # -------------------------------------------------
+    # Ingestion
+    # -------------------------------------------------
+    def record_visits(self, visits):
+        """Store (content_hash, center, visit_date, source, evaluation) visits; returns how many were new.
+
+        Visits already stored under the same content hash are skipped before their
+        evaluation is touched, so re-loading a batch only costs one indexed lookup per file.
+        A missing visit_date is stored as NULL.
+        """
+        recorded = 0
+        with self._lock, self._connect() as conn:
+            for content_hash, center, visit_date, source, evaluation in visits:
+                if conn.execute("SELECT 1 FROM visits WHERE content_hash = ?", (content_hash,)).fetchone():
+                    continue
+                evaluation = as_evaluation(evaluation)
+                counts = evaluation.status_counts
+                visit_id = conn.execute(
+                    "INSERT INTO visits (content_hash, center, visit_date, source, ingested_at, overall_score, "
+                    "e_count, r_count, n_count, na_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (content_hash, center, visit_date or None, source, time.time(),
+                     float(evaluation.overall_score), *(counts.get(status, 0) for status in STATUSES))
+                ).lastrowid
+                conn.executemany(
+                    "INSERT INTO pillars (visit_id, position, pillar_en, pillar_ar, score, weight, "
+                    "e_count, r_count, n_count, na_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (visit_id, position, pillar.name_en, pillar.name_ar, float(pillar.score), pillar.weight,
+                         *(pillar.status_counts.get(status, 0) for status in STATUSES))
+                        for position, pillar in enumerate(evaluation.pillars)
+                    ]
+                )
+                conn.executemany(
+                    "INSERT INTO attributes (visit_id, center, pillar_en, sub_pillar_en, attribute, status, score, weight) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (visit_id, center, pillar.name_en, sub_pillar.name_en, attribute.description,
+                         attribute.effective_status, None if attribute.is_na else float(attribute.score),
+                         float(attribute.weight))
+                        for pillar in evaluation.pillars
+                        for sub_pillar in pillar.sub_pillars
+                        for attribute in sub_pillar.attributes
+                    ]
+                )
+                recorded += 1
+        return recorded
+
+    # -------------------------------------------------
+    # Trend queries
+    # -------------------------------------------------
+    def _frame(self, query, params=()):
+        with self._connect() as conn:
+            cursor = conn.execute(query, params)
+            columns = [column[0] for column in cursor.description]
+            return pd.DataFrame(cursor.fetchall(), columns=columns)
+
+    def centers(self):
+        """Centers with their number of dated and undated stored visits, alphabetically"""
+        return self._frame(
+            "SELECT center, COUNT(visit_date) AS visits, COUNT(*) - COUNT(visit_date) AS undated "
+            "FROM visits GROUP BY center ORDER BY center"
+        )
+
+    def center_history(self, center):
+        """One row per dated visit of a center, oldest first: visit date, overall score and status counts"""
+        return self._frame(
+            f"SELECT visit_date, overall_score, {', '.join(_COUNT_COLUMNS)}, source FROM visits "
+            "WHERE center = ? AND visit_date IS NOT NULL ORDER BY visit_date, id",
+            (center,)
+        )
+
+    def pillar_history(self, center):
+        """One row per pillar per dated visit of a center, oldest visit first"""
+        return self._frame(
+            f"SELECT v.visit_date, p.pillar_en, p.pillar_ar, p.score, p.weight, "
+            f"{', '.join('p.' + column for column in _COUNT_COLUMNS)} "
+            "FROM visits v JOIN pillars p ON p.visit_id = v.id "
+            "WHERE v.center = ? AND v.visit_date IS NOT NULL ORDER BY v.visit_date, v.id, p.position",
+            (center,)
+        )
+
+    def attribute_history(self, attribute, center):
+        """Status and score of one attribute at every dated visit of a center, oldest first"""
+        return self._frame(
+            "SELECT v.visit_date, a.pillar_en, a.sub_pillar_en, a.status, a.score, a.weight "
+            "FROM attributes a JOIN visits v ON v.id = a.visit_id "
+            "WHERE a.attribute = ? AND a.center = ? AND v.visit_date IS NOT NULL ORDER BY v.visit_date, v.id",
+            (attribute, center)
+        )
+
+    def stats(self):
+        with self._connect() as conn:
+            visits, centers = conn.execute("SELECT COUNT(*), COUNT(DISTINCT center) FROM visits").fetchone()
+        return {'visits': visits, 'centers': centers}
@@ -0,0 +1,564 @@
+import functools
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from evaluation_utils import EvaluationBuilder, PillarRecord, compile_evaluation
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# Below this many files, parsing in-process is faster than starting worker processes
+_MIN_FILES_FOR_POOL = 4
+
+VALID_STATUSES = ('E', 'R', 'N', 'NA')
+
+
+class LoadedVisit:
+    """Result of loading one visit file: a compiled evaluation or the reason it was rejected"""
+    __slots__ = ('name', 'center', 'evaluation', 'error', 'visit_date', 'content_hash')
+
+    def __init__(self, name, center, evaluation=None, error=None, visit_date=None, content_hash=None):
+        self.name = name
+        self.center = center
+        self.evaluation = evaluation
+        self.error = error
+        self.visit_date = visit_date
+        self.content_hash = content_hash
+
+
+# -------------------------------------------------
+# Schema validation
+# -------------------------------------------------
+class SchemaValidationError(ValueError):
+    """Raised with every schema violation found in a visit; errors is a list of (JSON path, message)"""
+
+    # Errors spelled out in str(); the full list stays available on .errors
+    MAX_LISTED = 10
+
+    def __init__(self, errors):
+        self.errors = errors
+        lines = [f"{path}: {message}" for path, message in errors[:self.MAX_LISTED]]
+        if len(errors) > self.MAX_LISTED:
+            lines.append(f"... و{len(errors) - self.MAX_LISTED} أخطاء أخرى")
+        super().__init__(f"{len(errors)} خطأ في بنية الملف:\n" + "\n".join(lines))
+
+
+# Exact types accepted as numbers: bool is an int subclass but not a score
+_NUMBER_TYPES = frozenset((int, float))
+
+# Marks an object field that is absent, as opposed to present with a null value
+_MISSING = object()
+
+
+# Evaluation schema. Node kinds: ('object', {field: node}), ('list', item node), ('number',),
+# ('score',) = number or '-', ('text',) = string or null, ('enum', strings). Fields may be left
+# out because the records fill in defaults, but a field that is present must match its node:
+# null is only accepted where the node allows it. Unknown fields are ignored.
+ATTRIBUTE_SCHEMA = ('object', {
+    'attribute_en': ('text',),
+    'status': ('enum', VALID_STATUSES),
+    'score': ('score',),
+    'weight': ('number',),
+    'notes_ar': ('text',),
+    'report_notes_ar': ('text',),
+})
+SUB_PILLAR_SCHEMA = ('object', {
+    'sub_pillar_en': ('text',),
+    'sub_pillar_ar': ('text',),
+    'attributes': ('list', ATTRIBUTE_SCHEMA),
+})
+PILLAR_SCHEMA = ('object', {
+    'pillar_en': ('text',),
+    'pillar_ar': ('text',),
+    'pillar_score': ('number',),
+    'sub_pillars': ('list', SUB_PILLAR_SCHEMA),
+})
+# NDJSON rows carry their pillar and sub-pillar next to the attribute fields
+ATTRIBUTE_ROW_SCHEMA = ('object', {
+    **ATTRIBUTE_SCHEMA[1],
+    **{field: node for field, node in PILLAR_SCHEMA[1].items() if field != 'sub_pillars'},
+    **{field: node for field, node in SUB_PILLAR_SCHEMA[1].items() if field != 'attributes'},
+})
+
+
+def compile_schema(node):
+    """Turn a schema node into a check(value, path, errors) function.
+
+    The tree is walked once here, so checking a document is a single pass of plain
+    function calls with no schema interpretation per value. Scalar fields are tested
+    with a bare predicate and paths, as (parent, key) pairs, are only built for values
+    that fail. Problems are appended to errors as (path, message) and checking continues.
+    """
+    kind = node[0]
+    if kind == 'object':
+        fields = tuple((field, compile_schema(child)) for field, child in node[1].items())
+        scalar_fields = tuple((field, check.accepts, check) for field, check in fields if hasattr(check, 'accepts'))
+        nested_fields = tuple((field, check) for field, check in fields if not hasattr(check, 'accepts'))
+
+        def check(value, path, errors):
+            if value.__class__ is not dict:
+                errors.append((path, "يجب أن يكون كائناً"))
+                return
+            get = value.get
+            for field, accepts, check_field in scalar_fields:
+                field_value = get(field, _MISSING)
+                if field_value is not _MISSING and not accepts(field_value):
+                    check_field(field_value, (path, field), errors)
+            for field, check_field in nested_fields:
+                field_value = get(field, _MISSING)
+                if field_value is not _MISSING:
+                    check_field(field_value, (path, field), errors)
+        return check
+
+    if kind == 'list':
+        check_item = compile_schema(node[1])
+
+        def check(value, path, errors):
+            if value.__class__ is not list:
+                errors.append((path, "يجب أن تكون قائمة"))
+                return
+            for index, item in enumerate(value):
+                check_item(item, (path, index), errors)
+        return check
+
+    if kind == 'number':
+        accepts = lambda value: value.__class__ in _NUMBER_TYPES
+        message = "يجب أن تكون رقماً"
+    elif kind == 'score':
+        accepts = lambda value: value.__class__ in _NUMBER_TYPES or value == '-'
+        message = "النتيجة يجب أن تكون رقماً أو '-'"
+    elif kind == 'text':
+        accepts = lambda value: value is None or value.__class__ is str
+        message = "يجب أن يكون نصاً"
+    elif kind == 'enum':
+        allowed = frozenset(node[1])
+        accepts = lambda value: value.__class__ is str and value in allowed
+        message = None
+    else:
+        raise ValueError(f"Unknown schema node: {kind}")
+
+    def check(value, path, errors):
+        if not accepts(value):
+            errors.append((path, message or f"قيمة غير معروفة '{value}'"))
+    check.accepts = accepts
+    return check
+
+
+def render_path(path):
+    """JSON path string of a (parent, key) path built by compile_schema() checks"""
+    keys = []
+    while isinstance(path, tuple):
+        path, key = path
+        keys.append(f"[{key}]" if isinstance(key, int) else f".{key}")
+    return path + "".join(reversed(keys))
+
+
+def _check(check, value, root, errors):
+    """Run a compiled check and append its errors to errors with rendered paths"""
+    found = []
+    check(value, root, found)
+    errors.extend((render_path(path), message) for path, message in found)
+
+
+check_pillar = compile_schema(PILLAR_SCHEMA)
+check_pillar_list = compile_schema(('list', PILLAR_SCHEMA))
+check_attribute_row = compile_schema(ATTRIBUTE_ROW_SCHEMA)
+
+
+def evaluation_errors(data, path='$'):
+    """Every schema violation in a visit's pillar list, as (JSON path, message)"""
+    if not isinstance(data, list) or not data:
+        return [(path, "يجب أن يحتوي الملف على قائمة غير فارغة من المحاور")]
+    errors = []
+    _check(check_pillar_list, data, path, errors)
+    return errors
+
+
+def validate_evaluation(data, path='$'):
+    """Raise SchemaValidationError listing every problem in a visit's pillar list"""
+    errors = evaluation_errors(data, path)
+    if errors:
+        raise SchemaValidationError(errors)
+
+
+def split_visit(data, default_center):
+    """Return (center name, pillar list) for either a bare pillar list or {"center": ..., "pillars": [...]}"""
+    if isinstance(data, dict):
+        return data.get('center_ar') or data.get('center') or default_center, data.get('pillars')
+    return default_center, data
+
+
+def visit_date_of(data):
+    """ISO visit date of {"visit_date": ..., "pillars": [...]}; None for a bare pillar list"""
+    if isinstance(data, dict) and data.get('visit_date') is not None:
+        return str(data['visit_date'])
+    return None
+
+
+def center_name_from_file(name):
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+def parse_visit(name, payload=None, path=None, snapshots=None):
+    """Parse, validate and compile one visit file (runs in a worker process).
+
+    With a SnapshotStore, a file whose content was ingested before is returned as its
+    memory-mapped Snapshot without parsing, and new files get a snapshot written.
+    """
+    center = center_name_from_file(name)
+    try:
+        if payload is None:
+            with open(path, 'rb') as file:
+                payload = file.read()
+        digest = hashlib.sha256(payload).hexdigest()
+        if snapshots is not None:
+            snapshot = snapshots.get(digest)
+            if snapshot is not None:
+                return LoadedVisit(name, snapshot.center or center, evaluation=snapshot,
+                                   visit_date=snapshot.visit_date, content_hash=digest)
+
+        data = json.loads(payload)
+        file_center, pillars = split_visit(data, None)
+        validate_evaluation(pillars, '$.pillars' if isinstance(data, dict) else '$')
+        evaluation = compile_evaluation(pillars)
+        evaluation.content_hash = digest
+        visit_date = visit_date_of(data)
+        evaluation.center, evaluation.visit_date = file_center, visit_date
+        if snapshots is not None:
+            snapshots.put(digest, evaluation, file_center, visit_date)
+        return LoadedVisit(name, file_center or center, evaluation=evaluation,
+                           visit_date=visit_date, content_hash=digest)
+    except ValueError as e:
+        # json.JSONDecodeError and UnicodeDecodeError are ValueErrors too
+        return LoadedVisit(name, center, error=str(e))
+    except Exception as e:
+        return LoadedVisit(name, center, error=f"تعذر قراءة الملف: {str(e)}")
+
+
+def _parse_source(source, snapshots=None):
+    return parse_visit(*source, snapshots=snapshots)
+
+
+def ingest_workers():
+    """Worker processes used to parse visit files (INGEST_MAX_WORKERS, default the CPU count)"""
+    return int(os.getenv('INGEST_MAX_WORKERS', os.cpu_count() or 1))
+
+
+def create_parse_pool(max_workers=None):
+    """A process pool for load_visits(), or None when parsing should stay in-process.
+
+    Workers are started with spawn rather than fork: forking a multi-threaded process
+    (such as the Streamlit server) can leave a lock held by another thread locked forever
+    in the child. Spawned workers are slow to start, so the pool is meant to be kept and
+    reused across batches.
+    """
+    if max_workers is None:
+        max_workers = ingest_workers()
+    if max_workers <= 1:
+        return None
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def load_visits(sources, max_workers=None, snapshots=None, executor=None):
+    """Load (name, payload, path) sources in parallel processes; results keep the input order.
+
+    A file that fails to parse or validate is returned with its error instead of
+    stopping the batch. snapshots is an optional SnapshotStore (see parse_visit()).
+    executor is a long-lived pool from create_parse_pool(); without one a pool is created
+    for this call. Small batches are always parsed in-process.
+    """
+    sources = list(sources)
+    if max_workers is None:
+        max_workers = ingest_workers()
+    if len(sources) < _MIN_FILES_FOR_POOL or max_workers <= 1:
+        return [_parse_source(source, snapshots) for source in sources]
+
+    parse = functools.partial(_parse_source, snapshots=snapshots)
+    chunksize = max(1, len(sources) // (max_workers * 4))
+    if executor is not None:
+        return list(executor.map(parse, sources, chunksize=chunksize))
+    with create_parse_pool(min(max_workers, len(sources))) as executor:
+        return list(executor.map(parse, sources, chunksize=chunksize))
+
+
+def read_zip_sources(zip_bytes):
+    """(name, payload, path) sources for every JSON file in a zip archive"""
+    sources = []
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as archive:
+        for info in archive.infolist():
+            name = info.filename
+            if info.is_dir() or not name.lower().endswith('.json') or name.startswith('__MACOSX/'):
+                continue
+            sources.append((name, archive.read(info), None))
+    return sorted(sources, key=lambda source: source[0])
+
+
+def read_directory_sources(directory):
+    """(name, payload, path) sources for every JSON file in a directory; workers read the files"""
+    return [
+        (name, None, os.path.join(directory, name))
+        for name in sorted(os.listdir(directory))
+        if name.lower().endswith('.json') and os.path.isfile(os.path.join(directory, name))
+    ]
+
+
+# -------------------------------------------------
+# Streaming ingestion
+# -------------------------------------------------
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+
+
+class _ProgressReader:
+    """File wrapper that reports how many bytes have been consumed"""
+
+    def __init__(self, stream, total_bytes=None, on_progress=None):
+        self.stream = stream
+        self.total_bytes = total_bytes
+        self.on_progress = on_progress
+        self.bytes_read = 0
+
+    def _advance(self, data):
+        self.bytes_read += len(data)
+        if self.on_progress:
+            self.on_progress(self.bytes_read, self.total_bytes)
+        return data
+
+    def read(self, size=-1):
+        return self._advance(self.stream.read(size))
+
+    def readline(self):
+        return self._advance(self.stream.readline())
+
+    def tell(self):
+        return self.stream.tell()
+
+    def seek(self, offset):
+        self.bytes_read = offset
+        return self.stream.seek(offset)
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+def _root_is_object(stream):
+    """Peek at the first significant byte of a seekable stream without consuming it"""
+    start = stream.tell()
+    head = stream.read(256).lstrip(b'\xef\xbb\xbf \t\r\n')
+    stream.seek(start)
+    return head[:1] == b'{'
+
+
+# Root fields of {"center": ..., "pillars": [...]} read by split_visit() and visit_date_of()
+VISIT_META_FIELDS = ('center', 'center_ar', 'visit_date')
+
+
+def _collect_meta(events, meta):
+    """Pass ijson parse events through, copying the root metadata scalars into meta"""
+    for prefix, event, value in events:
+        if prefix in VISIT_META_FIELDS and event in ('string', 'number', 'boolean', 'null'):
+            meta[prefix] = value
+        yield prefix, event, value
+
+
+def iter_pillar_records(stream, meta=None):
+    """Yield one compiled PillarRecord at a time from a JSON visit.
+
+    With ijson only one raw pillar is held in memory at a time next to the compact
+    records, never the whole document tree. Accepts a bare pillar list or
+    {"center": ..., "pillars": [...]}; for the latter, the root center and visit_date
+    fields are copied into the meta dict when one is given. Without ijson the document
+    is loaded whole.
+    """
+    if ijson is None:
+        data = json.load(stream)
+        if meta is not None and isinstance(data, dict):
+            meta.update((field, data[field]) for field in VISIT_META_FIELDS if field in data)
+        _, pillars = split_visit(data, None)
+        validate_evaluation(pillars, '$.pillars' if isinstance(data, dict) else '$')
+        for pillar in pillars:
+            yield PillarRecord(pillar)
+        return
+
+    # Records are yielded as they are read; schema errors are collected across the whole
+    # file and raised at the end, which abandons the evaluation being compiled
+    path = '$.pillars' if _root_is_object(stream) else '$'
+    if path == '$.pillars' and meta is not None:
+        pillars = ijson.items(_collect_meta(ijson.parse(stream, use_float=True), meta), 'pillars.item')
+    else:
+        pillars = ijson.items(stream, 'pillars.item' if path == '$.pillars' else 'item', use_float=True)
+    errors = []
+    pillar_count = 0
+    while True:
+        try:
+            pillar = next(pillars)
+        except StopIteration:
+            break
+        except ijson.JSONError as e:
+            raise ValueError(f"ملف JSON غير صالح: {str(e)}")
+        _check(check_pillar, pillar, f"{path}[{pillar_count}]", errors)
+        pillar_count += 1
+        if not errors:
+            yield PillarRecord(pillar)
+    if not pillar_count:
+        errors.append((path, "يجب أن يحتوي الملف على قائمة غير فارغة من المحاور"))
+    if errors:
+        raise SchemaValidationError(errors)
+
+
+def iter_ndjson_rows(stream):
+    """Yield (line number, parsed object) for every non-empty NDJSON line"""
+    for line_number, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                yield line_number, json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"السطر {line_number}: {str(e)}")
+
+
+def is_ndjson(name):
+    return name.lower().endswith(NDJSON_EXTENSIONS)
+
+
+def stream_evaluation(stream, name, total_bytes=None, on_progress=None):
+    """Compile a single visit while streaming it: JSON, or NDJSON with one attribute per line.
+
+    on_progress(bytes_read, total_bytes) is called as the input is consumed. Raises
+    ValueError for malformed or invalid input. The center and visit_date of a JSON visit
+    object are set on the returned Evaluation.
+    """
+    reader = _ProgressReader(stream, total_bytes, on_progress)
+    if not is_ndjson(name):
+        meta = {}
+        evaluation = compile_evaluation(iter_pillar_records(reader, meta))
+        evaluation.center, _ = split_visit(meta, None)
+        evaluation.visit_date = visit_date_of(meta)
+        return evaluation
+
+    builder = EvaluationBuilder()
+    errors = []
+    for line_number, row in iter_ndjson_rows(reader):
+        _check(check_attribute_row, row, f"السطر {line_number}: $", errors)
+        if not errors:
+            builder.add_attribute(row)
+    if errors:
+        raise SchemaValidationError(errors)
+    if not builder.pillars:
+        raise ValueError("لا يحتوي الملف على أي عناصر")
+    return builder.build()
+
+
+def read_ndjson_sources(name, stream):
+    """(name, payload, path) sources for an NDJSON file with one visit per line"""
+    base_name = center_name_from_file(name)
+    return [
+        (f"{base_name}-{line_number}", line, None)
+        for line_number, line in enumerate(stream, 1)
+        if line.strip()
+    ]
+
+
+# -------------------------------------------------
+# Parse cache
+# -------------------------------------------------
+def content_hash(stream, chunk_size=1 << 20):
+    """SHA-256 hex digest of the rest of a binary stream; the stream is rewound afterwards"""
+    start = stream.tell()
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    stream.seek(start)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """Bounded LRU of compiled evaluations keyed by the SHA-256 of the raw file bytes.
+
+    Cached evaluations are shared between sessions and must be treated as read-only;
+    their content_hash is set so downstream caches can key on it. Files on disk are
+    also remembered by (mtime, size), so an unchanged file is not even re-hashed. With a
+    SnapshotStore, misses are served from an on-disk snapshot when one exists, and newly
+    parsed evaluations are snapshotted.
+    """
+
+    def __init__(self, max_entries=None, snapshots=None):
+        if max_entries is None:
+            max_entries = int(os.getenv('PARSE_CACHE_MAX_ENTRIES', 16))
+        self.max_entries = max_entries
+        self.snapshots = snapshots
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._file_digests = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            evaluation = self._entries.get(key)
+            if evaluation is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return evaluation
+
+    def put(self, key, evaluation):
+        with self._lock:
+            self._entries[key] = evaluation
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def file_digest(self, path):
+        """Content hash of a file, re-read only when its mtime or size changed"""
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._file_digests.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+        with open(path, 'rb') as file:
+            digest = content_hash(file)
+        with self._lock:
+            self._file_digests[path] = (signature, digest)
+        return digest
+
+    def load_stream(self, stream, name, total_bytes=None, on_progress=None, digest=None):
+        """stream_evaluation() memoized by content: an identical file returns the cached Evaluation"""
+        if digest is None:
+            digest = content_hash(stream)
+        # The same bytes compile differently as JSON and as NDJSON
+        source_format = 'ndjson' if is_ndjson(name) else 'json'
+        key = (digest, source_format)
+        evaluation = self.get(key)
+        if evaluation is not None:
+            return evaluation
+
+        snapshot = self.snapshots.get(digest, source_format) if self.snapshots is not None else None
+        if snapshot is not None:
+            evaluation = snapshot.to_evaluation()
+        else:
+            evaluation = stream_evaluation(stream, name, total_bytes, on_progress)
+            evaluation.content_hash = digest
+            if self.snapshots is not None:
+                self.snapshots.put(digest, evaluation, evaluation.center, evaluation.visit_date, source_format)
+        self.put(key, evaluation)
+        return evaluation
+
+    def load_file(self, path, on_progress=None):
+        digest = self.file_digest(path)
+        with open(path, 'rb') as file:
+            return self.load_stream(file, path, os.path.getsize(path), on_progress, digest)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
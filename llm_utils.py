@@ -0,0 +1,809 @@
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import logging.handlers
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+
+import google.generativeai as genai
+
+
+# Request priorities for the rate limiter (lower is served first)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+_RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class ModelUnavailableError(RuntimeError):
+    """No model is resolved, e.g. while the resolver backs off after a failed probe round"""
+
+
+def is_retryable_error(error):
+    """True for quota (429) and transient server (5xx) errors"""
+    if isinstance(error, ModelUnavailableError):
+        # The resolver decides when models are probed again; retrying sooner cannot succeed
+        return False
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code in _RETRYABLE_STATUS_CODES
+    message = str(error).lower()
+    return any(marker in message for marker in ("429", "quota", "rate limit", "500", "502", "503", "504", "unavailable"))
+
+
+class RateLimiter:
+    """Process-wide token-bucket limiter (requests/min and tokens/min) with retry and backoff.
+    
+    Waiting callers are served strictly by priority, then arrival order, so interactive
+    requests overtake queued background work.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_retries=None,
+                 base_delay=1.0, max_delay=30.0):
+        if requests_per_minute is None:
+            requests_per_minute = float(os.getenv("LLM_RATE_LIMIT_RPM", 60))
+        if tokens_per_minute is None:
+            tokens_per_minute = float(os.getenv("LLM_RATE_LIMIT_TPM", 250000))
+        if max_retries is None:
+            max_retries = int(os.getenv("LLM_MAX_RETRIES", 4))
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._request_bucket = requests_per_minute
+        self._token_bucket = tokens_per_minute
+        self._refilled_at = time.monotonic()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+        self.requests = 0
+        self.retries = 0
+        self.throttled_seconds = 0.0
+
+    # -------------------------------------------------
+    # Token buckets
+    # -------------------------------------------------
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self._refilled_at) / 60
+        self._refilled_at = now
+        self._request_bucket = min(self.requests_per_minute,
+                                   self._request_bucket + elapsed_minutes * self.requests_per_minute)
+        self._token_bucket = min(self.tokens_per_minute,
+                                 self._token_bucket + elapsed_minutes * self.tokens_per_minute)
+
+    def _seconds_until_available(self, tokens):
+        request_deficit = max(0.0, 1 - self._request_bucket)
+        token_deficit = max(0.0, tokens - self._token_bucket)
+        return 60 * max(request_deficit / self.requests_per_minute, token_deficit / self.tokens_per_minute)
+
+    def acquire(self, tokens=1, priority=PRIORITY_INTERACTIVE):
+        """Block until one request and `tokens` tokens are available for this caller"""
+        tokens = min(tokens, self.tokens_per_minute)
+        entry = (priority, next(self._sequence))
+        started = time.monotonic()
+
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    self._refill()
+                    wait = self._seconds_until_available(tokens) if self._waiting[0] == entry else None
+                    if wait == 0:
+                        heapq.heappop(self._waiting)
+                        self._request_bucket -= 1
+                        self._token_bucket -= tokens
+                        break
+                    self._condition.wait(timeout=wait)
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                raise
+            finally:
+                self.throttled_seconds += time.monotonic() - started
+                self._condition.notify_all()
+
+        self.requests += 1
+
+    def call(self, fn, tokens=1, priority=PRIORITY_INTERACTIVE, on_retry=None):
+        """Run fn() under the limiter, retrying quota and 5xx errors with jittered exponential backoff"""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens, priority)
+            try:
+                return fn()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable_error(e):
+                    raise
+                backoff = min(self.max_delay, self.base_delay * 2 ** attempt)
+                delay = backoff / 2 + random.uniform(0, backoff / 2)
+                self.retries += 1
+                self.throttled_seconds += delay
+                if on_retry:
+                    on_retry(e)
+                time.sleep(delay)
+
+    def stats(self):
+        with self._condition:
+            self._refill()
+            return {
+                "queue_depth": len(self._waiting),
+                "requests": self.requests,
+                "retries": self.retries,
+                "throttled_seconds": self.throttled_seconds,
+                "requests_available": int(self._request_bucket),
+                "tokens_available": int(self._token_bucket),
+            }
+
+
+class ModelResolver:
+    """Resolve a working Gemini model once per process and API key.
+    
+    Candidate models are health-probed with a one-token request and the first one
+    that answers is kept. The choice is re-probed in the background when it goes
+    stale or when a call reports that the model failed. When no model answers, the
+    failure is kept and callers get None without probing until the retry delay
+    (LLM_MODEL_RETRY_SECONDS, doubled after each failed round up to refresh_seconds)
+    has passed.
+    """
+
+    def __init__(self, api_key, model_names, refresh_seconds=None, probe_timeout=10, rate_limiter=None,
+                 retry_seconds=None):
+        if refresh_seconds is None:
+            refresh_seconds = float(os.getenv("LLM_MODEL_REFRESH_SECONDS", 3600))
+        if retry_seconds is None:
+            retry_seconds = float(os.getenv("LLM_MODEL_RETRY_SECONDS", 60))
+        self.api_key = api_key
+        self.model_names = list(model_names)
+        self.refresh_seconds = refresh_seconds
+        self.probe_timeout = probe_timeout
+        self.rate_limiter = rate_limiter
+        self.retry_seconds = retry_seconds
+
+        self.model = None
+        self.model_name = None
+        self.resolved_at = 0.0
+        self.last_error = None
+        self.failures = 0
+        self.retry_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+
+    def get_model(self):
+        if self.model is None:
+            # Only the very first resolution blocks callers; after a failed round, reruns
+            # get None straight away until the retry delay has passed
+            if time.time() < self.retry_at:
+                return None
+            with self._lock:
+                if self.model is None and time.time() >= self.retry_at:
+                    self._resolve()
+            return self.model
+
+        if self.refresh_seconds and time.time() - self.resolved_at > self.refresh_seconds:
+            self.refresh_async()
+        return self.model
+
+    def refresh_async(self):
+        with self._refresh_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                with self._lock:
+                    self._resolve(priority=PRIORITY_BACKGROUND)
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=refresh, name="gemini-model-refresh", daemon=True).start()
+
+    def report_failure(self, error=None):
+        self.last_error = str(error) if error else self.last_error
+        self.refresh_async()
+
+    # -------------------------------------------------
+    # Probing
+    # -------------------------------------------------
+    def _probe(self, model, priority=PRIORITY_INTERACTIVE):
+        def probe():
+            model.generate_content(
+                "ping",
+                generation_config={"max_output_tokens": 1},
+                request_options={"timeout": self.probe_timeout},
+            )
+
+        try:
+            if self.rate_limiter:
+                # Probes are not retried: a throttled model still counts as answering
+                self.rate_limiter.acquire(tokens=2, priority=priority)
+            probe()
+            return True
+        except Exception as e:
+            self.last_error = str(e)
+            # Quota errors mean the model exists and answers; it is only throttled
+            message = self.last_error.lower()
+            return "429" in message or "quota" in message
+
+    def _resolve(self, priority=PRIORITY_INTERACTIVE):
+        genai.configure(api_key=self.api_key)
+
+        for model_name in self.model_names:
+            try:
+                model = genai.GenerativeModel(model_name)
+            except Exception as e:
+                self.last_error = str(e)
+                continue
+
+            if self._probe(model, priority):
+                self._set_model(model, model_name)
+                return
+
+        # Nothing answered: keep the previous model (if any) and retry on the next refresh,
+        # or after a growing delay when there is no model at all
+        self.resolved_at = time.time()
+        self.failures += 1
+        delay = self.retry_seconds * 2 ** (self.failures - 1)
+        self.retry_at = self.resolved_at + (min(delay, self.refresh_seconds) if self.refresh_seconds else delay)
+
+    def _set_model(self, model, model_name):
+        self.model = model
+        self.model_name = model_name
+        self.resolved_at = time.time()
+        self.last_error = None
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+# -------------------------------------------------
+# Backends
+# -------------------------------------------------
+class LLMBackend:
+    """Interface of a text generation backend.
+    
+    generate() returns the full response text; stream() yields text chunks.
+    generation_config is passed through (e.g. JSON mode settings). When a `usage`
+    dict is given, backends fill in prompt_tokens and response_tokens.
+    """
+
+    model_name = None
+    generation_config = None
+
+    def generate(self, prompt, generation_config=None, usage=None):
+        raise NotImplementedError
+
+    def stream(self, prompt, generation_config=None, usage=None):
+        text = self.generate(prompt, generation_config, usage)
+        if text:
+            yield text
+
+
+def _record_usage(usage, usage_metadata):
+    """Copy Gemini usage_metadata token counts into a usage dict"""
+    if usage is None or not usage_metadata:
+        return
+    prompt_tokens = getattr(usage_metadata, "prompt_token_count", None)
+    response_tokens = getattr(usage_metadata, "candidates_token_count", None)
+    if prompt_tokens:
+        usage["prompt_tokens"] = prompt_tokens
+    if response_tokens:
+        usage["response_tokens"] = response_tokens
+
+
+class GeminiBackend(LLMBackend):
+    """google.generativeai backend using the model picked by a ModelResolver"""
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+
+    @property
+    def model_name(self):
+        return self.resolver.model_name
+
+    @property
+    def generation_config(self):
+        return getattr(self.resolver.model, "_generation_config", None)
+
+    def generate(self, prompt, generation_config=None, usage=None):
+        response = self._generate_content(prompt, generation_config, stream=False)
+        _record_usage(usage, getattr(response, "usage_metadata", None))
+        return response.text if response and hasattr(response, "text") else None
+
+    def stream(self, prompt, generation_config=None, usage=None):
+        for chunk in self._generate_content(prompt, generation_config, stream=True):
+            # The last chunk carries the totals for the whole response
+            _record_usage(usage, getattr(chunk, "usage_metadata", None))
+            try:
+                chunk_text = chunk.text
+            except ValueError:
+                # Chunks without text parts (e.g. the final finish-reason chunk)
+                continue
+            if chunk_text:
+                yield chunk_text
+
+    def _generate_content(self, prompt, generation_config, stream):
+        kwargs = {"generation_config": generation_config} if generation_config else {}
+        model = self.resolver.get_model()
+        if model is None:
+            retry_in = max(0, math.ceil(self.resolver.retry_at - time.time()))
+            raise ModelUnavailableError(f"No Gemini model available; models are probed again in {retry_in}s "
+                                        f"(last error: {self.resolver.last_error})")
+        try:
+            return model.generate_content(prompt, stream=stream, **kwargs)
+        except Exception as e:
+            # Missing or retired models get re-probed in the background
+            if "404" in str(e) or "not found" in str(e).lower():
+                self.resolver.report_failure(e)
+            raise
+
+
+class FakeBackend(LLMBackend):
+    """Offline deterministic backend for load testing without a key or network.
+    
+    Responses are Arabic text shaped like the real report sections. Latency follows a
+    log-normal time to first token plus a per-token streaming rate; the same prompt
+    always produces the same text and timings. LLM_FAKE_LATENCY_SCALE scales all
+    delays (0 disables them).
+    """
+
+    model_name = "fake-gemini"
+
+    # Typical response lengths in words, per section kind
+    _WORD_COUNTS = {"summary": (260, 60), "pillar": (190, 40), "recommendations": (150, 30), "generic": (120, 40)}
+
+    _SENTENCES = [
+        "يعكس هذا الأداء التزام المركز بتوفير تجربة متعاملين متميزة وفق معايير الخدمة الحكومية",
+        "تمت ملاحظة مستوى جيد من النظافة والتنظيم في مختلف مرافق المركز",
+        "تتطلب بعض الجوانب المتعلقة باللافتات الإرشادية مراجعة لضمان وضوحها من مسافة مناسبة",
+        "يسهم توفر مواقف السيارات القريبة في تسهيل وصول المتعاملين إلى المركز",
+        "تشكل أوقات الذروة تحدياً يتطلب رفع القدرة الاستيعابية لمنطقة الانتظار",
+        "تظهر بعض قطع الأثاث آثار التقادم مما يستدعي وضع خطة صيانة دورية",
+        "يتيح المسار الممتد من المواقف إلى المدخل حركة سلسة للأشخاص من ذوي الهمم",
+        "ينعكس ضبط درجة الحرارة والإضاءة بشكل مباشر على راحة المتعاملين أثناء الانتظار",
+    ]
+
+    _RECOMMENDATION_CATEGORIES = [
+        "البيئة العامة",
+        "مواقف السيارات",
+        "المبنى",
+        "القدرة الاستيعابية والانتظار",
+        "سهولة الوصول إلى الموقع",
+    ]
+
+    def __init__(self, latency_scale=None, tokens_per_second=80.0, median_first_token_seconds=0.8):
+        if latency_scale is None:
+            latency_scale = float(os.getenv("LLM_FAKE_LATENCY_SCALE", 1.0))
+        self.latency_scale = latency_scale
+        self.tokens_per_second = tokens_per_second
+        self.median_first_token_seconds = median_first_token_seconds
+
+    def generate(self, prompt, generation_config=None, usage=None):
+        return "".join(self.stream(prompt, generation_config, usage))
+
+    def stream(self, prompt, generation_config=None, usage=None):
+        rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+        text = self._compose(prompt, generation_config, rng)
+        if usage is not None:
+            usage["prompt_tokens"] = len(prompt) // 2
+            usage["response_tokens"] = int(len(text.split()) * 1.5)
+
+        self._sleep(rng.lognormvariate(math.log(self.median_first_token_seconds), 0.4))
+        words = text.split(" ")
+        for start in range(0, len(words), 12):
+            chunk = " ".join(words[start:start + 12])
+            yield chunk if start + 12 >= len(words) else chunk + " "
+            # ~1.5 tokens per Arabic word
+            self._sleep(18 / self.tokens_per_second * rng.uniform(0.7, 1.3))
+
+    def _sleep(self, seconds):
+        if self.latency_scale > 0:
+            time.sleep(seconds * self.latency_scale)
+
+    # -------------------------------------------------
+    # Section-shaped text
+    # -------------------------------------------------
+    def _compose(self, prompt, generation_config, rng):
+        kind = self._section_kind(prompt)
+        if generation_config and generation_config.get("response_mime_type") == "application/json":
+            return self._compose_json(prompt, rng)
+        if kind == "recommendations":
+            return self._compose_recommendations(rng)
+
+        mean, spread = self._WORD_COUNTS[kind]
+        target_words = max(40, int(rng.gauss(mean, spread)))
+        percentage = self._first_percentage(prompt)
+        opening = {
+            "summary": f"أظهرت نتائج زيارة المتسوق السري أن المركز حقق معدلاً كلياً بلغ {percentage}،",
+            "pillar": f"حقق هذا المحور نتيجة بلغت {percentage}،",
+        }.get(kind, "")
+        return self._paragraphs(opening, target_words, 3 if kind == "summary" else 1, rng)
+
+    def _compose_recommendations(self, rng):
+        blocks = []
+        for category in self._RECOMMENDATION_CATEGORIES:
+            items = rng.sample(self._SENTENCES, 2)
+            blocks.append(f"### {category}\n" + "\n".join(f"● {item}" for item in items))
+        return "\n\n".join(blocks)
+
+    def _compose_json(self, prompt, rng):
+        pillar_keys = re.findall(r"^- ([A-Za-z][A-Za-z ]*): ", prompt, flags=re.MULTILINE)
+        percentage = self._first_percentage(prompt)
+        report = {
+            "executive_summary": self._paragraphs(
+                f"أظهرت نتائج زيارة المتسوق السري أن المركز حقق معدلاً كلياً بلغ {percentage}،", 260, 3, rng),
+            "pillar_analyses": {
+                key: self._paragraphs("حقق هذا المحور نتيجة مرتفعة،", 190, 1, rng) for key in pillar_keys
+            },
+            "recommendations": {
+                category: rng.sample(self._SENTENCES, 2) for category in self._RECOMMENDATION_CATEGORIES
+            },
+        }
+        return json.dumps(report, ensure_ascii=False)
+
+    def _paragraphs(self, opening, target_words, paragraph_count, rng):
+        paragraphs = []
+        words_per_paragraph = max(1, target_words // paragraph_count)
+        for index in range(paragraph_count):
+            sentences = [opening] if index == 0 and opening else []
+            while sum(len(sentence.split()) for sentence in sentences) < words_per_paragraph:
+                sentences.append(rng.choice(self._SENTENCES) + ".")
+            paragraphs.append(" ".join(sentences))
+        return "\n\n".join(paragraphs)
+
+    @staticmethod
+    def _section_kind(prompt):
+        if "أظهرت نتائج زيارة المتسوق السري أن" in prompt:
+            return "summary"
+        if "اكتب تحليلاً تفصيلياً لمحور" in prompt:
+            return "pillar"
+        if "مقترحات تطويرية" in prompt:
+            return "recommendations"
+        return "generic"
+
+    @staticmethod
+    def _first_percentage(prompt):
+        match = re.search(r"(\d+(?:\.\d+)?)%", prompt)
+        return f"{match.group(1)}%" if match else "70%"
+
+
+class _InFlightCall:
+    """State of one in-flight request shared by its leader and followers"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.done = False
+        self.result = None
+        self.error = None
+        self.partial = None
+
+
+class SingleFlight:
+    """Coalesce identical concurrent requests into a single call.
+    
+    The first caller for a key (the leader) runs the call; callers arriving while it
+    is in flight wait for its result instead of issuing their own request. Partial
+    results published by the leader are forwarded to waiting followers.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.waiting = 0
+
+    def do(self, key, fn, on_partial=None):
+        """Run fn(publish) once per key at a time; publish(partial) feeds followers' on_partial"""
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _InFlightCall()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+                self.waiting += 1
+
+        if is_leader:
+            return self._lead(key, call, fn, on_partial)
+        try:
+            return self._follow(call, on_partial)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def _lead(self, key, call, fn, on_partial):
+        def publish(partial):
+            with call.condition:
+                call.partial = partial
+                call.condition.notify_all()
+            if on_partial:
+                on_partial(partial)
+
+        try:
+            call.result = fn(publish)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            with call.condition:
+                call.done = True
+                call.condition.notify_all()
+
+    def _follow(self, call, on_partial):
+        seen = None
+        with call.condition:
+            while not call.done:
+                if on_partial and call.partial is not None and call.partial is not seen:
+                    seen = call.partial
+                    on_partial(seen)
+                call.condition.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "waiting": self.waiting,
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+            }
+
+
+# -------------------------------------------------
+# Telemetry
+# -------------------------------------------------
+class CallRecord:
+    """Measurements of one LLM call as seen by the report"""
+    __slots__ = ("section", "model", "started_at", "cache_hit", "coalesced", "prompt_tokens",
+                 "response_tokens", "ttfb_seconds", "latency_seconds", "retries", "error")
+
+    def __init__(self, section, model):
+        self.section = section
+        self.model = model
+        self.started_at = time.time()
+        self.cache_hit = False
+        self.coalesced = False
+        self.prompt_tokens = None
+        self.response_tokens = None
+        self.ttfb_seconds = None
+        self.latency_seconds = None
+        self.retries = 0
+        self.error = None
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))]
+
+
+class LLMTelemetry:
+    """Collect per-call LLM telemetry in memory and in a rotating JSONL log"""
+
+    def __init__(self, log_path=None, max_bytes=5 * 1024 * 1024, backup_count=3, history_size=2000):
+        self.log_path = log_path or os.getenv("LLM_TELEMETRY_LOG", ".cache/llm/telemetry.jsonl")
+        self._records = defaultdict(lambda: deque(maxlen=history_size))
+        self._lock = threading.Lock()
+
+        self._logger = logging.getLogger(f"llm_telemetry.{id(self)}")
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False
+        try:
+            os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                self.log_path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(handler)
+        except OSError:
+            # Telemetry must never break generation; keep in-memory stats only
+            pass
+
+    def record(self, call_record):
+        with self._lock:
+            self._records[call_record.section].append(call_record)
+        self._logger.info(json.dumps(call_record.to_dict(), ensure_ascii=False))
+
+    def summary(self):
+        """Per-section call counts, p50/p95 latency and TTFB, token averages and cache hits.
+
+        Latency, TTFB and token figures only cover calls that reached the model; cache hits
+        and calls that waited on an identical in-flight request are counted separately.
+        """
+        with self._lock:
+            records_by_section = {section: list(records) for section, records in self._records.items()}
+
+        summary = {}
+        for section, records in records_by_section.items():
+            model_calls = [r for r in records if not r.cache_hit and not r.coalesced]
+            latencies = [r.latency_seconds for r in model_calls if r.latency_seconds is not None]
+            ttfbs = [r.ttfb_seconds for r in model_calls if r.ttfb_seconds is not None]
+            prompt_tokens = [r.prompt_tokens for r in model_calls if r.prompt_tokens]
+            response_tokens = [r.response_tokens for r in model_calls if r.response_tokens]
+            summary[section] = {
+                "calls": len(records),
+                "cache_hits": sum(1 for r in records if r.cache_hit),
+                "coalesced": sum(1 for r in records if r.coalesced),
+                "errors": sum(1 for r in records if r.error),
+                "retries": sum(r.retries for r in records),
+                "latency_p50": _percentile(latencies, 50),
+                "latency_p95": _percentile(latencies, 95),
+                "ttfb_p50": _percentile(ttfbs, 50),
+                "ttfb_p95": _percentile(ttfbs, 95),
+                "prompt_tokens_avg": sum(prompt_tokens) / len(prompt_tokens) if prompt_tokens else None,
+                "response_tokens_avg": sum(response_tokens) / len(response_tokens) if response_tokens else None,
+            }
+        return summary
+
+
+class ResponseCache:
+    """Persistent content-addressed cache for LLM responses (SQLite)"""
+
+    def __init__(self, cache_dir=None, ttl_seconds=None, max_bytes=None):
+        self.cache_dir = cache_dir or os.getenv("LLM_CACHE_DIR", ".cache/llm")
+        if ttl_seconds is None:
+            ttl_seconds = float(os.getenv("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv("LLM_CACHE_MAX_MB", 50)) * 1024 * 1024)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.db_path = os.path.join(self.cache_dir, "responses.sqlite3")
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+
+    # -------------------------------------------------
+    # Keys
+    # -------------------------------------------------
+    @staticmethod
+    def make_key(model_name, prompt, generation_config=None):
+        payload = json.dumps(
+            {"model": model_name, "prompt": prompt, "config": generation_config or {}},
+            ensure_ascii=False,
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    # -------------------------------------------------
+    # Lookup / store
+    # -------------------------------------------------
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            response, created_at = row
+            if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return response
+
+    def set(self, key, model_name, response):
+        if not response:
+            return
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_name, response, size, now, now),
+            )
+            self._evict(conn)
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+    # -------------------------------------------------
+    # Eviction (TTL first, then least recently used)
+    # -------------------------------------------------
+    def _evict(self, conn):
+        if self.ttl_seconds:
+            cursor = conn.execute(
+                "DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+            )
+            self.evictions += max(cursor.rowcount, 0)
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall():
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.evictions += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    # -------------------------------------------------
+    # Stats
+    # -------------------------------------------------
+    def stats(self):
+        with self._connect() as conn:
+            entries, total = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size_bytes": total,
+        }
+
+    def _connect(self):
+        return _closing_connection(sqlite3.connect(self.db_path, timeout=30))
+
+
+class _closing_connection:
+    """sqlite3 connection context that commits and always closes"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.conn.close()
+        return False
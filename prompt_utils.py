@@ -0,0 +1,341 @@
+import heapq
+import itertools
+import math
+import re
+
+
+# Lower rank = more severe; notes of less severe findings are shortened first
+STATUS_SEVERITY = {'N': 0, 'R': 1, 'E': 2, 'NA': 3}
+
+# Default per-section input token budgets
+PROMPT_TOKEN_BUDGETS = {
+    'summary': 2500,
+    'pillar': 1500,
+    'recommendations': 1200,
+    'one_shot': 3500,
+    'sub_pillar': 800,
+    'comparison': 900,
+    'network': 1200
+}
+
+# Note length caps (characters) tried in turn until the payload fits its budget
+_NOTE_CAPS = (240, 120, 0)
+
+# Points per status when ranking findings for the recommendations prompt (E and NA are not ranked)
+FINDING_SEVERITY_POINTS = {'N': 3.0, 'R': 2.0}
+
+# Approximate tokens of one finding row at the longest note cap; sets how many findings fit a budget
+_FINDING_TOKENS = _NOTE_CAPS[0] // 2 + 10
+
+# Approximate tokens of one changed-attribute row in a visit comparison (notes at the shorter cap)
+_CHANGE_TOKENS = _NOTE_CAPS[1] // 2 + 10
+
+
+def estimate_tokens(text):
+    """Rough token estimate: ~4 chars per token for Latin text, ~2 for Arabic"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return math.ceil(ascii_chars / 4 + (len(text) - ascii_chars) / 2)
+
+
+class _Row:
+    """One attribute/finding line of a compact payload; label replaces the status text when given"""
+    __slots__ = ('group', 'status', 'score', 'weight', 'note', 'full_note', 'label')
+
+    def __init__(self, group, status, score, weight, note, label=None):
+        self.group = group
+        self.status = status
+        self.score = score
+        self.weight = weight
+        self.note = note
+        self.full_note = note
+        self.label = label
+
+
+class CompactPayload:
+    """Tabular prompt payload grouped by pillar / sub-pillar, fitted to a token budget"""
+
+    STATUS_LEGEND = "(E متميز، R يحتاج تحسين، N حرج، NA لا ينطبق)"
+
+    def __init__(self, rows, group_headers, budget_tokens=None, show_score=True):
+        self.rows = rows
+        self.group_headers = group_headers
+        self.budget_tokens = budget_tokens
+        self.show_score = show_score
+        self.truncated = 0
+        self._fit()
+        self.text = self.render()
+        self.tokens = estimate_tokens(self.text)
+
+    def render(self):
+        columns = "الحالة | النتيجة | الملاحظة" if self.show_score else "الحالة | الملاحظة"
+        lines = [f"الصيغة: {columns} {self.STATUS_LEGEND}"]
+        current_group = None
+        for row in self.rows:
+            # Pillar and sub-pillar names are written once per group, not per row
+            if row.group != current_group:
+                for depth, name in enumerate(row.group):
+                    if current_group is None or depth >= len(current_group) or current_group[depth] != name:
+                        lines.append(" " * depth + self.group_headers.get(row.group[:depth + 1], name or ""))
+                current_group = row.group
+
+            fields = [row.label or row.status]
+            if self.show_score:
+                fields.append(_format_score(row.score, row.weight))
+            if row.note:
+                fields.append(row.note)
+            lines.append(" " * len(row.group) + " | ".join(fields))
+        return "\n".join(lines)
+
+    def _fit(self):
+        if not self.budget_tokens or estimate_tokens(self.render()) <= self.budget_tokens:
+            return
+
+        severities = sorted(STATUS_SEVERITY, key=STATUS_SEVERITY.get, reverse=True)
+        for cap in _NOTE_CAPS:
+            for severity in severities:
+                for row in self.rows:
+                    if row.status == severity and row.note and len(row.note) > cap:
+                        row.note = _truncate(row.full_note, cap)
+                        self.truncated += 1
+                if estimate_tokens(self.render()) <= self.budget_tokens:
+                    return
+
+
+def _format_score(score, weight):
+    score_text = '-' if score in ('-', None) else f"{float(score):g}"
+    return score_text if weight in (1, None) else f"{score_text} (w{weight:g})"
+
+
+def _truncate(text, cap):
+    if not cap or not text:
+        return ""
+    text = re.sub(r"\s+", " ", text).strip()
+    if len(text) <= cap:
+        return text
+    # Prefer cutting at the end of a sentence
+    cut = text[:cap]
+    sentence_end = max(cut.rfind("."), cut.rfind("،"), cut.rfind("؛"))
+    if sentence_end > cap // 2:
+        cut = cut[:sentence_end]
+    return cut.rstrip() + "…"
+
+
+def _clean_note(text):
+    return re.sub(r"\s+", " ", text or "").strip()
+
+
+def serialize_pillars(pillars, budget_tokens=None):
+    """Compact payload of prepare_data_for_gemini()['pillars'] for the executive summary"""
+    rows = []
+    headers = {}
+    for pillar in pillars:
+        pillar_key = (pillar['name_ar'],)
+        headers[pillar_key] = f"[{pillar['name_ar']} | {float(pillar['score']) * 100:.0f}%]"
+        for sub_pillar in pillar['sub_pillars']:
+            for attr in sub_pillar['attributes']:
+                rows.append(_Row(pillar_key + (sub_pillar['name_ar'],), attr['status'],
+                                 attr['score'], attr.get('weight', 1), _clean_note(attr.get('notes_ar'))))
+    return CompactPayload(rows, headers, budget_tokens)
+
+
+def serialize_pillar_detail(sub_pillars, budget_tokens=None):
+    """Compact payload of analyze_pillar_performance()['sub_pillars'] for a pillar analysis"""
+    rows = []
+    headers = {}
+    for sub_pillar in sub_pillars:
+        sub_key = (sub_pillar['name_ar'],)
+        counts = sub_pillar['status_counts']
+        headers[sub_key] = f"{sub_pillar['name_ar']} (E:{counts['E']} R:{counts['R']} N:{counts['N']})"
+        for attr in sub_pillar['attributes']:
+            rows.append(_Row(sub_key, attr['status'], attr['score'], attr.get('weight', 1),
+                             _clean_note(attr.get('notes_ar'))))
+    return CompactPayload(rows, headers, budget_tokens)
+
+
+def serialize_findings(findings, budget_tokens=None):
+    """Compact payload of prepare_data_for_gemini()['detailed_findings'] entries"""
+    rows = [
+        _Row((finding['pillar'], finding['sub_pillar']), finding['status'], None, None,
+             _clean_note(finding.get('notes')))
+        for finding in findings
+    ]
+    # Keep each pillar / sub-pillar contiguous so its name is written once
+    order = {}
+    for row in rows:
+        order.setdefault(row.group, len(order))
+    rows.sort(key=lambda row: order[row.group])
+    return CompactPayload(rows, {}, budget_tokens, show_score=False)
+
+
+def serialize_sub_pillar(sub_pillar, budget_tokens=None):
+    """Compact payload of one sub-pillar's attributes for a map-stage summary"""
+    rows = [
+        _Row((), attr['status'], attr['score'], attr.get('weight', 1), _clean_note(attr.get('notes_ar')))
+        for attr in sub_pillar['attributes']
+    ]
+    return CompactPayload(rows, {}, budget_tokens)
+
+
+def _numeric_score(score):
+    try:
+        return float(score)
+    except (TypeError, ValueError):
+        return None
+
+
+def select_findings(findings, category_of, categories, budget_tokens=None):
+    """Pick the N/R findings most worth sending to the recommendations prompt.
+
+    Each finding is ranked by status severity x attribute weight x (1 + score gap), where
+    the gap is measured against the best score seen for the same weight. Candidates are
+    kept in bounded per-category heaps; every category first gets its best finding, and
+    the remaining slots go to the highest ranked overall. The number of findings follows
+    the token budget. Returned findings are ordered by rank.
+    """
+    limit = max(len(categories), (budget_tokens or PROMPT_TOKEN_BUDGETS['recommendations']) // _FINDING_TOKENS)
+
+    full_scores = {}
+    for finding in findings:
+        score = _numeric_score(finding.get('score'))
+        if score is not None:
+            weight = finding.get('weight', 1)
+            full_scores[weight] = max(full_scores.get(weight, 0.0), score)
+
+    heaps = {}
+    order = itertools.count()
+    for finding in findings:
+        points = FINDING_SEVERITY_POINTS.get(finding['status'])
+        score = _numeric_score(finding.get('score', 0))
+        if not points or score is None:
+            continue
+        weight = finding.get('weight', 1) or 1
+        full_score = full_scores.get(weight)
+        gap = (full_score - score) / full_score if full_score else 1.0
+        # Earlier findings win ties, so equal ranks keep file order
+        entry = (points * weight * (1 + gap), -next(order), finding)
+
+        heap = heaps.setdefault(category_of(finding), [])
+        if len(heap) < limit:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    ranked = {category: sorted(heap, reverse=True) for category, heap in heaps.items()}
+    selected = [ranked[category][0] for category in categories if ranked.get(category)]
+    selected += heapq.nlargest(
+        max(0, limit - len(selected)),
+        (entry for category in categories for entry in ranked.get(category, [])[1:])
+    )
+    selected.sort(reverse=True)
+    return [entry[2] for entry in selected]
+
+
+def serialize_delta(delta, budget_tokens=None):
+    """Compact text of an EvaluationDelta for the executive summary prompt.
+
+    Overall movement, the pillars that moved (worst first) and status transition counts
+    come first, within half the budget; then only the changed attributes, most severe
+    first, as many as fit. Each change is written as before→after with the latest note.
+    """
+    budget_tokens = budget_tokens or PROMPT_TOKEN_BUDGETS['comparison']
+    lines = [
+        f"المعدل الكلي: من {delta.before.overall_score:.1f}% إلى {delta.after.overall_score:.1f}% "
+        f"({delta.overall_delta:+.1f} نقطة)",
+        f"عناصر تراجعت: {len(delta.worsened)} - عناصر تحسنت: {len(delta.improved)} - دون تغيير: {delta.unchanged}"
+    ]
+    if delta.transitions:
+        lines.append("انتقالات الحالة: " + "، ".join(
+            f"{before}→{after} ×{count}" for (before, after), count in
+            sorted(delta.transitions.items(), key=lambda item: -item[1])
+        ))
+
+    moved = sorted(
+        (pillar for pillar in delta.pillars
+         if round(pillar['delta'] or 0, 1) or pillar['delta'] is None or any(pillar['status_deltas'].values())),
+        key=lambda pillar: (pillar['delta'] or 0,
+                            -(2 * pillar['status_deltas']['N'] + pillar['status_deltas']['R']))
+    )
+    for position, pillar in enumerate(moved):
+        if estimate_tokens("\n".join(lines)) > budget_tokens // 2:
+            lines.append(f"... و{len(moved) - position} محاور أخرى تغيرت")
+            break
+        status_moves = "، ".join(f"{status} {count:+d}" for status, count in pillar['status_deltas'].items() if count)
+        if pillar['delta'] is None:
+            lines.append(f"- {pillar['name_ar']}: {pillar['after_score']:.0f}% (محور جديد)")
+        else:
+            lines.append(f"- {pillar['name_ar']}: من {pillar['before_score']:.0f}% إلى {pillar['after_score']:.0f}% "
+                         f"({pillar['delta']:+.0f})" + (f" [{status_moves}]" if status_moves else ""))
+    header = "\n".join(lines)
+
+    limit = max(1, (budget_tokens - estimate_tokens(header)) // _CHANGE_TOKENS)
+    selected = delta.changes[:limit]
+    rows = [
+        _Row((change.pillar.name_ar, change.sub_pillar.name_ar), change.after_status or change.before_status,
+             None, None, _clean_note((change.after or change.before).notes_ar), label=_change_label(change))
+        for change in selected
+    ]
+    # Keep each pillar / sub-pillar contiguous so its name is written once
+    order = {}
+    for row in rows:
+        order.setdefault(row.group, len(order))
+    rows.sort(key=lambda row: order[row.group])
+
+    if not rows:
+        return header
+    payload = CompactPayload(rows, {}, budget_tokens - estimate_tokens(header), show_score=False)
+    omitted = len(delta.changes) - len(selected)
+    text = f"{header}\nالعناصر المتغيرة:\n{payload.text}"
+    return text + (f"\n... و{omitted} تغييرات أخرى أقل أهمية" if omitted else "")
+
+
+def _change_label(change):
+    """before→after status, or the score movement when only the score changed"""
+    if change.before_status == change.after_status:
+        return (f"{change.after_status} {_format_score(change.before.score, None)}"
+                f"→{_format_score(change.after.score, None)}")
+    return f"{change.before_status or '-'}→{change.after_status or '-'}"
+
+
+def serialize_benchmark(benchmark, budget_tokens=None):
+    """Compact text of a portfolio benchmark for the network summary prompt.
+
+    Only aggregates: the score distribution, per-pillar statistics, the three best and
+    worst centers, then the most failing attributes (no notes) as many as fit the budget,
+    so the text has the same size however many centers the portfolio has.
+    """
+    budget_tokens = budget_tokens or PROMPT_TOKEN_BUDGETS['network']
+    summary = benchmark['summary']
+    scoreboard = benchmark['scoreboard']
+    scores = scoreboard['overall_score']
+    counts = summary['status_counts']
+    lines = [
+        f"عدد المراكز: {summary['centers']}",
+        f"المعدل الكلي: متوسط {summary['mean_score']:.1f}% - وسيط {summary['median_score']:.1f}% - "
+        f"الربع الأدنى {scores.quantile(0.25):.1f}% - الربع الأعلى {scores.quantile(0.75):.1f}% - "
+        f"أدنى {summary['min_score']:.1f}% - أعلى {summary['max_score']:.1f}%",
+        f"إجمالي العناصر: E {counts['E']} - R {counts['R']} - N {counts['N']} - NA {counts['NA']}",
+        "المحاور (متوسط | وسيط | أدنى - أعلى):",
+    ]
+    lines += [
+        f"- {pillar['pillar_ar']}: {pillar['mean']:.1f}% | {pillar['median']:.1f}% | "
+        f"{pillar['min']:.0f}% - {pillar['max']:.0f}%"
+        for pillar in benchmark['pillars'].to_dict('records')
+    ]
+    lines.append("أعلى المراكز: " + "، ".join(
+        f"{row['center']} {row['overall_score']:.1f}%" for row in scoreboard.head(3).to_dict('records')))
+    lines.append("أدنى المراكز: " + "، ".join(
+        f"{row['center']} {row['overall_score']:.1f}%" for row in scoreboard.tail(3).iloc[::-1].to_dict('records')))
+
+    failing = benchmark['failing_attributes'].to_dict('records')
+    if failing:
+        lines.append("العناصر الأكثر إخفاقاً (حرج N / يحتاج تحسين R من أصل المراكز المقيمة):")
+    for position, attribute in enumerate(failing):
+        line = (f"- [{attribute['pillar_en']}] {_truncate(attribute['description'], 120)}: "
+                f"N {attribute['N']} / R {attribute['R']} من {attribute['evaluated']} ({attribute['n_rate']:.0f}% حرج)")
+        if estimate_tokens("\n".join(lines + [line])) > budget_tokens:
+            lines.append(f"... و{len(failing) - position} عناصر أخرى")
+            break
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,216 @@
+import numpy as np
+
+from evaluation_utils import (STATUSES, AttributeRecord, Evaluation, PillarRecord, SubPillarRecord, aggregate_codes,
+                              as_evaluation, empty_status_counts)
+
+# Share of its weight an attribute scores in each status; statuses not listed score nothing
+STATUS_CREDIT = {'E': 1.0, 'R': 0.5, 'N': 0.0}
+
+
+class WhatIfSimulation:
+    """What-if scenario over an evaluation: attribute statuses, scores and weights can be changed one at a time.
+
+    The evaluation itself is never modified (compiled evaluations are shared through the
+    parse cache); the simulation keeps its own copies of the attribute columns and of the
+    per-pillar aggregates. Each change removes the attribute's old contribution from its
+    pillar and adds the new one, so the pillar score, the status counts and the overall
+    score are updated in constant time whatever the number of attributes.
+
+    A pillar's score is the sum of its applicable attribute scores, with each attribute
+    scoring its share of the pillar's weight. Changing an attribute's status or weight
+    rescores it as STATUS_CREDIT[status] × weight / the pillar's evaluated weight, unless a
+    score is given explicitly; going back to the evaluated status and weight restores the
+    reported score. The simulated pillar score is the reported one moved by the change in
+    that sum, clamped to 0–100%, and the overall score weights pillar scores by their
+    applicable attribute weight, as Evaluation does. Setting the status to NA marks the
+    attribute as not applicable; its score is kept so it comes back with another status.
+    """
+
+    def __init__(self, evaluation):
+        self.evaluation = as_evaluation(evaluation)
+        frame = self.evaluation.frame
+        self.categories = list(frame['effective_status'].cat.categories)
+        self._category_codes = {status: code for code, status in enumerate(self.categories)}
+        self._na_code = self._category_codes['NA']
+        self._load()
+
+    def _load(self):
+        """Columns and aggregates of the evaluation as evaluated, with no changes"""
+        frame = self.evaluation.frame
+        self._pillar = frame['pillar'].to_numpy(np.int64)
+        self._status = frame['effective_status'].cat.codes.to_numpy(np.int64).copy()
+        self._score = frame['score'].to_numpy(np.float64).copy()
+        self._weight = frame['weight'].to_numpy(np.float64).copy()
+        self._applicable = ~frame['na'].to_numpy()
+
+        pillar_count = len(self.evaluation.pillars)
+        self._counts, self._weights, self._score_totals, _ = aggregate_codes(
+            self._pillar, self._status, self.categories, self._applicable, self._weight, self._score, pillar_count
+        )
+        self._status_totals = self._counts.sum(axis=0)
+        self._base_pillar_scores = np.asarray([_number(pillar.score) for pillar in self.evaluation.pillars],
+                                              dtype=np.float64)
+        self._base_score_totals = self._score_totals.copy()
+        self._base_weights = self._weights.copy()
+        self._pillar_scores = self._base_pillar_scores.copy()
+        self._weighted_total = float((self._pillar_scores * self._weights).sum())
+        self._weight_total = float(self._weights.sum())
+
+        # {attribute position: its original (status code, score, weight, applicable)}
+        self._original = {}
+
+    def __len__(self):
+        return len(self._status)
+
+    # -------------------------------------------------
+    # Changes
+    # -------------------------------------------------
+    def attribute(self, index):
+        """Current (status, score, weight) of the attribute at a frame position"""
+        return self.categories[self._status[index]], float(self._score[index]), float(self._weight[index])
+
+    def set_attribute(self, index, status=None, score=None, weight=None):
+        """Change one attribute; arguments left as None keep their current value.
+
+        A new status or weight without a score rescores the attribute from its status (see
+        the class docstring).
+        """
+        status_code, new_score, new_weight, applicable = self._state(index)
+        if status is not None:
+            status_code = self._category_codes.get(status)
+            if status_code is None:
+                raise ValueError(f"Unknown status: {status}")
+            applicable = status_code != self._na_code
+        if weight is not None:
+            new_weight = float(weight)
+        if score is not None:
+            new_score = float(score)
+        elif (status is not None or weight is not None) and applicable:
+            new_score = self._status_score(index, status_code, new_weight)
+        self._apply(index, (status_code, new_score, new_weight, applicable))
+
+    def _status_score(self, index, status_code, weight):
+        """Score of an attribute from its status and weight; the evaluated score if neither changed"""
+        original = self._original.get(index, self._state(index))
+        if (status_code, weight) == (original[0], original[2]) and original[3]:
+            return original[1]
+        pillar_weight = self._base_weights[self._pillar[index]] or 1.0
+        return STATUS_CREDIT.get(self.categories[status_code], 0.0) * weight / pillar_weight
+
+    def revert(self, index):
+        """Put one attribute back to its evaluated values"""
+        original = self._original.get(index)
+        if original is not None:
+            self._apply(index, original)
+
+    def reset(self):
+        """Undo every change; aggregates are reloaded rather than reverted, so no rounding error is left"""
+        self._load()
+
+    def _apply(self, index, new_state):
+        state = self._state(index)
+        if new_state == state:
+            return
+        self._original.setdefault(index, state)
+        if self._original[index] == new_state:
+            del self._original[index]
+
+        pillar = self._pillar[index]
+        old_score, old_weight = self._pillar_scores[pillar], self._weights[pillar]
+        self._contribute(index, -1)
+        self._status[index], self._score[index], self._weight[index], self._applicable[index] = new_state
+        self._contribute(index, 1)
+
+        self._pillar_scores[pillar] = min(1.0, max(0.0, self._base_pillar_scores[pillar]
+                                                   + self._score_totals[pillar] - self._base_score_totals[pillar]))
+        self._weighted_total += self._pillar_scores[pillar] * self._weights[pillar] - old_score * old_weight
+        self._weight_total += self._weights[pillar] - old_weight
+
+    def _state(self, index):
+        return (int(self._status[index]), float(self._score[index]), float(self._weight[index]),
+                bool(self._applicable[index]))
+
+    def _contribute(self, index, sign):
+        """Add (sign=1) or remove (sign=-1) one attribute from its pillar's aggregates"""
+        pillar = self._pillar[index]
+        status = self._status[index]
+        self._counts[pillar, status] += sign
+        self._status_totals[status] += sign
+        if self._applicable[index]:
+            self._weights[pillar] += sign * self._weight[index]
+            self._score_totals[pillar] += sign * self._score[index]
+
+    # -------------------------------------------------
+    # Aggregates
+    # -------------------------------------------------
+    @property
+    def changes(self):
+        """Frame positions of the attributes that differ from the evaluation"""
+        return sorted(self._original)
+
+    @property
+    def overall_score(self):
+        return self._weighted_total / self._weight_total * 100 if self._weight_total > 0 else 0
+
+    @property
+    def status_counts(self):
+        return _status_counts(self.categories, self._status_totals)
+
+    def pillar_score(self, position):
+        """Simulated pillar score as a percentage"""
+        return float(self._pillar_scores[position]) * 100
+
+    def pillar_status_counts(self, position):
+        return _status_counts(self.categories, self._counts[position])
+
+    def pillar_weight(self, position):
+        return float(self._weights[position])
+
+    def to_evaluation(self):
+        """A new Evaluation with the simulated values, e.g. to compare with the original or to prompt on.
+
+        Unchanged attribute records are shared with the original evaluation; pillars and
+        sub-pillars are new records, since Evaluation fills in their aggregates.
+        """
+        position = 0
+        pillars = []
+        for pillar_position, pillar in enumerate(self.evaluation.pillars):
+            changed = False
+            sub_pillars = []
+            for sub_pillar in pillar.sub_pillars:
+                attributes = []
+                for attribute in sub_pillar.attributes:
+                    if position in self._original:
+                        changed = True
+                        status, score, weight = self.attribute(position)
+                        attribute = AttributeRecord({
+                            'attribute_en': attribute.description,
+                            'status': status,
+                            'score': score if self._applicable[position] else '-',
+                            'weight': weight,
+                            'notes_ar': attribute.notes_ar,
+                            'report_notes_ar': attribute.report_notes_ar,
+                        })
+                    attributes.append(attribute)
+                    position += 1
+                sub_pillars.append(SubPillarRecord({'sub_pillar_en': sub_pillar.name_en,
+                                                    'sub_pillar_ar': sub_pillar.name_ar}, attributes=attributes))
+            score = float(self._pillar_scores[pillar_position]) if changed else pillar.score
+            pillars.append(PillarRecord({'pillar_en': pillar.name_en, 'pillar_ar': pillar.name_ar, 'pillar_score': score},
+                                        sub_pillars=sub_pillars))
+        return Evaluation(pillars)
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _status_counts(categories, totals):
+    counts = empty_status_counts()
+    for status, count in zip(categories, totals.tolist()):
+        if count or status in STATUSES:
+            counts[status] = int(count)
+    return counts
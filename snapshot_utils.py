@@ -0,0 +1,304 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from evaluation_utils import (Evaluation, PillarRecord, SubPillarRecord, aggregate_codes, empty_status_counts,
+                              overall_score)
+
+
+# Version 3 records the source format; older snapshots do not say whether they came from JSON or NDJSON
+SNAPSHOT_VERSION = 3
+
+# String columns of each table; they are dictionary-encoded (int32 codes + distinct values)
+_STRING_COLUMNS = {
+    'pillars': ('name_en', 'name_ar'),
+    'sub_pillars': ('name_en', 'name_ar'),
+    'attributes': ('description', 'notes_ar', 'report_notes_ar'),
+}
+
+
+def _encode_strings(values):
+    """Dictionary-encode a string column: (int32 codes, distinct values); None is stored as -1"""
+    index = {}
+    codes = np.fromiter(
+        (-1 if value is None else index.setdefault(value, len(index)) for value in values),
+        dtype=np.int32, count=len(values)
+    )
+    return codes, list(index)
+
+
+def _plain_number(value):
+    """Scores and weights are stored as float64; integral values go back to int as they came from JSON"""
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def write_snapshot(evaluation, directory, center=None, visit_date=None, source_format='json'):
+    """Write an evaluation as a columnar snapshot: one .npy file per column plus meta.json.
+
+    Tables are pillars, sub_pillars and attributes, linked by integer positions. String
+    columns are dictionary-encoded so every .npy file can be memory-mapped on reload.
+    """
+    pillars = evaluation.pillars
+    sub_pillars = [sub_pillar for pillar in pillars for sub_pillar in pillar.sub_pillars]
+    attributes = [attribute for sub_pillar in sub_pillars for attribute in sub_pillar.attributes]
+    frame = evaluation.frame
+
+    tables = {
+        'pillars': {
+            'score': np.asarray([float(pillar.score) for pillar in pillars], dtype=np.float64),
+            'name_en': [pillar.name_en for pillar in pillars],
+            'name_ar': [pillar.name_ar for pillar in pillars],
+        },
+        'sub_pillars': {
+            'pillar': np.asarray([position for position, pillar in enumerate(pillars)
+                                  for _ in pillar.sub_pillars], dtype=np.int32),
+            'name_en': [sub_pillar.name_en for sub_pillar in sub_pillars],
+            'name_ar': [sub_pillar.name_ar for sub_pillar in sub_pillars],
+        },
+        'attributes': {
+            'pillar': frame['pillar'].to_numpy(np.int32),
+            'sub_pillar': frame['sub_pillar'].to_numpy(np.int32),
+            'status': frame['status'].cat.codes.to_numpy(np.int8),
+            'score': frame['score'].to_numpy(np.float64),
+            'weight': frame['weight'].to_numpy(np.float64),
+            'na': frame['na'].to_numpy(bool),
+            'description': [attribute.description for attribute in attributes],
+            'notes_ar': [attribute.notes_ar for attribute in attributes],
+            'report_notes_ar': [attribute.report_notes_ar for attribute in attributes],
+        },
+    }
+
+    os.makedirs(directory, exist_ok=True)
+    for table, columns in tables.items():
+        for name, values in columns.items():
+            if name in _STRING_COLUMNS[table]:
+                values, strings = _encode_strings(values)
+                with open(os.path.join(directory, f"{table}.{name}.strings.json"), 'w', encoding='utf-8') as file:
+                    json.dump(strings, file, ensure_ascii=False)
+            np.save(os.path.join(directory, f"{table}.{name}.npy"), values)
+
+    meta = {
+        'version': SNAPSHOT_VERSION,
+        'content_hash': evaluation.content_hash,
+        'source_format': source_format,
+        'center': center,
+        'visit_date': visit_date,
+        'created_at': time.time(),
+        'rows': {table: len(next(iter(columns.values()))) for table, columns in tables.items()},
+        'status_categories': [str(category) for category in frame['status'].cat.categories],
+    }
+    with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as file:
+        json.dump(meta, file, ensure_ascii=False)
+
+
+class Snapshot:
+    """A columnar evaluation snapshot on disk; columns are memory-mapped on first use.
+
+    overall_score, status_counts and pillars (names, scores and aggregates, without
+    sub-pillars) are computed straight from the mapped arrays, reading only the columns
+    they need. to_evaluation() rebuilds the full Evaluation when names and notes are needed.
+    """
+
+    def __init__(self, directory, meta=None):
+        self.directory = directory
+        if meta is None:
+            with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as file:
+                meta = json.load(file)
+        self.meta = meta
+        self.content_hash = meta.get('content_hash')
+        self.center = meta.get('center')
+        self.visit_date = meta.get('visit_date')
+        self._columns = {}
+        self._aggregates = None
+        self._evaluation = None
+
+    # Only the path and metadata travel between processes; columns are re-mapped on use
+    def __getstate__(self):
+        return (self.directory, self.meta)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def column(self, table, name):
+        """Column as a read-only array, memory-mapped without copying; string columns are decoded to lists"""
+        key = (table, name)
+        if key not in self._columns:
+            path = os.path.join(self.directory, f"{table}.{name}.npy")
+            try:
+                values = np.load(path, mmap_mode='r')
+            except ValueError:
+                # Empty arrays cannot be mapped
+                values = np.load(path)
+            if name in _STRING_COLUMNS[table]:
+                with open(os.path.join(self.directory, f"{table}.{name}.strings.json"), encoding='utf-8') as file:
+                    strings = json.load(file)
+                values = [strings[code] if code >= 0 else None for code in values.tolist()]
+            self._columns[key] = values
+        return self._columns[key]
+
+    def _aggregate(self):
+        if self._aggregates is None:
+            categories = self.meta['status_categories']
+            na = self.column('attributes', 'na')
+            effective = np.where(na, categories.index('NA'), self.column('attributes', 'status'))
+            counts, weights, _, _ = aggregate_codes(
+                self.column('attributes', 'pillar'), effective, categories, ~na,
+                self.column('attributes', 'weight'), self.column('attributes', 'score'),
+                self.meta['rows']['pillars']
+            )
+            status_counts = empty_status_counts()
+            status_counts.update(zip(categories, counts.sum(axis=0).tolist()))
+            pillar_status_counts = [dict(zip(categories, row)) for row in counts.tolist()]
+            self._aggregates = (status_counts, pillar_status_counts, weights)
+        return self._aggregates
+
+    @property
+    def status_counts(self):
+        return self._aggregate()[0]
+
+    @property
+    def overall_score(self):
+        return overall_score(self.column('pillars', 'score'), self._aggregate()[2])
+
+    @property
+    def pillars(self):
+        """PillarRecords with names, score and aggregates only (no sub-pillars)"""
+        _, pillar_status_counts, weights = self._aggregate()
+        pillars = []
+        for position, (name_en, name_ar, score) in enumerate(zip(
+                self.column('pillars', 'name_en'), self.column('pillars', 'name_ar'),
+                self.column('pillars', 'score').tolist())):
+            pillar = PillarRecord({'pillar_en': name_en, 'pillar_ar': name_ar, 'pillar_score': _plain_number(score)},
+                                  sub_pillars=[])
+            pillar.status_counts.update(pillar_status_counts[position])
+            pillar.weight = float(weights[position])
+            pillars.append(pillar)
+        return pillars
+
+    def attribute_columns(self):
+        """Evaluation.attribute_columns() from the mapped columns, without rebuilding the evaluation"""
+        categories = self.meta['status_categories']
+        na = self.column('attributes', 'na')
+        return {
+            'pillar': self.column('attributes', 'pillar'),
+            'status': np.where(na, categories.index('NA'), self.column('attributes', 'status')),
+            'categories': categories,
+            'applicable': ~na,
+            'score': self.column('attributes', 'score'),
+            'weight': self.column('attributes', 'weight'),
+            'description': self.column('attributes', 'description'),
+            'pillar_en': self.column('pillars', 'name_en'),
+        }
+
+    def to_evaluation(self):
+        """Rebuild the full Evaluation (reads every column)"""
+        if self._evaluation is not None:
+            return self._evaluation
+
+        categories = self.meta['status_categories']
+        attribute_rows = zip(
+            self.column('attributes', 'sub_pillar').tolist(),
+            self.column('attributes', 'description'),
+            self.column('attributes', 'status').tolist(),
+            self.column('attributes', 'score').tolist(),
+            self.column('attributes', 'weight').tolist(),
+            self.column('attributes', 'na').tolist(),
+            self.column('attributes', 'notes_ar'),
+            self.column('attributes', 'report_notes_ar'),
+        )
+        attributes = [[] for _ in range(self.meta['rows']['sub_pillars'])]
+        for sub_pillar, description, status, score, weight, na, notes_ar, report_notes_ar in attribute_rows:
+            attributes[sub_pillar].append({
+                'attribute_en': description,
+                'status': categories[status],
+                'score': '-' if na else _plain_number(score),
+                'weight': _plain_number(weight),
+                'notes_ar': notes_ar,
+                'report_notes_ar': report_notes_ar,
+            })
+
+        sub_pillars = [[] for _ in range(self.meta['rows']['pillars'])]
+        for position, (pillar, name_en, name_ar) in enumerate(zip(
+                self.column('sub_pillars', 'pillar').tolist(),
+                self.column('sub_pillars', 'name_en'), self.column('sub_pillars', 'name_ar'))):
+            sub_pillars[pillar].append(SubPillarRecord({'sub_pillar_en': name_en, 'sub_pillar_ar': name_ar,
+                                                        'attributes': attributes[position]}))
+
+        pillars = [
+            PillarRecord({'pillar_en': name_en, 'pillar_ar': name_ar, 'pillar_score': _plain_number(score)},
+                         sub_pillars=sub_pillars[position])
+            for position, (name_en, name_ar, score) in enumerate(zip(
+                self.column('pillars', 'name_en'), self.column('pillars', 'name_ar'),
+                self.column('pillars', 'score').tolist()))
+        ]
+        self._evaluation = Evaluation(pillars)
+        self._evaluation.content_hash = self.content_hash
+        self._evaluation.center = self.center
+        self._evaluation.visit_date = self.visit_date
+        return self._evaluation
+
+
+class SnapshotStore:
+    """Directory of snapshots, one sub-directory per content hash and source format (SNAPSHOT_DIR, default .cache/snapshots).
+
+    The same bytes compile differently as JSON and as NDJSON, so the format is part of
+    the key as it is in the parse cache.
+    """
+
+    def __init__(self, root=None):
+        self.root = root or os.getenv('SNAPSHOT_DIR', '.cache/snapshots')
+
+    @classmethod
+    def from_env(cls):
+        """The configured store, or None when SNAPSHOT_DIR is set to an empty value"""
+        root = os.getenv('SNAPSHOT_DIR', '.cache/snapshots')
+        return cls(root) if root else None
+
+    def path(self, digest, source_format='json'):
+        return os.path.join(self.root, f"{digest}.{source_format}")
+
+    def get(self, digest, source_format='json'):
+        """The snapshot for a content hash, or None if it is missing, unreadable, from an older version or another format"""
+        try:
+            snapshot = Snapshot(self.path(digest, source_format))
+        except (OSError, ValueError):
+            return None
+        if snapshot.meta.get('version') != SNAPSHOT_VERSION or snapshot.meta.get('source_format') != source_format:
+            return None
+        return snapshot
+
+    def put(self, digest, evaluation, center=None, visit_date=None, source_format='json'):
+        """Write the snapshot of an evaluation unless a current one exists; returns the stored snapshot.
+
+        Snapshots are content-addressed, so an existing one is never rewritten: other sessions
+        may have its columns memory-mapped. A new snapshot is written to a temporary directory
+        and renamed into place; an outdated one is first renamed aside and only removed after
+        the swap. A snapshot that cannot be written (read-only disk, concurrent writer) is skipped.
+        """
+        existing = self.get(digest, source_format)
+        if existing is not None:
+            return existing
+        temp_directory = None
+        old_directory = None
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            temp_directory = tempfile.mkdtemp(prefix='.tmp-', dir=self.root)
+            write_snapshot(evaluation, temp_directory, center, visit_date, source_format)
+            target = self.path(digest, source_format)
+            if os.path.exists(target):
+                old_directory = tempfile.mkdtemp(prefix='.old-', dir=self.root)
+                os.replace(target, old_directory)
+            os.replace(temp_directory, target)
+            temp_directory = None
+        except OSError:
+            pass
+        finally:
+            for directory in (temp_directory, old_directory):
+                if directory:
+                    shutil.rmtree(directory, ignore_errors=True)
+        return self.get(digest, source_format)
@@ -13,6 +13,13 @@ import os
 from datetime import datetime
 import re
 import sys
+import queue
+import functools
+import hashlib
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Try to import toml for direct secrets file reading
 try:
@@ -23,6 +30,18 @@ except ImportError:
 # Add current directory to path for local imports
 sys.path.append(os.path.dirname(__file__))
 
+from evaluation_utils import STATUSES, as_evaluation, benchmark_portfolio, compare_evaluations, portfolio_hash
+from history_utils import VisitStore
+from ingest_utils import (LoadedVisit, ParseCache, SchemaValidationError, create_parse_pool, is_ndjson, load_visits,
+                          read_directory_sources, read_ndjson_sources, read_zip_sources)
+from llm_utils import (PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, CallRecord, FakeBackend, GeminiBackend, LLMTelemetry,
+                       ModelResolver, RateLimiter, ResponseCache, SingleFlight)
+from prompt_utils import (PROMPT_TOKEN_BUDGETS, estimate_tokens, serialize_findings,
+                          select_findings, serialize_benchmark, serialize_delta, serialize_pillar_detail,
+                          serialize_pillars, serialize_sub_pillar)
+from simulation_utils import WhatIfSimulation
+from snapshot_utils import SnapshotStore
+
 # Load environment variables
 load_dotenv()
 
@@ -203,24 +222,50 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Gemini models to try, in order of preference
+GEMINI_MODEL_NAMES = [
+    'gemini-2.5-flash',
+    'models/gemini-2.5-flash',
+    'gemini-1.5-flash',
+    'gemini-1.5-flash-latest',
+    'gemini-pro',
+    'gemini-1.0-pro'
+]
+
 def load_api_key_from_secrets_file():
     """Fallback method to read secrets file directly"""
     secrets_path = ".streamlit/secrets.toml"
     if os.path.exists(secrets_path) and toml:
-        try:
-            with open(secrets_path, 'r') as f:
-                secrets = toml.load(f)
-                # Try direct key first
-                if 'GEMINI_API_KEY' in secrets:
-                    return secrets['GEMINI_API_KEY']
-                # Fallback to section-based key
-                elif 'gemini' in secrets and 'api_key' in secrets['gemini']:
-                    return secrets['gemini']['api_key']
-                return None
-        except Exception:
-            return None
+        # Re-parse only when the file changes
+        return _read_api_key_from_secrets_file(secrets_path, os.path.getmtime(secrets_path))
     return None
 
+@functools.lru_cache(maxsize=4)
+def _read_api_key_from_secrets_file(secrets_path, mtime):
+    """Parse the secrets file for the Gemini API key (memoized per file modification time)"""
+    try:
+        with open(secrets_path, 'r') as f:
+            secrets = toml.load(f)
+            # Try direct key first
+            if 'GEMINI_API_KEY' in secrets:
+                return secrets['GEMINI_API_KEY']
+            # Fallback to section-based key
+            elif 'gemini' in secrets and 'api_key' in secrets['gemini']:
+                return secrets['gemini']['api_key']
+            return None
+    except Exception:
+        return None
+
+@st.cache_resource
+def get_rate_limiter():
+    """Process-wide rate limiter that every Gemini call goes through"""
+    return RateLimiter()
+
+@st.cache_resource
+def get_model_resolver(api_key):
+    """Process-wide model resolver for an API key"""
+    return ModelResolver(api_key, GEMINI_MODEL_NAMES, rate_limiter=get_rate_limiter())
+
 def setup_gemini_api():
     """Setup Gemini API with key from Streamlit secrets, environment, or user input"""
     api_key = None
@@ -310,32 +355,21 @@ def setup_gemini_api():
         st.stop()  # Stop execution instead of asking for manual input
     
     try:
-        genai.configure(api_key=api_key)
-        
-        # Try different model names in order of preference
-        model_names = [
-            'gemini-2.5-flash',
-            'models/gemini-2.5-flash',
-            'gemini-1.5-flash',
-            'gemini-1.5-flash-latest',
-            'gemini-pro',
-            'gemini-1.0-pro'
-        ]
-        
-        for model_name in model_names:
+        # Resolved and health-probed once per process; later reruns reuse the model
+        resolver = get_model_resolver(api_key)
+        failures = resolver.failures
+        if resolver.get_model():
+            return GeminiBackend(resolver)
+        
+        # If all models failed in this run's probe round, list available models; while the
+        # resolver waits before probing again, reruns do not call the API at all
+        if resolver.failures != failures:
             try:
-                model = genai.GenerativeModel(model_name)
-                return model
-            except Exception as model_error:
-                continue
-        
-        # If all models fail, list available models
-        try:
-            available_models = genai.list_models()
-            model_list = [m.name for m in available_models if 'generateContent' in m.supported_generation_methods]
-            st.sidebar.error(f"النماذج المتاحة: {model_list}")
-        except:
-            pass
+                available_models = genai.list_models()
+                model_list = [m.name for m in available_models if 'generateContent' in m.supported_generation_methods]
+                st.sidebar.error(f"النماذج المتاحة: {model_list}")
+            except:
+                pass
             
         st.error("فشل في تحميل أي نموذج من نماذج Gemini")
         return None
@@ -344,6 +378,100 @@ def setup_gemini_api():
         st.error(f"خطأ في إعداد Gemini API: {str(e)}")
         return None
 
+def setup_llm_backend():
+    """Select the LLM backend: Gemini by default, or the offline fake with LLM_BACKEND=fake"""
+    if os.getenv('LLM_BACKEND', 'gemini').strip().lower() == 'fake':
+        return FakeBackend()
+    return setup_gemini_api()
+
+@st.cache_resource
+def get_response_cache():
+    """Process-wide on-disk cache of Gemini responses, shared across sessions"""
+    return ResponseCache()
+
+@st.cache_resource
+def get_single_flight():
+    """Process-wide coalescing of identical in-flight prompts across sessions"""
+    return SingleFlight()
+
+@st.cache_resource
+def get_llm_telemetry():
+    """Process-wide per-call LLM telemetry (JSONL log + in-memory percentiles)"""
+    return LLMTelemetry()
+
+def generate_text(model, prompt, force_regenerate=False, on_chunk=None, generation_config=None,
+                  priority=PRIORITY_INTERACTIVE, section=None):
+    """Generate text for a prompt, serving repeat prompts from the response cache.
+    
+    Uncached calls go through the shared rate limiter, and identical prompts already
+    in flight in another session are awaited instead of re-sent. When on_chunk is given
+    the response is streamed and on_chunk receives the accumulated text after every chunk.
+    Every call is recorded in the LLM telemetry under `section`.
+    """
+    cache = get_response_cache()
+    slots = get_call_slots()
+    model_name = model.model_name
+    key = cache.make_key(model_name, prompt, [model.generation_config, generation_config])
+    
+    record = CallRecord(section or 'other', model_name)
+    started = time.perf_counter()
+    try:
+        if not force_regenerate:
+            cached = cache.get(key)
+            if cached:
+                record.cache_hit = True
+                if on_chunk:
+                    on_chunk(cached)
+                return cached
+        
+        # Only the session that actually calls the backend runs generate(); others wait on it
+        record.coalesced = True
+        
+        def generate(publish):
+            record.coalesced = False
+            usage = {}
+            # Budget the prompt plus a typical section-length response against tokens/min
+            with slots:
+                text = get_rate_limiter().call(
+                    lambda: _generate_uncached(model, prompt, publish if on_chunk else None, generation_config,
+                                               usage, record, started),
+                    tokens=estimate_tokens(prompt) + 1000,
+                    priority=priority,
+                    on_retry=lambda error: setattr(record, 'retries', record.retries + 1)
+                )
+            record.prompt_tokens = usage.get('prompt_tokens')
+            record.response_tokens = usage.get('response_tokens')
+            if text:
+                cache.set(key, model_name, text)
+            return text
+        
+        return get_single_flight().do(key, generate, on_partial=on_chunk) or None
+    except Exception as e:
+        record.error = str(e)
+        raise
+    finally:
+        record.latency_seconds = time.perf_counter() - started
+        # Estimate only for calls that reached the model without reporting usage
+        if record.prompt_tokens is None and not record.cache_hit and not record.coalesced:
+            record.prompt_tokens = estimate_tokens(prompt)
+        get_llm_telemetry().record(record)
+
+def _generate_uncached(model, prompt, on_chunk=None, generation_config=None, usage=None, record=None, started=None):
+    """Call the backend directly, streaming into on_chunk when given"""
+    if not on_chunk:
+        text = model.generate(prompt, generation_config, usage)
+        if record:
+            record.ttfb_seconds = time.perf_counter() - started
+        return text
+    
+    text = ""
+    for chunk_text in model.stream(prompt, generation_config, usage):
+        if record and not text:
+            record.ttfb_seconds = time.perf_counter() - started
+        text += chunk_text
+        on_chunk(text)
+    return text
+
 def clean_and_format_text(text):
     """Clean asterisk formatting, hashtags, and convert to proper HTML"""
     if not text:
@@ -392,168 +520,193 @@ def clean_and_format_text(text):
     
     return '\n'.join(formatted_lines)
 
-def load_data(file_path):
-    """Load JSON data from file"""
+class StreamingTextFormatter:
+    """Format streamed text incrementally: finished paragraphs are formatted only once"""
+    
+    def __init__(self):
+        self._formatted_until = 0
+        self._html_parts = []
+    
+    def update(self, text):
+        # Paragraphs separated by a blank line format independently of each other
+        boundary = text.rfind('\n\n')
+        if boundary > self._formatted_until:
+            self._html_parts.append(clean_and_format_text(text[self._formatted_until:boundary]))
+            self._formatted_until = boundary + 2
+        
+        tail = clean_and_format_text(text[self._formatted_until:])
+        return '\n<br>\n'.join(self._html_parts + ([tail] if tail else []))
+
+@st.cache_resource
+def get_snapshot_store():
+    """On-disk columnar snapshots of ingested evaluations (None when SNAPSHOT_DIR is empty)"""
+    return SnapshotStore.from_env()
+
+@st.cache_resource
+def get_visit_store():
+    """Historical visit store shared across sessions (None when VISIT_STORE_PATH is empty)"""
+    return VisitStore.from_env()
+
+@st.cache_resource
+def get_parse_pool():
+    """Worker processes for multi-center ingestion, started once and shared across sessions (None for in-process)"""
+    return create_parse_pool()
+
+@st.cache_resource
+def get_parse_cache():
+    """Process-wide LRU of compiled evaluations keyed by file content, shared across sessions"""
+    return ParseCache(snapshots=get_snapshot_store())
+
+def load_data(file_path, on_progress=None):
+    """Load an evaluation file, compiling it while it is streamed in (unchanged files come from the parse cache)"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            data = json.load(file)
-        return data
+        return get_parse_cache().load_file(file_path, on_progress)
     except Exception as e:
-        st.error(f"خطأ في تحميل البيانات: {str(e)}")
+        report_load_error(e, "خطأ في تحميل البيانات")
         return None
 
-def calculate_overall_score(data):
-    """Calculate overall score based on pillar scores and weights"""
-    total_score = 0
-    total_weight = 0
+def report_load_error(error, title):
+    """Show why a file was rejected; schema errors are listed in full with their JSON paths"""
+    if isinstance(error, SchemaValidationError):
+        st.error(f"{title}: تم رفض الملف قبل التحليل ({len(error.errors)} خطأ في بنية البيانات)")
+        with st.expander("تفاصيل الأخطاء"):
+            st.dataframe(pd.DataFrame(error.errors, columns=["المسار", "الخطأ"]),
+                         hide_index=True, use_container_width=True)
+    else:
+        st.error(f"{title}: {str(error)}")
+
+def progress_callback(progress_bar, label):
+    """on_progress(done, total) that updates a st.progress bar once per whole percent"""
+    last_percent = [-1]
     
-    for pillar in data:
-        pillar_score = pillar.get('pillar_score', 0)
-        # Calculate pillar weight based on number of attributes
-        pillar_weight = 0
-        for sub_pillar in pillar.get('sub_pillars', []):
-            for attribute in sub_pillar.get('attributes', []):
-                if attribute.get('score') != '-':  # Exclude N/A items
-                    pillar_weight += attribute.get('weight', 1)
-        
-        total_score += pillar_score * pillar_weight
-        total_weight += pillar_weight
+    def on_progress(done, total):
+        if not total:
+            return
+        percent = min(100, int(done * 100 / total))
+        if percent != last_percent[0]:
+            last_percent[0] = percent
+            progress_bar.progress(percent / 100, text=f"{label} {percent}%")
     
-    return (total_score / total_weight * 100) if total_weight > 0 else 0
+    return on_progress
+
+def calculate_overall_score(data):
+    """Calculate overall score based on pillar scores and weights"""
+    return as_evaluation(data).overall_score
 
 def analyze_performance_by_status(data):
     """Analyze performance by status (E, R, N)"""
-    status_counts = {'E': 0, 'R': 0, 'N': 0, 'NA': 0}
-    status_scores = {'E': [], 'R': [], 'N': [], 'NA': []}
-    
-    for pillar in data:
-        for sub_pillar in pillar.get('sub_pillars', []):
-            for attribute in sub_pillar.get('attributes', []):
-                status = attribute.get('status', 'N')
-                score = attribute.get('score', 0)
-                
-                if score == '-':
-                    status_counts['NA'] += 1
-                else:
-                    status_counts[status] += 1
-                    status_scores[status].append(float(score))
-    
-    return status_counts, status_scores
+    evaluation = as_evaluation(data)
+    return dict(evaluation.status_counts), {status: list(scores) for status, scores in evaluation.status_scores.items()}
 
 def analyze_pillar_performance(data, pillar_name_en):
     """Analyze performance for a specific pillar"""
-    pillar_data = None
-    for pillar in data:
-        if pillar.get('pillar_en') == pillar_name_en:
-            pillar_data = pillar
-            break
-    
-    if not pillar_data:
+    evaluation = as_evaluation(data)
+    pillar = evaluation.pillar(pillar_name_en)
+    if not pillar:
         return None
     
-    status_counts = {'E': 0, 'R': 0, 'N': 0, 'NA': 0}
-    sub_pillar_analysis = []
-    
-    for sub_pillar in pillar_data.get('sub_pillars', []):
-        sub_status_counts = {'E': 0, 'R': 0, 'N': 0, 'NA': 0}
-        attributes_detail = []
-        
-        for attribute in sub_pillar.get('attributes', []):
-            status = attribute.get('status', 'N')
-            score = attribute.get('score', 0)
-            
-            if score == '-':
-                status_counts['NA'] += 1
-                sub_status_counts['NA'] += 1
-            else:
-                status_counts[status] += 1
-                sub_status_counts[status] += 1
-            
-            attributes_detail.append({
-                'description': attribute.get('attribute_en', ''),
-                'status': status,
-                'score': score,
-                'notes_ar': attribute.get('notes_ar', ''),
-                'weight': attribute.get('weight', 1)
-            })
-        
-        sub_pillar_analysis.append({
-            'name_ar': sub_pillar.get('sub_pillar_ar', ''),
-            'name_en': sub_pillar.get('sub_pillar_en', ''),
-            'status_counts': sub_status_counts,
-            'attributes': attributes_detail
-        })
+    def build():
+        return {
+            'pillar_name_ar': pillar.name_ar,
+            'pillar_score': pillar.score,
+            'status_counts': dict(pillar.status_counts),
+            'sub_pillars': [
+                {
+                    'name_ar': sub_pillar.name_ar,
+                    'name_en': sub_pillar.name_en,
+                    'status_counts': dict(sub_pillar.status_counts),
+                    'dominant_status': sub_pillar.dominant_status,
+                    'attributes': [
+                        {
+                            'description': attr.description,
+                            'status': attr.status,
+                            'score': attr.score,
+                            'notes_ar': attr.notes_ar,
+                            'weight': attr.weight
+                        }
+                        for attr in sub_pillar.attributes
+                    ]
+                }
+                for sub_pillar in pillar.sub_pillars
+            ]
+        }
     
-    return {
-        'pillar_name_ar': pillar_data.get('pillar_ar', ''),
-        'pillar_score': pillar_data.get('pillar_score', 0),
-        'status_counts': status_counts,
-        'sub_pillars': sub_pillar_analysis
-    }
+    return evaluation.view(('pillar_performance', pillar_name_en), build)
 
 def prepare_data_for_gemini(data, overall_score, status_counts):
     """Prepare structured data summary for Gemini analysis"""
-    
-    # Extract key information
-    pillars_summary = []
-    detailed_findings = []
-    
-    for pillar in data:
-        pillar_name_ar = pillar.get('pillar_ar', pillar.get('pillar_en', ''))
-        pillar_name_en = pillar.get('pillar_en', '')
-        pillar_score = pillar.get('pillar_score', 0)
-        
-        pillar_info = {
-            'name_ar': pillar_name_ar,
-            'name_en': pillar_name_en,
-            'score': pillar_score,
-            'sub_pillars': []
-        }
-        
-        for sub_pillar in pillar.get('sub_pillars', []):
-            sub_pillar_name_ar = sub_pillar.get('sub_pillar_ar', sub_pillar.get('sub_pillar_en', ''))
-            sub_pillar_name_en = sub_pillar.get('sub_pillar_en', '')
+    evaluation = as_evaluation(data)
+    
+    def build():
+        pillars_summary = []
+        detailed_findings = []
+        
+        for pillar in evaluation.pillars:
+            pillar_info = {
+                'name_ar': pillar.name_ar,
+                'name_en': pillar.name_en,
+                'score': pillar.score,
+                'sub_pillars': []
+            }
             
-            attributes_summary = []
-            for attribute in sub_pillar.get('attributes', []):
-                attr_summary = {
-                    'description': attribute.get('attribute_en', ''),
-                    'status': attribute.get('status', 'N'),
-                    'score': attribute.get('score', 0),
-                    'weight': attribute.get('weight', 1),
-                    'notes_ar': attribute.get('notes_ar', ''),
-                    'report_notes_ar': attribute.get('report_notes_ar', '')
-                }
-                attributes_summary.append(attr_summary)
-                
-                # Add to detailed findings for context
-                if attribute.get('notes_ar'):
-                    detailed_findings.append({
-                        'pillar': pillar_name_ar,
-                        'sub_pillar': sub_pillar_name_ar,
-                        'status': attribute.get('status', 'N'),
-                        'notes': attribute.get('notes_ar', '')
+            for sub_pillar in pillar.sub_pillars:
+                attributes_summary = []
+                for attr in sub_pillar.attributes:
+                    attributes_summary.append({
+                        'description': attr.description,
+                        'status': attr.status,
+                        'score': attr.score,
+                        'weight': attr.weight,
+                        'notes_ar': attr.notes_ar,
+                        'report_notes_ar': attr.report_notes_ar
                     })
+                    
+                    # Add to detailed findings for context
+                    if attr.notes_ar:
+                        detailed_findings.append({
+                            'pillar': pillar.name_ar,
+                            'pillar_en': pillar.name_en,
+                            'sub_pillar': sub_pillar.name_ar,
+                            'sub_pillar_en': sub_pillar.name_en,
+                            'status': attr.status,
+                            'score': attr.score,
+                            'weight': attr.weight,
+                            'notes': attr.notes_ar
+                        })
+                
+                pillar_info['sub_pillars'].append({
+                    'name_ar': sub_pillar.name_ar,
+                    'name_en': sub_pillar.name_en,
+                    'attributes': attributes_summary
+                })
             
-            pillar_info['sub_pillars'].append({
-                'name_ar': sub_pillar_name_ar,
-                'name_en': sub_pillar_name_en,
-                'attributes': attributes_summary
-            })
-        
-        pillars_summary.append(pillar_info)
-    
-    return {
-        'overall_score': overall_score,
-        'status_counts': status_counts,
-        'pillars': pillars_summary,
-        'detailed_findings': detailed_findings
-    }
+            pillars_summary.append(pillar_info)
+        
+        return {
+            'overall_score': overall_score,
+            'status_counts': status_counts,
+            'pillars': pillars_summary,
+            'detailed_findings': detailed_findings
+        }
+    
+    key = ('data_summary', overall_score, tuple(sorted(status_counts.items())))
+    return evaluation.view(key, build)
+
+def comparison_prompt_block(data_summary):
+    """Prompt lines with the compact diff against the previous visit, when a comparison is active"""
+    if not data_summary.get('comparison'):
+        return ""
+    return f"""
+التغيرات منذ الزيارة السابقة (العناصر المتغيرة فقط):
+{data_summary['comparison']}
+اذكر في الملخص أبرز ما تراجع وما تحسن منذ الزيارة السابقة.
+"""
 
-def generate_executive_summary(model, data_summary):
-    """Generate executive summary using Gemini"""
+def build_executive_summary_prompt(data_summary):
+    """Build the executive summary prompt from the compact pillar payload"""
+    pillars_payload = serialize_pillars(data_summary['pillars'], PROMPT_TOKEN_BUDGETS['summary'])
     
-    prompt = f"""
+    return f"""
 أنت محلل خبير في تقييم مراكز الخدمة الحكومية. بناءً على البيانات التالية من تقييم مركز خدمة جمارك أبوظبي، اكتب ملخصاً تنفيذياً شاملاً باللغة العربية.
 
 البيانات:
@@ -563,8 +716,8 @@ def generate_executive_summary(model, data_summary):
 - العناصر الحرجة (N): {data_summary['status_counts']['N']} عنصر
 
 المحاور الرئيسية:
-{json.dumps(data_summary['pillars'], ensure_ascii=False, indent=2)}
-
+{pillars_payload.text}
+{comparison_prompt_block(data_summary)}
 المطلوب:
 1. اكتب ملخصاً تنفيذياً مهنياً باللغة العربية (3-4 فقرات)
 2. ركز على النقاط الإيجابية والتحديات الرئيسية
@@ -581,32 +734,48 @@ def generate_executive_summary(model, data_summary):
 - لا تستخدم تنسيق markdown مثل **نص** أو *نص*
 """
 
+def generate_executive_summary(model, data_summary, force_regenerate=False, report_error=st.error, on_chunk=None,
+                               hierarchical=False, priority=PRIORITY_INTERACTIVE):
+    """Generate executive summary using Gemini"""
+    
     try:
-        response = model.generate_content(prompt)
-        if response and hasattr(response, 'text') and response.text:
-            return response.text
+        if hierarchical:
+            pillar_analyses = run_parallel([
+                lambda pillar=pillar: reduce_pillar(model, pillar['name_ar'], pillar['score'], pillar['sub_pillars'],
+                                                    force_regenerate, priority=priority)
+                for pillar in data_summary['pillars']
+            ])
+            prompt = build_hierarchical_summary_prompt(data_summary, pillar_analyses)
         else:
-            st.error("لم يتم إنتاج أي محتوى من النموذج")
+            prompt = build_executive_summary_prompt(data_summary)
+        
+        text = generate_text(model, prompt, force_regenerate=force_regenerate, on_chunk=on_chunk, section='summary',
+                             priority=priority)
+        if text:
+            return text
+        else:
+            report_error("لم يتم إنتاج أي محتوى من النموذج")
             return None
     except Exception as e:
         error_msg = str(e)
         if "404" in error_msg:
-            st.error("النموذج المطلوب غير متاح. يرجى المحاولة مرة أخرى.")
+            report_error("النموذج المطلوب غير متاح. يرجى المحاولة مرة أخرى.")
         elif "quota" in error_msg.lower():
-            st.error("تم تجاوز حد الاستخدام المسموح. يرجى المحاولة لاحقاً.")
+            report_error("تم تجاوز حد الاستخدام المسموح. يرجى المحاولة لاحقاً.")
         elif "api_key" in error_msg.lower():
-            st.error("مشكلة في مفتاح API. يرجى التحقق من صحة المفتاح.")
+            report_error("مشكلة في مفتاح API. يرجى التحقق من صحة المفتاح.")
         else:
-            st.error(f"خطأ في توليد التحليل: {error_msg}")
+            report_error(f"خطأ في توليد التحليل: {error_msg}")
         return None
 
-def generate_pillar_analysis(model, pillar_data, pillar_name):
-    """Generate detailed analysis for a specific pillar"""
+def build_pillar_analysis_prompt(pillar_data, pillar_name):
+    """Build the pillar analysis prompt from the compact sub-pillar payload"""
     
     # Convert score to percentage
     pillar_score_percentage = pillar_data['pillar_score'] * 100
+    sub_pillars_payload = serialize_pillar_detail(pillar_data['sub_pillars'], PROMPT_TOKEN_BUDGETS['pillar'])
     
-    prompt = f"""
+    return f"""
 أنت محلل خبير في تقييم مراكز الخدمة. اكتب تحليلاً تفصيلياً لمحور "{pillar_name}" بناءً على البيانات التالية:
 
 بيانات المحور:
@@ -617,7 +786,7 @@ def generate_pillar_analysis(model, pillar_data, pillar_name):
 - العناصر الحرجة: {pillar_data['status_counts']['N']}
 
 المحاور الفرعية والتفاصيل:
-{json.dumps(pillar_data['sub_pillars'], ensure_ascii=False, indent=2)}
+{sub_pillars_payload.text}
 
 المطلوب:
 1. ابدأ بجملة تلخص الأداء العام للمحور مع ذكر النسبة المئوية الصحيحة ({pillar_score_percentage:.0f}%)
@@ -635,20 +804,29 @@ def generate_pillar_analysis(model, pillar_data, pillar_name):
 - تأكد من استخدام النسبة المئوية الصحيحة: {pillar_score_percentage:.0f}%
 """
 
+def generate_pillar_analysis(model, pillar_data, pillar_name, force_regenerate=False, report_error=st.error, on_chunk=None,
+                             section='pillar', hierarchical=False, priority=PRIORITY_INTERACTIVE):
+    """Generate detailed analysis for a specific pillar"""
+    
     try:
-        response = model.generate_content(prompt)
-        if response and hasattr(response, 'text') and response.text:
-            return response.text
-        else:
-            return None
+        if hierarchical:
+            return reduce_pillar(model, pillar_data['pillar_name_ar'], pillar_data['pillar_score'],
+                                 pillar_data['sub_pillars'], force_regenerate, on_chunk, section, priority)
+        
+        prompt = build_pillar_analysis_prompt(pillar_data, pillar_name)
+        return generate_text(model, prompt, force_regenerate=force_regenerate, on_chunk=on_chunk, section=section,
+                             priority=priority)
     except Exception as e:
-        st.error(f"خطأ في توليد تحليل المحور: {str(e)}")
+        report_error(f"خطأ في توليد تحليل المحور: {str(e)}")
         return None
 
-def generate_recommendations(model, data_summary):
-    """Generate development recommendations using Gemini"""
+def build_recommendations_prompt(data_summary):
+    """Build the recommendations prompt from the compact N/R findings payload"""
+    challenges = select_findings(data_summary['detailed_findings'], recommendation_category,
+                                 RECOMMENDATION_CATEGORIES, PROMPT_TOKEN_BUDGETS['recommendations'])
+    challenges_payload = serialize_findings(challenges, PROMPT_TOKEN_BUDGETS['recommendations'])
     
-    prompt = f"""
+    return f"""
 بناءً على تقييم مركز خدمة جمارك أبوظبي، قدم مقترحات تطويرية محددة وقابلة للتطبيق مقسمة حسب المجالات.
 
 البيانات:
@@ -657,7 +835,7 @@ def generate_recommendations(model, data_summary):
 - العناصر التي تحتاج تحسين: {data_summary['status_counts']['R']} عنصر
 
 التحديات الرئيسية:
-{json.dumps([f for f in data_summary['detailed_findings'] if f['status'] in ['N', 'R']][:10], ensure_ascii=False, indent=2)}
+{challenges_payload.text}
 
 المطلوب تقسيم المقترحات إلى 5 مجالات رئيسية:
 
@@ -689,15 +867,535 @@ def generate_recommendations(model, data_summary):
 - اكتب كل مقترح في جملة واضحة ومحددة
 """
 
+def generate_recommendations(model, data_summary, force_regenerate=False, report_error=st.error, on_chunk=None,
+                             priority=PRIORITY_INTERACTIVE):
+    """Generate development recommendations using Gemini"""
+    
+    prompt = build_recommendations_prompt(data_summary)
+
     try:
-        response = model.generate_content(prompt)
-        if response and hasattr(response, 'text') and response.text:
-            return response.text
-        else:
-            return None
+        return generate_text(model, prompt, force_regenerate=force_regenerate, on_chunk=on_chunk, section='recommendations',
+                             priority=priority)
     except Exception as e:
-        st.error(f"خطأ في توليد التوصيات: {str(e)}")
+        report_error(f"خطأ في توليد التوصيات: {str(e)}")
+        return None
+
+# Recommendation areas, in the order they appear in the tab, flowchart and DOCX
+RECOMMENDATION_CATEGORIES = [
+    "البيئة العامة",
+    "مواقف السيارات",
+    "المبنى",
+    "القدرة الاستيعابية والانتظار",
+    "سهولة الوصول إلى الموقع"
+]
+
+# Keywords of English sub-pillar names that place a finding in a recommendation area, checked in order
+RECOMMENDATION_CATEGORY_KEYWORDS = [
+    ("مواقف السيارات", ("parking",)),
+    ("القدرة الاستيعابية والانتظار", ("seating", "waiting", "queue", "capacity")),
+    ("المبنى", ("maint", "building", "physical", "facilit")),
+    ("سهولة الوصول إلى الموقع", ("navigation", "location", "signage", "access")),
+    ("البيئة العامة", ("ambience", "cleanliness", "lighting", "environment"))
+]
+
+def recommendation_category(finding):
+    """Recommendation area a finding belongs to, from its sub-pillar (falling back to its pillar)"""
+    sub_pillar = (finding.get('sub_pillar_en') or "").lower()
+    for category, keywords in RECOMMENDATION_CATEGORY_KEYWORDS:
+        if any(keyword in sub_pillar for keyword in keywords):
+            return category
+    if finding.get('pillar_en') == "Accessibility":
+        return "سهولة الوصول إلى الموقع"
+    return "البيئة العامة"
+
+# Pillar sections: section key -> (pillar_en in the data, Arabic pillar name)
+PILLAR_SECTIONS = {
+    'accessibility': ("Accessibility", "سهولة الوصول"),
+    'appearance': ("Appearance", "المظهر العام")
+}
+
+def build_one_shot_prompt(data_summary, pillar_data_by_section):
+    """Build a single prompt that asks for every report section as one JSON object"""
+    pillars_payload = serialize_pillars(data_summary['pillars'], PROMPT_TOKEN_BUDGETS['one_shot'])
+    challenges = select_findings(data_summary['detailed_findings'], recommendation_category,
+                                 RECOMMENDATION_CATEGORIES, PROMPT_TOKEN_BUDGETS['recommendations'])
+    challenges_payload = serialize_findings(challenges, PROMPT_TOKEN_BUDGETS['recommendations'])
+    
+    pillar_lines = "\n".join(
+        f"- {PILLAR_SECTIONS[section][0]}: {pillar_data['pillar_name_ar']} ({pillar_data['pillar_score'] * 100:.0f}%)"
+        for section, pillar_data in pillar_data_by_section.items() if pillar_data
+    )
+    categories = "، ".join(f'"{category}"' for category in RECOMMENDATION_CATEGORIES)
+    
+    return f"""
+أنت محلل خبير في تقييم مراكز الخدمة الحكومية. بناءً على البيانات التالية من تقييم مركز خدمة جمارك أبوظبي، أعد التقرير كاملاً باللغة العربية في صورة كائن JSON واحد.
+
+البيانات:
+- المعدل الكلي للأداء: {data_summary['overall_score']:.1f}%
+- العناصر المتميزة (E): {data_summary['status_counts']['E']} عنصر
+- العناصر التي تحتاج تحسين (R): {data_summary['status_counts']['R']} عنصر
+- العناصر الحرجة (N): {data_summary['status_counts']['N']} عنصر
+
+المحاور الرئيسية:
+{pillars_payload.text}
+
+التحديات الرئيسية:
+{challenges_payload.text}
+{comparison_prompt_block(data_summary)}
+المطلوب (مفاتيح كائن JSON):
+1. "executive_summary": ملخص تنفيذي مهني (3-4 فقرات) يبدأ بالضبط بهذا النص: "أظهرت نتائج زيارة المتسوق السري أن"، نص متدفق ومترابط دون عناوين أو نقاط، يركز على النقاط الإيجابية والتحديات الرئيسية ويذكر الأرقام والنسب المئوية بشكل طبيعي
+2. "pillar_analyses": كائن مفاتيحه أسماء المحاور التالية بالإنجليزية، وقيمة كل مفتاح تحليل تفصيلي للمحور:
+{pillar_lines}
+   يبدأ التحليل بجملة تلخص أداء المحور مع ذكر نسبته المئوية المذكورة أعلاه، ثم فقرة تحليلية (150-200 كلمة) عن النقاط الإيجابية والتحديات وتأثيرها على تجربة المتعاملين، ويختتم بجملة تلخص النتيجة العامة للمحور (مرتفع/منخفض/متوسط)
+3. "recommendations": كائن مفاتيحه المجالات التالية بالضبط: {categories}، وقيمة كل مفتاح قائمة من مقترحين محددين وقابلين للتطبيق، كل مقترح في جملة واضحة
+
+تعليمات مهمة:
+- لا تستخدم أي عبارات ترحيبية مثل "يسرنا تقديم" أو "نتشرف بتقديم"
+- افصل بين الفقرات بسطر فارغ
+- لا تستخدم تنسيق markdown مثل **نص** أو *نص*
+"""
+
+def format_recommendations(recommendations_by_category):
+    """Render recommendations keyed by category in the per-section "### / ●" text format"""
+    blocks = []
+    for category in RECOMMENDATION_CATEGORIES:
+        items = [str(item).strip() for item in recommendations_by_category.get(category) or [] if str(item).strip()]
+        if items:
+            blocks.append(f"### {category}\n" + "\n".join(f"● {item}" for item in items))
+    return "\n\n".join(blocks) if blocks else None
+
+def parse_one_shot_response(text, pillar_data_by_section):
+    """Map a one-shot JSON response onto report sections; returns None if it cannot be parsed"""
+    try:
+        report = json.loads(text)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(report, dict):
+        return None
+    
+    sections = {}
+    if isinstance(report.get('executive_summary'), str) and report['executive_summary'].strip():
+        sections['summary'] = report['executive_summary'].strip()
+    
+    pillar_analyses = report.get('pillar_analyses')
+    if isinstance(pillar_analyses, dict):
+        for section, pillar_data in pillar_data_by_section.items():
+            analysis = pillar_analyses.get(PILLAR_SECTIONS[section][0])
+            if pillar_data and isinstance(analysis, str) and analysis.strip():
+                sections[section] = analysis.strip()
+    
+    if isinstance(report.get('recommendations'), dict):
+        recommendations = format_recommendations(report['recommendations'])
+        if recommendations:
+            sections['recommendations'] = recommendations
+    
+    return sections or None
+
+def generate_report_one_shot(model, data_summary, pillar_data_by_section, force_regenerate=False):
+    """Generate all report sections with one structured (JSON mode) call.
+    
+    Returns the sections that could be parsed, or None when the call or the parsing
+    fails so the caller can fall back to per-section generation.
+    """
+    pillar_keys = [PILLAR_SECTIONS[section][0] for section, pillar_data in pillar_data_by_section.items() if pillar_data]
+    response_schema = {
+        'type': 'object',
+        'properties': {
+            'executive_summary': {'type': 'string'},
+            'pillar_analyses': {
+                'type': 'object',
+                'properties': {key: {'type': 'string'} for key in pillar_keys},
+                'required': pillar_keys
+            },
+            'recommendations': {
+                'type': 'object',
+                'properties': {category: {'type': 'array', 'items': {'type': 'string'}}
+                               for category in RECOMMENDATION_CATEGORIES},
+                'required': RECOMMENDATION_CATEGORIES
+            }
+        },
+        'required': ['executive_summary', 'pillar_analyses', 'recommendations']
+    }
+    
+    prompt = build_one_shot_prompt(data_summary, pillar_data_by_section)
+    try:
+        text = generate_text(
+            model, prompt, force_regenerate=force_regenerate,
+            generation_config={'response_mime_type': 'application/json', 'response_schema': response_schema},
+            section='one_shot'
+        )
+    except Exception:
         return None
+    return parse_one_shot_response(text, pillar_data_by_section)
+
+def get_call_slots():
+    """This session's bound on in-flight model calls (LLM_MAX_CONCURRENCY).
+    
+    Sections and their map-stage calls run on nested thread pools; the slots are taken only
+    around the backend call itself, so the bound holds across both levels without a
+    waiting parent blocking its children.
+    """
+    if 'llm_call_slots' not in st.session_state:
+        st.session_state['llm_call_slots'] = threading.BoundedSemaphore(max(1, int(os.getenv('LLM_MAX_CONCURRENCY', 4))))
+    return st.session_state['llm_call_slots']
+
+def run_parallel(tasks):
+    """Run callables on worker threads that share the script context; results keep the task order"""
+    get_call_slots()
+    ctx = get_script_run_ctx()
+    max_workers = max(1, min(int(os.getenv('LLM_MAX_CONCURRENCY', 4)), len(tasks)))
+    with ThreadPoolExecutor(max_workers=max_workers,
+                            initializer=lambda: add_script_run_ctx(ctx=ctx)) as executor:
+        return list(executor.map(lambda task: task(), tasks))
+
+def count_attribute_statuses(sub_pillars):
+    """Status counts over the attributes of the given sub-pillars ('-' scores count as NA)"""
+    counts = {'E': 0, 'R': 0, 'N': 0, 'NA': 0}
+    for sub_pillar in sub_pillars:
+        for attr in sub_pillar['attributes']:
+            status = 'NA' if attr['score'] == '-' else attr['status']
+            counts[status] = counts.get(status, 0) + 1
+    return counts
+
+def sub_pillar_name(sub_pillar):
+    return sub_pillar['name_ar'] or sub_pillar.get('name_en') or ""
+
+def build_sub_pillar_summary_prompt(pillar_name, sub_pillar):
+    """Build the map-stage prompt that summarizes a single sub-pillar"""
+    attributes_payload = serialize_sub_pillar(sub_pillar, PROMPT_TOKEN_BUDGETS['sub_pillar'])
+    
+    return f"""
+أنت محلل خبير في تقييم مراكز الخدمة. لخص نتائج المحور الفرعي "{sub_pillar_name(sub_pillar)}" ضمن محور "{pillar_name}" باللغة العربية.
+
+نتائج العناصر:
+{attributes_payload.text}
+
+المطلوب:
+- 3-4 جمل تذكر أبرز نقاط القوة وأهم الفجوات وعدد العناصر في كل حالة
+- اعتمد على البيانات المذكورة فقط
+- لا تستخدم عناوين أو نقاط أو تنسيق markdown
+"""
+
+def build_pillar_reduce_prompt(pillar_name, pillar_score, sub_pillars, sub_pillar_summaries):
+    """Build the reduce-stage prompt that turns sub-pillar summaries into a pillar analysis"""
+    pillar_score_percentage = float(pillar_score) * 100
+    counts = count_attribute_statuses(sub_pillars)
+    summaries = "\n".join(
+        f"- {sub_pillar_name(sub_pillar)}: {summary or 'لا يتوفر ملخص'}"
+        for sub_pillar, summary in zip(sub_pillars, sub_pillar_summaries)
+    )
+    
+    return f"""
+أنت محلل خبير في تقييم مراكز الخدمة. اكتب تحليلاً تفصيلياً لمحور "{pillar_name}" بناءً على ملخصات محاوره الفرعية التالية:
+
+بيانات المحور:
+- نتيجة المحور: {pillar_score_percentage:.0f}% (من 100%)
+- العناصر المتميزة: {counts['E']}
+- العناصر التي تحتاج تحسين: {counts['R']}
+- العناصر الحرجة: {counts['N']}
+
+ملخصات المحاور الفرعية:
+{summaries}
+
+المطلوب:
+1. ابدأ بجملة تلخص الأداء العام للمحور مع ذكر النسبة المئوية الصحيحة ({pillar_score_percentage:.0f}%)
+2. اكتب فقرة تحليلية تفصيلية (150-200 كلمة) تشمل:
+   - النقاط الإيجابية المحققة
+   - التحديات والفجوات المحددة
+   - تأثير هذه النتائج على تجربة المتعاملين
+3. اختتم بجملة تلخص النتيجة العامة للمحور (مرتفع/منخفض/متوسط)
+
+استخدم أسلوباً مهنياً ومترابطاً، ولا تستخدم نقاط أو عناوين فرعية.
+
+تعليمات التنسيق:
+- لا تستخدم تنسيق markdown مثل **نص** أو *نص*
+- اكتب النص بشكل عادي بدون رموز تنسيق
+"""
+
+def build_hierarchical_summary_prompt(data_summary, pillar_analyses):
+    """Build the final-stage executive summary prompt from the per-pillar analyses"""
+    pillars_text = "\n\n".join(
+        f"[{pillar['name_ar']} | {float(pillar['score']) * 100:.0f}%]\n{analysis or 'لا يتوفر تحليل'}"
+        for pillar, analysis in zip(data_summary['pillars'], pillar_analyses)
+    )
+    
+    return f"""
+أنت محلل خبير في تقييم مراكز الخدمة الحكومية. بناءً على البيانات التالية من تقييم مركز خدمة جمارك أبوظبي، اكتب ملخصاً تنفيذياً شاملاً باللغة العربية.
+
+البيانات:
+- المعدل الكلي للأداء: {data_summary['overall_score']:.1f}%
+- العناصر المتميزة (E): {data_summary['status_counts']['E']} عنصر
+- العناصر التي تحتاج تحسين (R): {data_summary['status_counts']['R']} عنصر  
+- العناصر الحرجة (N): {data_summary['status_counts']['N']} عنصر
+
+تحليل المحاور الرئيسية:
+{pillars_text}
+{comparison_prompt_block(data_summary)}
+المطلوب:
+1. اكتب ملخصاً تنفيذياً مهنياً باللغة العربية (3-4 فقرات)
+2. ركز على النقاط الإيجابية والتحديات الرئيسية
+3. قدم توصيات عملية للتحسين
+4. استخدم أسلوباً مهنياً يناسب التقارير الحكومية
+5. اذكر الأرقام والنسب المئوية بشكل طبيعي في النص
+
+تعليمات مهمة:
+- ابدأ الفقرة الأولى بالضبط بهذا النص: "أظهرت نتائج زيارة المتسوق السري أن"
+- "لا تستخدم أي عبارات ترحيبية أخرى مثل "يسرنا تقديم" أو "نتشرف بتقديم" أو "يستعرض هذا الملخص التنفيذي
+- استخدم أسلوباً تقريرياً مهنياً ومباشراً
+- لا تستخدم عناوين أو نقاط، فقط نص متدفق ومترابط
+- اجعل التحليل موضوعياً وقائماً على البيانات
+- لا تستخدم تنسيق markdown مثل **نص** أو *نص*
+"""
+
+def reduce_pillar(model, pillar_name, pillar_score, sub_pillars, force_regenerate=False, on_chunk=None, section='pillar',
+                  priority=PRIORITY_INTERACTIVE):
+    """Summarize each sub-pillar in parallel (map), then combine the summaries into the pillar analysis (reduce).
+    
+    Every stage goes through generate_text, so intermediate summaries are cached and shared
+    between the pillar tabs and the executive summary.
+    """
+    def summarize(sub_pillar):
+        # A failed map call leaves that sub-pillar without a summary instead of failing the pillar
+        try:
+            return generate_text(model, build_sub_pillar_summary_prompt(pillar_name, sub_pillar),
+                                 force_regenerate=force_regenerate, section='sub_pillar', priority=priority)
+        except Exception:
+            return None
+    
+    sub_pillar_summaries = run_parallel([
+        lambda sub_pillar=sub_pillar: summarize(sub_pillar)
+        for sub_pillar in sub_pillars
+    ])
+    prompt = build_pillar_reduce_prompt(pillar_name, pillar_score, sub_pillars, sub_pillar_summaries)
+    return generate_text(model, prompt, force_regenerate=force_regenerate, on_chunk=on_chunk, section=section,
+                         priority=priority)
+
+# AI report sections: section key -> label used in the sidebar
+SECTION_LABELS = {
+    'one_shot': "التقرير الكامل (طلب واحد)",
+    'sub_pillar': "ملخصات المحاور الفرعية",
+    'pillar': "تحليل المحاور",
+    'summary': "الملخص التنفيذي",
+    'accessibility': "محور سهولة الوصول",
+    'appearance': "محور المظهر العام",
+    'recommendations': "المقترحات التطويرية",
+    'scenario': "تحليل السيناريو",
+    'network': "ملخص الشبكة"
+}
+
+def compute_section_fingerprints(model, data_summary, pillar_data_by_section, hierarchical=False):
+    """Fingerprint exactly the inputs each AI section depends on"""
+    def fingerprint(inputs, mode=None):
+        payload = json.dumps([model.model_name, mode, inputs], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    fingerprints = {
+        'summary': fingerprint({
+            'overall_score': data_summary['overall_score'],
+            'status_counts': data_summary['status_counts'],
+            'pillars': data_summary['pillars'],
+            'comparison': data_summary.get('comparison')
+        }, 'hierarchical' if hierarchical else None)
+    }
+    for section, pillar_data in pillar_data_by_section.items():
+        if pillar_data:
+            fingerprints[section] = fingerprint(pillar_data, 'hierarchical' if hierarchical else None)
+    fingerprints['recommendations'] = fingerprint({
+        'overall_score': data_summary['overall_score'],
+        'status_counts': data_summary['status_counts'],
+        'findings': [f for f in data_summary['detailed_findings'] if f['status'] in ['N', 'R']]
+    })
+    return fingerprints
+
+# AI report sections: section key -> CSS class of its container in the tabs
+SECTION_CSS_CLASSES = {
+    'summary': 'summary-text',
+    'accessibility': 'pillar-analysis',
+    'appearance': 'pillar-analysis',
+    'recommendations': 'recommendation-card'
+}
+
+def generate_report_sections(model, data_summary, pillar_data_by_section, force_regenerate=False,
+                             stream=False, on_section_update=None, on_section_done=None, only_sections=None,
+                             hierarchical=False, background_sections=()):
+    """Generate the AI report sections concurrently, reporting each one as soon as it finishes.
+    
+    With stream=True, on_section_update receives the partial text of a section while it
+    is being generated. All callbacks run on the calling (script) thread. only_sections
+    restricts generation to the given section keys. hierarchical=True builds the summary
+    and pillar analyses by map-reduce over the sub-pillars. Calls of background_sections
+    wait behind interactive requests in the rate limiter.
+    """
+    def priority(section):
+        return PRIORITY_BACKGROUND if section in background_sections else PRIORITY_INTERACTIVE
+    
+    tasks = {
+        'summary': lambda report_error, on_chunk: generate_executive_summary(model, data_summary, force_regenerate, report_error, on_chunk,
+                                                                            hierarchical, priority('summary')),
+        'recommendations': lambda report_error, on_chunk: generate_recommendations(model, data_summary, force_regenerate, report_error, on_chunk,
+                                                                                  priority('recommendations'))
+    }
+    for section, pillar_data in pillar_data_by_section.items():
+        if pillar_data:
+            tasks[section] = (lambda report_error, on_chunk, pillar_data=pillar_data, name=PILLAR_SECTIONS[section][1], section=section:
+                              generate_pillar_analysis(model, pillar_data, name, force_regenerate, report_error, on_chunk, section,
+                                                       hierarchical, priority(section)))
+    if only_sections is not None:
+        tasks = {section: task for section, task in tasks.items() if section in only_sections}
+    if not tasks:
+        return {}
+    
+    # Workers only post events; the script thread drains them and updates the UI
+    events = queue.Queue()
+    
+    def run_task(section, task):
+        errors = []
+        on_chunk = (lambda text: events.put(('chunk', section, text, None))) if stream else None
+        try:
+            text = task(errors.append, on_chunk)
+        except Exception as e:
+            text, errors = None, [f"خطأ في توليد التحليل: {str(e)}"]
+        events.put(('done', section, text, errors))
+    
+    # Worker threads share the script context so cached resources resolve as in the main thread
+    get_call_slots()
+    ctx = get_script_run_ctx()
+    max_workers = max(1, min(int(os.getenv('LLM_MAX_CONCURRENCY', 4)), len(tasks)))
+    results = {}
+    
+    with ThreadPoolExecutor(max_workers=max_workers,
+                            initializer=lambda: add_script_run_ctx(ctx=ctx)) as executor:
+        for section, task in tasks.items():
+            executor.submit(run_task, section, task)
+        
+        pending = len(tasks)
+        while pending:
+            batch = [events.get()]
+            while not events.empty():
+                batch.append(events.get_nowait())
+            
+            # Only the latest partial text of each section is worth rendering
+            latest_chunks = {}
+            for kind, section, text, errors in batch:
+                if kind == 'chunk':
+                    latest_chunks[section] = text
+                    continue
+                latest_chunks.pop(section, None)
+                pending -= 1
+                results[section] = text
+                if on_section_done:
+                    on_section_done(section, text, errors)
+            
+            if on_section_update:
+                for section, text in latest_chunks.items():
+                    on_section_update(section, text)
+    
+    return results
+
+def estimate_section_prompt_tokens(data_summary, pillar_data_by_section, hierarchical=False):
+    """Estimated input tokens of each section prompt, reported before the calls are made.
+    
+    In hierarchical mode only the map-stage prompts are known up front, so their total is reported.
+    """
+    if hierarchical:
+        def map_tokens(pillar_name, sub_pillars):
+            return sum(estimate_tokens(build_sub_pillar_summary_prompt(pillar_name, sub_pillar)) for sub_pillar in sub_pillars)
+        
+        estimates = {'summary': sum(map_tokens(pillar['name_ar'], pillar['sub_pillars']) for pillar in data_summary['pillars'])}
+        for section, pillar_data in pillar_data_by_section.items():
+            if pillar_data:
+                estimates[section] = map_tokens(pillar_data['pillar_name_ar'], pillar_data['sub_pillars'])
+        estimates['recommendations'] = estimate_tokens(build_recommendations_prompt(data_summary))
+        return estimates
+    
+    estimates = {'summary': estimate_tokens(build_executive_summary_prompt(data_summary))}
+    for section, pillar_data in pillar_data_by_section.items():
+        if pillar_data:
+            estimates[section] = estimate_tokens(build_pillar_analysis_prompt(pillar_data, PILLAR_SECTIONS[section][1]))
+    estimates['recommendations'] = estimate_tokens(build_recommendations_prompt(data_summary))
+    return estimates
+
+def render_llm_stats(placeholder):
+    """Show response cache, rate limiter and parse cache state in the sidebar"""
+    cache_stats = get_response_cache().stats()
+    parse_stats = get_parse_cache().stats()
+    limiter_stats = get_rate_limiter().stats()
+    flight_stats = get_single_flight().stats()
+    with placeholder.container():
+        st.caption(
+            f"الذاكرة المؤقتة: {cache_stats['hits']} إصابة / {cache_stats['misses']} إخفاق "
+            f"- {cache_stats['entries']} عنصر ({cache_stats['size_bytes'] / 1024:.0f} KB)"
+        )
+        st.caption(
+            f"طلبات في الانتظار: {limiter_stats['queue_depth']} "
+            f"- وقت التقييد: {limiter_stats['throttled_seconds']:.1f} ث "
+            f"- إعادة المحاولة: {limiter_stats['retries']}"
+        )
+        st.caption(
+            f"طلبات مدمجة مع طلبات جارية: {flight_stats['coalesced']} "
+            f"- بانتظار النتيجة حالياً: {flight_stats['waiting']}"
+        )
+        st.caption(
+            f"الملفات المحللة المخزنة: {parse_stats['entries']} "
+            f"- إصابة: {parse_stats['hits']} / إخفاق: {parse_stats['misses']}"
+        )
+
+def render_performance_panel(placeholder):
+    """Show per-section LLM latency and token percentiles for this process in the sidebar"""
+    summary = get_llm_telemetry().summary()
+    
+    def seconds(value):
+        return f"{value:.2f}" if value is not None else "-"
+    
+    rows = [
+        {
+            "القسم": SECTION_LABELS.get(section, section),
+            "الطلبات": stats['calls'],
+            "من الذاكرة": stats['cache_hits'],
+            "بانتظار طلب مماثل": stats['coalesced'],
+            "p50 (ث)": seconds(stats['latency_p50']),
+            "p95 (ث)": seconds(stats['latency_p95']),
+            "أول استجابة p50 (ث)": seconds(stats['ttfb_p50']),
+            "رموز المدخلات": f"{stats['prompt_tokens_avg']:.0f}" if stats['prompt_tokens_avg'] else "-",
+            "رموز المخرجات": f"{stats['response_tokens_avg']:.0f}" if stats['response_tokens_avg'] else "-",
+            "إعادة المحاولة": stats['retries'],
+            "أخطاء": stats['errors']
+        }
+        for section, stats in summary.items()
+    ]
+    with placeholder.container():
+        with st.expander("الأداء"):
+            if rows:
+                st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+                st.caption("الأزمنة والرموز محسوبة على الطلبات التي وصلت إلى النموذج فقط")
+            else:
+                st.caption("لا توجد طلبات مسجلة بعد")
+
+def request_sections(*sections):
+    """Mark sections as wanted by the user; they are generated on the next run and kept for the session"""
+    st.session_state.setdefault('requested_sections', set()).update(sections)
+
+def render_pending_section(placeholder, section):
+    """Show a lazily generated section that has not been requested yet"""
+    with placeholder.container():
+        st.info("لم يتم توليد هذا التحليل بعد")
+        st.button(
+            "توليد التحليل",
+            key=f"generate_{section}",
+            on_click=request_sections,
+            args=(section,)
+        )
+
+def render_ai_section(placeholder, section, text, errors=None):
+    """Render a generated AI section (or its errors) into its tab placeholder"""
+    with placeholder.container():
+        if text:
+            formatted_text = clean_and_format_text(text)
+            st.markdown(f'<div class="{SECTION_CSS_CLASSES[section]}">{formatted_text}</div>', unsafe_allow_html=True)
+        for message in errors or []:
+            st.error(message)
+        if not text and not errors:
+            st.warning("لم يتم إنتاج أي محتوى من النموذج")
 
 def create_score_gauge(score):
     """Create a circular gauge chart for the overall score"""
@@ -744,9 +1442,8 @@ def create_pillar_status_chart(pillar_data):
     status_map = {'E': 'مرتفع', 'R': 'متوسط', 'N': 'منخفض', 'NA': 'لا ينطبق'}
     
     for sub_pillar in pillar_data['sub_pillars']:
-        # Determine dominant status for this sub-pillar
-        status_counts = sub_pillar['status_counts']
-        dominant_status = max(status_counts.items(), key=lambda x: x[1])[0]
+        # Dominant status for this sub-pillar (precomputed by the evaluation model when available)
+        dominant_status = sub_pillar.get('dominant_status') or max(sub_pillar['status_counts'].items(), key=lambda x: x[1])[0]
         
         sub_pillars.append(sub_pillar['name_ar'])
         statuses.append(status_map[dominant_status])
@@ -781,13 +1478,7 @@ def create_pillar_status_chart(pillar_data):
 def create_recommendations_flowchart():
     """Create a visual flowchart for recommendations"""
     # This is a simplified representation using plotly
-    categories = [
-        "البيئة العامة",
-        "مواقف السيارات", 
-        "المبنى",
-        "القدرة الاستيعابية والانتظار",
-        "سهولة الوصول إلى الموقع"
-    ]
+    categories = RECOMMENDATION_CATEGORIES
     
     fig = go.Figure()
     
@@ -1457,21 +2148,19 @@ def save_streamlit_data_to_txt(data, overall_score, status_counts, ai_summary, a
 """
     
     # Add detailed pillar data in Arabic
-    for pillar in data:
-        pillar_name_ar = pillar.get('pillar_ar', pillar.get('pillar_en', 'محور غير معروف'))
-        pillar_name_en = pillar.get('pillar_en', '')
-        pillar_score = pillar.get('pillar_score', 0)
+    for pillar in as_evaluation(data).pillars:
+        pillar_name_ar = pillar.name_ar or 'محور غير معروف'
         
-        content += f"\n--- {pillar_name_ar} ({pillar_name_en}) - النتيجة: {pillar_score} ---\n"
+        content += f"\n--- {pillar_name_ar} ({pillar.name_en}) - النتيجة: {pillar.score} ---\n"
         
-        for sub_pillar in pillar.get('sub_pillars', []):
-            sub_name_ar = sub_pillar.get('sub_pillar_ar', sub_pillar.get('sub_pillar_en', 'محور فرعي غير معروف'))
+        for sub_pillar in pillar.sub_pillars:
+            sub_name_ar = sub_pillar.name_ar or 'محور فرعي غير معروف'
             content += f"\n  {sub_name_ar}:\n"
             
-            for attr in sub_pillar.get('attributes', []):
-                attr_name_en = attr.get('attribute_en', 'خاصية غير معروفة')
-                status = attr.get('status', 'N')
-                score = attr.get('score', 0)
+            for attr in sub_pillar.attributes:
+                attr_name_en = attr.description or 'خاصية غير معروفة'
+                status = attr.status
+                score = attr.score
                 status_text = {'E': 'ممتاز', 'R': 'يحتاج تحسين', 'N': 'حرج', 'NA': 'غير قابل للتطبيق'}.get(status, 'غير محدد')
                 
                 content += f"    - {attr_name_en}: {status_text} (النتيجة: {score})\n"
@@ -1967,6 +2656,523 @@ def generate_arabic_docx_from_txt(txt_file_path):
 # Set the main DOCX generation function
 generate_arabic_docx = generate_arabic_docx_from_txt
 
+def load_center_batch(batch_file, batch_directory):
+    """Load every visit file of a zip upload or a directory, reusing the result while the source is unchanged"""
+    if batch_file is not None and is_ndjson(batch_file.name):
+        signature = ('ndjson', batch_file.file_id)
+        get_sources = lambda: read_ndjson_sources(batch_file.name, batch_file)
+    elif batch_file is not None:
+        signature = ('zip', batch_file.file_id)
+        get_sources = lambda: read_zip_sources(batch_file.getvalue())
+    elif batch_directory:
+        if not os.path.isdir(batch_directory):
+            st.sidebar.error("المجلد المحدد غير موجود")
+            return None
+        sources = read_directory_sources(batch_directory)
+        signature = ('directory', batch_directory,
+                     tuple((name, os.stat(path).st_mtime_ns, os.stat(path).st_size) for name, _, path in sources))
+        get_sources = lambda: sources
+    else:
+        return None
+    
+    cached = st.session_state.get('center_batch')
+    if cached and cached[0] == signature:
+        return cached[1]
+    
+    with st.spinner("جاري تحميل ملفات المراكز..."):
+        try:
+            visits = load_visits(get_sources(), snapshots=get_snapshot_store(), executor=get_parse_pool())
+        except Exception as e:
+            st.sidebar.error(f"خطأ في قراءة ملفات المراكز: {str(e)}")
+            return None
+        record_visit_history(visits)
+    st.session_state['center_batch'] = (signature, visits)
+    return visits
+
+def center_visits(visits):
+    """{center label: LoadedVisit} of the valid visits; repeated center names are told apart by file name"""
+    names = [visit.center for visit in visits if not visit.error]
+    labelled = {}
+    for visit in visits:
+        if visit.error:
+            continue
+        label = visit.center if names.count(visit.center) == 1 else f"{visit.center} ({visit.name})"
+        labelled[label] = visit
+    return labelled
+
+def center_evaluations(visits):
+    """{center label: Evaluation} of the valid visits"""
+    return {label: visit.evaluation for label, visit in center_visits(visits).items()}
+
+def record_visit_history(visits):
+    """Add newly loaded valid visits to the historical visit store"""
+    store = get_visit_store()
+    if store is None:
+        return
+    try:
+        store.record_visits(
+            (visit.content_hash, visit.center, visit.visit_date, visit.name, visit.evaluation)
+            for visit in visits if not visit.error
+        )
+    except Exception as e:
+        st.sidebar.warning(f"تعذر حفظ الزيارات في السجل التاريخي: {str(e)}")
+
+def record_uploaded_visit(uploaded_file, evaluation, key):
+    """Add a single uploaded visit to the historical visit store, once per upload; returns its center.
+    
+    The center comes from the file; when the file does not name one, the user is asked for
+    it and the visit is recorded once it is given.
+    """
+    if get_visit_store() is None:
+        return evaluation.center
+    center = evaluation.center
+    if not center:
+        center = st.sidebar.text_input(
+            f"اسم المركز للملف {uploaded_file.name}",
+            key=f"{key}_center_{uploaded_file.file_id}",
+            help="الملف لا يحدد اسم المركز؛ أدخله لحفظ الزيارة في السجل التاريخي"
+        ).strip()
+        if not center:
+            return None
+    if st.session_state.get(key) != uploaded_file.file_id:
+        record_visit_history([LoadedVisit(uploaded_file.name, center, evaluation=evaluation,
+                                          visit_date=evaluation.visit_date, content_hash=evaluation.content_hash)])
+        st.session_state[key] = uploaded_file.file_id
+    return center
+
+def create_score_trend_chart(history):
+    """Overall score of a center at each visit"""
+    fig = go.Figure(go.Scatter(
+        x=history['visit_date'],
+        y=history['overall_score'],
+        mode='lines+markers',
+        line=dict(color='#1f77b4', width=3),
+        hovertemplate='%{x}<br>المعدل الكلي: %{y:.1f}%<extra></extra>'
+    ))
+    fig.update_layout(
+        title="المعدل الكلي عبر الزيارات",
+        title_font=dict(size=18, family='Arial'),
+        yaxis=dict(range=[0, 100], title="%"),
+        height=350,
+        paper_bgcolor="white",
+        plot_bgcolor="white"
+    )
+    return fig
+
+def create_pillar_trend_chart(pillar_history):
+    """Score of each pillar at each visit"""
+    fig = px.line(
+        pillar_history.assign(score=pillar_history['score'] * 100),
+        x='visit_date', y='score', color='pillar_ar', markers=True,
+        labels={'visit_date': "تاريخ الزيارة", 'score': "%", 'pillar_ar': "المحور"}
+    )
+    fig.update_layout(
+        title="أداء المحاور عبر الزيارات",
+        title_font=dict(size=18, family='Arial'),
+        yaxis=dict(range=[0, 100]),
+        height=350,
+        paper_bgcolor="white",
+        plot_bgcolor="white"
+    )
+    return fig
+
+def create_status_trend_chart(history):
+    """E / R / N counts of a center at each visit"""
+    color_map = {'e_count': '#28a745', 'r_count': '#ffc107', 'n_count': '#dc3545'}
+    names = {'e_count': 'متميز', 'r_count': 'يحتاج تحسين', 'n_count': 'حرج'}
+    fig = go.Figure([
+        go.Bar(x=history['visit_date'], y=history[column], name=names[column], marker_color=color)
+        for column, color in color_map.items()
+    ])
+    fig.update_layout(
+        title="توزيع الحالات عبر الزيارات",
+        title_font=dict(size=18, family='Arial'),
+        barmode='stack',
+        height=350,
+        paper_bgcolor="white",
+        plot_bgcolor="white"
+    )
+    return fig
+
+def previous_visit_label(labelled_visits, selected_label):
+    """Label of the latest earlier dated visit of the same center, or None"""
+    selected = labelled_visits[selected_label]
+    if not selected.visit_date:
+        return None
+    earlier = [
+        (visit.visit_date, label) for label, visit in labelled_visits.items()
+        if label != selected_label and visit.center == selected.center
+        and visit.visit_date and visit.visit_date < selected.visit_date
+    ]
+    return max(earlier)[1] if earlier else None
+
+STATUS_LABELS = {'E': 'متميز', 'R': 'يحتاج تحسين', 'N': 'حرج', 'NA': 'غير قابل للتطبيق', None: '-'}
+
+def render_comparison(delta):
+    """Changes since the previous visit: overall and pillar movement, status transitions and changed attributes"""
+    st.markdown("---")
+    st.markdown('<div class="rtl" dir="rtl"><h3>المقارنة مع الزيارة السابقة</h3></div>', unsafe_allow_html=True)
+    
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("المعدل الكلي", f"{delta.after.overall_score:.1f}%", f"{delta.overall_delta:+.1f} نقطة")
+    col2.metric("عناصر تراجعت", len(delta.worsened))
+    col3.metric("عناصر تحسنت", len(delta.improved))
+    col4.metric("دون تغيير", delta.unchanged)
+    
+    st.dataframe(pd.DataFrame([
+        {
+            "المحور": pillar['name_ar'],
+            "الزيارة السابقة %": pillar['before_score'],
+            "الزيارة الحالية %": pillar['after_score'],
+            "التغير": pillar['delta'],
+            **{STATUS_LABELS[status]: f"{count:+d}" for status, count in pillar['status_deltas'].items()}
+        }
+        for pillar in delta.pillars
+    ]).round(1), hide_index=True, use_container_width=True)
+    
+    if delta.transitions:
+        st.caption("انتقالات الحالة: " + " - ".join(
+            f"{STATUS_LABELS[before]} ← {STATUS_LABELS[after]}: {count}"
+            for (before, after), count in sorted(delta.transitions.items(), key=lambda item: -item[1])
+        ))
+    
+    if delta.changes:
+        with st.expander(f"العناصر المتغيرة ({len(delta.changes)})"):
+            st.dataframe(pd.DataFrame([
+                {
+                    "المحور": change.pillar.name_ar,
+                    "المحور الفرعي": change.sub_pillar.name_ar,
+                    "العنصر": change.description,
+                    "الحالة السابقة": STATUS_LABELS[change.before_status],
+                    "الحالة الحالية": STATUS_LABELS[change.after_status],
+                    "تغير النتيجة": change.score_delta
+                }
+                for change in delta.changes
+            ]), hide_index=True, use_container_width=True)
+
+# Run the simulator as a fragment where Streamlit supports it, so an edit reruns only the simulator tab
+fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None) or (lambda function: function)
+
+def build_scenario_prompt(delta_text):
+    """Prompt for a short narrative of a what-if scenario, from the compact diff against the actual evaluation"""
+    return f"""
+أنت محلل خبير في تقييم مراكز الخدمة الحكومية. فيما يلي سيناريو افتراضي لتقييم مركز خدمة جمارك أبوظبي، يوضح أثر تغيير حالة أو نتيجة أو وزن بعض العناصر مقارنة بالتقييم الفعلي.
+
+أثر السيناريو:
+{delta_text}
+
+المطلوب:
+1. اكتب فقرتين باللغة العربية توضحان أثر هذه التغييرات على المعدل الكلي والمحاور
+2. بين أي التغييرات أكثر تأثيراً وما يلزم لتحقيقها عملياً
+3. اذكر الأرقام والنسب المئوية بشكل طبيعي في النص
+
+تعليمات مهمة:
+- وضح أن النتائج افتراضية وليست نتائج زيارة فعلية
+- لا تستخدم عناوين أو نقاط، فقط نص متدفق ومترابط
+- لا تستخدم تنسيق markdown مثل **نص** أو *نص*
+"""
+
+def build_simulation_table(data):
+    """Editor rows of the what-if simulator, one per attribute in frame order (NA attributes have no score)"""
+    frame = data.frame
+    sub_pillars = [sub_pillar for pillar in data.pillars for sub_pillar in pillar.sub_pillars]
+    attributes = [attribute for sub_pillar in sub_pillars for attribute in sub_pillar.attributes]
+    return pd.DataFrame({
+        "المحور": [data.pillars[position].name_ar for position in frame['pillar'].tolist()],
+        "المحور الفرعي": [sub_pillars[position].name_ar for position in frame['sub_pillar'].tolist()],
+        "العنصر": [attribute.description for attribute in attributes],
+        "الحالة": frame['effective_status'].astype(str).tolist(),
+        "النتيجة": frame['score'].where(~frame['na']),
+        "الوزن": frame['weight'],
+    })
+
+def get_simulation(data):
+    """This session's what-if state for the evaluation on screen; a new evaluation starts a new scenario"""
+    key = data.content_hash or id(data)
+    state = st.session_state.get('whatif')
+    if state is None or state['key'] != key:
+        state = {
+            'key': key,
+            'simulation': WhatIfSimulation(data),
+            'table': data.view('simulation_table', lambda: build_simulation_table(data)),
+            'version': 0,
+            'applied': {},
+            'narrative': None
+        }
+        st.session_state['whatif'] = state
+    return state
+
+def apply_simulation_edits(state, editor_key):
+    """Apply the editor rows that changed since the last run; untouched rows cost nothing"""
+    edited_rows = st.session_state[editor_key]['edited_rows']
+    simulation = state['simulation']
+    for row, cells in edited_rows.items():
+        if state['applied'].get(row) == cells:
+            continue
+        # Only edited cells are passed, so a status edit without a score edit rescores the attribute;
+        # the row is rebuilt from its evaluated values since cells holds every edit made to it
+        values = {column: cells.get(column) for column in ("الحالة", "النتيجة", "الوزن")}
+        values = {column: None if value is None or pd.isna(value) else value for column, value in values.items()}
+        simulation.revert(row)
+        simulation.set_attribute(row, status=values["الحالة"], score=values["النتيجة"], weight=values["الوزن"])
+    state['applied'] = {row: dict(cells) for row, cells in edited_rows.items()}
+
+def reset_simulation(state):
+    state['simulation'].reset()
+    state['applied'] = {}
+    state['narrative'] = None
+    state['version'] += 1
+
+def request_scenario_narrative(state):
+    state['narrative_requested'] = True
+
+def create_scenario_pillar_chart(data, simulation):
+    """Actual vs simulated score of each pillar"""
+    names = [pillar.name_ar for pillar in data.pillars]
+    fig = go.Figure(data=[
+        go.Bar(name="الفعلي", x=names, y=[float(pillar.score) * 100 for pillar in data.pillars],
+               marker_color='#6c757d'),
+        go.Bar(name="السيناريو", x=names, y=[simulation.pillar_score(position) for position in range(len(names))],
+               marker_color='#1f77b4')
+    ])
+    fig.update_layout(
+        title="نتائج المحاور: الفعلي مقابل السيناريو",
+        barmode='group',
+        yaxis=dict(title="%", range=[0, 100]),
+        height=400,
+        paper_bgcolor="white",
+        plot_bgcolor="white"
+    )
+    return fig
+
+def create_scenario_status_chart(actual_counts, scenario_counts):
+    """Actual vs simulated number of attributes per status"""
+    names = {'E': 'متميز', 'R': 'يحتاج تحسين', 'N': 'حرج', 'NA': 'لا ينطبق'}
+    fig = go.Figure(data=[
+        go.Bar(name="الفعلي", x=list(names.values()), y=[actual_counts.get(status, 0) for status in names],
+               marker_color='#6c757d'),
+        go.Bar(name="السيناريو", x=list(names.values()), y=[scenario_counts.get(status, 0) for status in names],
+               marker_color='#1f77b4')
+    ])
+    fig.update_layout(
+        title="توزيع حالات العناصر",
+        barmode='group',
+        height=400,
+        paper_bgcolor="white",
+        plot_bgcolor="white"
+    )
+    return fig
+
+@fragment
+def render_simulator(data, model):
+    """What-if tab: edit attribute statuses, scores and weights and see the scores move.
+    
+    Runs as a fragment, so an edit reruns only this tab; each edited row is applied to the
+    simulation's maintained aggregates in constant time. The model is only called when
+    the user asks for the scenario narrative.
+    """
+    state = get_simulation(data)
+    simulation = state['simulation']
+    editor_key = f"whatif_editor_{state['version']}"
+    
+    col1, col2, col3 = st.columns(3)
+    col1.metric("المعدل الكلي للسيناريو", f"{simulation.overall_score:.1f}%",
+                f"{simulation.overall_score - data.overall_score:+.1f} نقطة")
+    col2.metric("العناصر المعدلة", len(simulation.changes))
+    col3.metric("العناصر الحرجة في السيناريو", simulation.status_counts['N'],
+                simulation.status_counts['N'] - data.status_counts['N'], delta_color="inverse")
+    
+    col1, col2 = st.columns([1, 2])
+    with col1:
+        st.plotly_chart(create_score_gauge(simulation.overall_score), use_container_width=True, key="whatif_gauge")
+    with col2:
+        st.plotly_chart(create_scenario_pillar_chart(data, simulation), use_container_width=True,
+                        key="whatif_pillars")
+    st.plotly_chart(create_scenario_status_chart(data.status_counts, simulation.status_counts),
+                    use_container_width=True, key="whatif_statuses")
+    
+    st.caption("تغيير الحالة أو الوزن يعيد احتساب نتيجة العنصر من وزنه: متميز = كامل الوزن، يحتاج تحسين = نصفه، "
+               "حرج = صفر، ما لم تُعدَّل النتيجة يدوياً. نتيجة المحور هي مجموع نتائج عناصره بين 0 و100%")
+    st.data_editor(
+        state['table'],
+        key=editor_key,
+        on_change=apply_simulation_edits,
+        args=(state, editor_key),
+        disabled=["المحور", "المحور الفرعي", "العنصر"],
+        column_config={
+            "الحالة": st.column_config.SelectboxColumn("الحالة", options=list(STATUSES), required=True),
+            "النتيجة": st.column_config.NumberColumn("النتيجة", min_value=0.0, format="%.2f"),
+            "الوزن": st.column_config.NumberColumn("الوزن", min_value=0.0, format="%.2f"),
+        },
+        hide_index=True,
+        use_container_width=True
+    )
+    
+    col1, col2 = st.columns(2)
+    col1.button("إعادة التعيين", key="whatif_reset", on_click=reset_simulation, args=(state,),
+                disabled=not simulation.changes)
+    if model:
+        col2.button("توليد تحليل للسيناريو", key="whatif_narrative", on_click=request_scenario_narrative,
+                    args=(state,), disabled=not simulation.changes)
+    
+    # The narrative belongs to the scenario it was written for
+    scenario = tuple((index, simulation.attribute(index)) for index in simulation.changes)
+    if state.pop('narrative_requested', False) and model and simulation.changes:
+        delta = compare_evaluations(data, simulation.to_evaluation())
+        try:
+            with st.spinner("جاري توليد تحليل السيناريو..."):
+                text = generate_text(model, build_scenario_prompt(serialize_delta(delta)), section='scenario')
+            state['narrative'] = (scenario, text)
+        except Exception as e:
+            st.error(f"خطأ في توليد التحليل: {e}")
+    if state['narrative'] and state['narrative'][0] == scenario and state['narrative'][1]:
+        formatted_text = clean_and_format_text(state['narrative'][1])
+        st.markdown(f'<div class="summary-text">{formatted_text}</div>', unsafe_allow_html=True)
+
+def render_trends(default_center=None):
+    """Trend tab: a center's overall score, pillar scores and status counts from visit to visit"""
+    store = get_visit_store()
+    centers = store.centers() if store is not None else pd.DataFrame()
+    if centers.empty:
+        st.info("لا توجد زيارات محفوظة بعد. يتم حفظ الزيارات عند رفع ملفاتها.")
+        return
+    
+    names = centers['center'].tolist()
+    center = st.selectbox(
+        "المركز",
+        names,
+        index=names.index(default_center) if default_center in names else 0,
+        format_func=lambda name: f"{name} ({int(centers.loc[centers['center'] == name, 'visits'].iloc[0])} زيارة)",
+        key="trend_center"
+    )
+    undated = int(centers.loc[centers['center'] == center, 'undated'].iloc[0])
+    if undated:
+        st.caption(f"{undated} زيارة بدون تاريخ محفوظة لهذا المركز ولا تظهر في الرسوم، إذ لا يمكن ترتيبها زمنياً")
+    history = store.center_history(center)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.plotly_chart(create_score_trend_chart(history), use_container_width=True)
+    with col2:
+        st.plotly_chart(create_status_trend_chart(history), use_container_width=True)
+    st.plotly_chart(create_pillar_trend_chart(store.pillar_history(center)), use_container_width=True)
+    
+    st.dataframe(
+        history.rename(columns={
+            'visit_date': "تاريخ الزيارة",
+            'overall_score': "المعدل الكلي %",
+            'e_count': "متميز",
+            'r_count': "يحتاج تحسين",
+            'n_count': "حرج",
+            'na_count': "لا ينطبق",
+            'source': "الملف"
+        }).round(1),
+        hide_index=True,
+        use_container_width=True
+    )
+
+@st.cache_resource(max_entries=8)
+def get_portfolio_benchmark(portfolio_key, _evaluations):
+    """Benchmark of a portfolio, computed once per portfolio content hash and shared across sessions"""
+    return benchmark_portfolio(_evaluations)
+
+def build_network_summary_prompt(benchmark):
+    """Network-level summary prompt from the portfolio aggregates only (no per-center notes)"""
+    return f"""
+أنت محلل خبير في تقييم مراكز الخدمة الحكومية. فيما يلي إحصاءات مجمعة لنتائج زيارات المتسوق السري لشبكة مراكز خدمة جمارك أبوظبي.
+
+الإحصاءات:
+{serialize_benchmark(benchmark)}
+
+المطلوب:
+1. اكتب ملخصاً تنفيذياً على مستوى الشبكة باللغة العربية (3 فقرات)
+2. صف مستوى الأداء العام وتفاوته بين المراكز والمحاور
+3. حدد العناصر التي تتكرر فيها الإخفاقات عبر الشبكة وما تعنيه كأولويات مشتركة
+4. قدم توصيات على مستوى الشبكة وليس لمركز بعينه
+
+تعليمات مهمة:
+- اذكر الأرقام والنسب المئوية بشكل طبيعي في النص
+- لا تستخدم عناوين أو نقاط، فقط نص متدفق ومترابط
+- لا تستخدم تنسيق markdown مثل **نص** أو *نص*
+"""
+
+def request_network_summary(portfolio_key):
+    st.session_state['network_summary_requested'] = portfolio_key
+
+def render_benchmark(benchmark, model):
+    """League tables across centers: pillar ranks, pillar statistics, most failing attributes and the network summary"""
+    key = benchmark['portfolio_hash']
+    with st.expander("المقارنة المعيارية بين المراكز"):
+        st.markdown('<div class="rtl" dir="rtl"><h4>ترتيب المراكز في كل محور (1 الأفضل)</h4></div>', unsafe_allow_html=True)
+        st.dataframe(benchmark['pillar_ranks'].rename(columns={'center': "المركز"}), hide_index=True,
+                     use_container_width=True)
+        
+        st.markdown('<div class="rtl" dir="rtl"><h4>إحصاءات المحاور</h4></div>', unsafe_allow_html=True)
+        st.dataframe(benchmark['pillars'].drop(columns='pillar_en').rename(columns={
+            'pillar_ar': "المحور",
+            'mean': "المتوسط %",
+            'median': "الوسيط %",
+            'min': "الأدنى %",
+            'max': "الأعلى %",
+            'best_center': "أفضل مركز",
+            'worst_center': "أدنى مركز"
+        }).round(1), hide_index=True, use_container_width=True)
+        
+        st.markdown('<div class="rtl" dir="rtl"><h4>العناصر الأكثر إخفاقاً عبر الشبكة</h4></div>', unsafe_allow_html=True)
+        st.dataframe(benchmark['failing_attributes'].rename(columns={
+            'pillar_en': "المحور",
+            'description': "العنصر",
+            'evaluated': "مراكز مقيمة",
+            'N': "حرج",
+            'R': "يحتاج تحسين",
+            'n_rate': "نسبة الحرج %",
+            'centers_n': "مراكز بحالة حرجة"
+        }).round(1), hide_index=True, use_container_width=True)
+        
+        if not model:
+            return
+        st.button("توليد ملخص الشبكة", key="generate_network_summary", on_click=request_network_summary, args=(key,))
+        if st.session_state.pop('network_summary_requested', None) == key:
+            try:
+                with st.spinner("جاري توليد ملخص الشبكة..."):
+                    text = generate_text(model, build_network_summary_prompt(benchmark), section='network')
+                st.session_state['network_summary'] = (key, text)
+            except Exception as e:
+                st.error(f"خطأ في توليد ملخص الشبكة: {e}")
+        summary = st.session_state.get('network_summary')
+        if summary and summary[0] == key and summary[1]:
+            st.markdown(f'<div class="summary-text">{clean_and_format_text(summary[1])}</div>', unsafe_allow_html=True)
+
+def render_portfolio(evaluations, model=None):
+    """Per-center scoreboard with rank and percentile, portfolio aggregates and the benchmarking view"""
+    benchmark = get_portfolio_benchmark(portfolio_hash(evaluations), evaluations)
+    scoreboard = benchmark['scoreboard']
+    portfolio = benchmark['summary']
+    
+    with st.expander(f"لوحة أداء المراكز ({portfolio['centers']} مركز)", expanded=True):
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("متوسط الأداء", f"{portfolio['mean_score']:.1f}%")
+        col2.metric("الوسيط", f"{portfolio['median_score']:.1f}%")
+        col3.metric("أدنى أداء", f"{portfolio['min_score']:.1f}%")
+        col4.metric("أعلى أداء", f"{portfolio['max_score']:.1f}%")
+        
+        counts = portfolio['status_counts']
+        st.caption(f"إجمالي العناصر: متميز {counts['E']} - يحتاج تحسين {counts['R']} - حرج {counts['N']} - لا ينطبق {counts['NA']}")
+        
+        display = scoreboard.rename(columns={
+            'center': "المركز",
+            'overall_score': "المعدل الكلي %",
+            'rank': "الترتيب",
+            'percentile': "المئين",
+            'E': "متميز",
+            'R': "يحتاج تحسين",
+            'N': "حرج",
+            'NA': "لا ينطبق"
+        })
+        st.dataframe(display.round(1), hide_index=True, use_container_width=True)
+    
+    render_benchmark(benchmark, model)
+
 def main():
     # Set page direction to RTL
     st.markdown('<div dir="rtl" style="text-align: right;">', unsafe_allow_html=True)
@@ -1975,8 +3181,8 @@ def main():
     st.markdown('<div class="main-title" dir="rtl">تحليل أداء مراكز الخدمة</div>', unsafe_allow_html=True)
     st.markdown("---")
     
-    # Setup Gemini API
-    model = setup_gemini_api()
+    # Setup the LLM backend (Gemini, or the offline fake for load testing)
+    model = setup_llm_backend()
     
     # Sidebar with logo
     # Display logo in sidebar
@@ -1989,30 +3195,126 @@ def main():
     
     st.sidebar.markdown("---")
     st.sidebar.title("إعدادات التحليل")
+    if isinstance(model, FakeBackend):
+        st.sidebar.warning("وضع المحاكاة: يتم توليد التحليلات محلياً دون الاتصال بـ Gemini")
     
     
     # Default file path - use relative path for deployment compatibility
     default_file = "service_center_api_schema_RTL_FIXED.json"
     
-    # File upload option
-    uploaded_file = st.sidebar.file_uploader(
-        "اختر ملف JSON للتحليل",
-        type=['json'],
-        help="اختر ملف البيانات بصيغة JSON"
+    source_mode = st.sidebar.radio("مصدر البيانات", ["مركز واحد", "عدة مراكز"], horizontal=True)
+    uploaded_file = baseline_file = batch_file = batch_directory = None
+    if source_mode == "مركز واحد":
+        # File upload option
+        uploaded_file = st.sidebar.file_uploader(
+            "اختر ملف JSON للتحليل",
+            type=['json', 'ndjson', 'jsonl'],
+            help="اختر ملف البيانات بصيغة JSON، أو NDJSON بعنصر واحد في كل سطر"
+        )
+        baseline_file = st.sidebar.file_uploader(
+            "ملف زيارة سابقة للمقارنة (اختياري)",
+            type=['json', 'ndjson', 'jsonl'],
+            help="مقارنة الزيارة الحالية بزيارة سابقة لنفس المركز وإبراز ما تغير بينهما"
+        )
+    else:
+        batch_file = st.sidebar.file_uploader(
+            "اختر ملف ZIP لزيارات المراكز",
+            type=['zip', 'ndjson', 'jsonl'],
+            help="ملف مضغوط يحتوي على ملف JSON لكل زيارة مركز، أو ملف NDJSON بزيارة واحدة في كل سطر"
+        )
+        batch_directory = st.sidebar.text_input(
+            "أو مسار مجلد ملفات الزيارات",
+            help="مجلد على الخادم يحتوي على ملفات JSON للزيارات"
+        )
+    
+    # Response cache controls
+    st.sidebar.markdown("---")
+    force_regenerate = st.sidebar.button(
+        "إعادة توليد التحليلات",
+        help="تجاهل النتائج المحفوظة وإعادة توليد جميع التحليلات من النموذج",
+        use_container_width=True
+    )
+    llm_stats_placeholder = st.sidebar.empty()
+    performance_placeholder = st.sidebar.empty()
+    stream_output = st.sidebar.toggle(
+        "عرض النص أثناء التوليد",
+        value=True,
+        help="عرض التحليلات تدريجياً أثناء توليدها بدلاً من انتظار اكتمالها"
+    )
+    one_shot = st.sidebar.toggle(
+        "توليد التقرير بطلب واحد",
+        value=False,
+        help="إرسال البيانات مرة واحدة وتوليد جميع الأقسام في استجابة واحدة منظمة"
+    )
+    hierarchical = st.sidebar.toggle(
+        "التوليد الهرمي للبيانات الكبيرة",
+        value=False,
+        help="تلخيص كل محور فرعي على حدة بالتوازي ثم دمج الملخصات في تحليل كل محور ثم في الملخص التنفيذي، "
+             "ليبقى حجم كل طلب محدوداً مهما كبر حجم البيانات"
+    )
+    lazy_sections = st.sidebar.toggle(
+        "توليد الأقسام عند الطلب",
+        value=True,
+        help="توليد الملخص التنفيذي فقط عند التحميل، وتوليد بقية الأقسام عند طلبها من تبويبها. "
+             "لا ينطبق عند توليد التقرير بطلب واحد، إذ تُولَّد جميع الأقسام معاً"
     )
     
     # Load data
-    if uploaded_file is not None:
+    trend_center = None
+    baseline = None
+    if source_mode == "عدة مراكز":
+        visits = load_center_batch(batch_file, batch_directory)
+        if visits is None:
+            st.info("يرجى رفع ملف ZIP أو تحديد مجلد يحتوي على ملفات الزيارات")
+            return
+        
+        failed_visits = [visit for visit in visits if visit.error]
+        if failed_visits:
+            with st.sidebar.expander(f"ملفات تعذر تحميلها ({len(failed_visits)})"):
+                for visit in failed_visits:
+                    st.error(f"{visit.name}: {visit.error}")
+        
+        labelled_visits = center_visits(visits)
+        if not labelled_visits:
+            st.error("لم يتم تحميل أي ملف زيارة صالح")
+            return
+        
+        render_portfolio(center_evaluations(visits), model)
+        selected_center = st.sidebar.selectbox("المركز المعروض في التقرير", list(labelled_visits))
+        data = labelled_visits[selected_center].evaluation
+        trend_center = labelled_visits[selected_center].center
+        
+        baseline_options = ["بدون مقارنة"] + [label for label in labelled_visits if label != selected_center]
+        previous_label = previous_visit_label(labelled_visits, selected_center)
+        baseline_label = st.sidebar.selectbox(
+            "الزيارة المرجعية للمقارنة",
+            baseline_options,
+            index=baseline_options.index(previous_label) if previous_label else 0,
+            help="افتراضياً أحدث زيارة سابقة لنفس المركز"
+        )
+        if baseline_label != "بدون مقارنة":
+            baseline = labelled_visits[baseline_label].evaluation
+    elif uploaded_file is not None:
+        # Stream the upload into the compact evaluation model instead of loading the raw JSON tree;
+        # a re-upload of the same bytes is served from the parse cache
+        progress_bar = st.progress(0.0, text="جاري قراءة الملف...")
         try:
-            data = json.load(uploaded_file)
+            data = get_parse_cache().load_stream(uploaded_file, uploaded_file.name, uploaded_file.size,
+                                                 progress_callback(progress_bar, "جاري قراءة الملف..."))
         except Exception as e:
-            st.error(f"خطأ في قراءة الملف: {str(e)}")
+            report_load_error(e, "خطأ في قراءة الملف")
             return
+        finally:
+            progress_bar.empty()
+        trend_center = record_uploaded_visit(uploaded_file, data, 'recorded_upload')
     else:
         # Use default file
         if os.path.exists(default_file):
-            data = load_data(default_file)
-            st.sidebar.success("تم تحميل الملف ")
+            progress_bar = st.progress(0.0, text="جاري قراءة الملف...")
+            data = load_data(default_file, progress_callback(progress_bar, "جاري قراءة الملف..."))
+            progress_bar.empty()
+            if data is not None:
+                st.sidebar.success("تم تحميل الملف ")
         else:
             st.error("لم يتم العثور على ملف البيانات. يرجى رفع ملف JSON.")
             return
@@ -2020,79 +3322,48 @@ def main():
     if data is None:
         return
     
+    if baseline_file is not None:
+        try:
+            baseline = get_parse_cache().load_stream(baseline_file, baseline_file.name, baseline_file.size)
+            record_uploaded_visit(baseline_file, baseline, 'recorded_baseline_upload')
+        except Exception as e:
+            report_load_error(e, "تعذر تحميل ملف الزيارة السابقة")
+    
+    # Compile the evaluation once; every metric below reads from its indexes and aggregates
+    data = as_evaluation(data)
+    
     # Calculate metrics
     overall_score = calculate_overall_score(data)
     status_counts, status_scores = analyze_performance_by_status(data)
     data_summary = prepare_data_for_gemini(data, overall_score, status_counts)
     
-    # Generate all analyses for PDF
-    ai_summary = None
-    accessibility_analysis = None
-    appearance_analysis = None
-    recommendations = None
+    # Visit-to-visit comparison; only the compact diff of changed attributes reaches the summary prompt
+    comparison = None
+    comparison_key = None
+    if baseline is not None:
+        baseline = as_evaluation(baseline)
+        comparison_key = baseline.content_hash or id(baseline)
+        comparison = data.view(('comparison', comparison_key), lambda: compare_evaluations(baseline, data))
+        data_summary = {
+            **data_summary,
+            'comparison': data.view(('comparison_text', comparison_key), lambda: serialize_delta(comparison))
+        }
     
-    if model:
-        with st.spinner("جاري إعداد التقرير..."):
-            ai_summary = generate_executive_summary(model, data_summary)
-            
-            accessibility_data = analyze_pillar_performance(data, "Accessibility")
-            if accessibility_data:
-                accessibility_analysis = generate_pillar_analysis(model, accessibility_data, "سهولة الوصول")
-            
-            appearance_data = analyze_pillar_performance(data, "Appearance")
-            if appearance_data:
-                appearance_analysis = generate_pillar_analysis(model, appearance_data, "المظهر العام")
-            
-            recommendations = generate_recommendations(model, data_summary)
+    accessibility_data = analyze_pillar_performance(data, "Accessibility")
+    appearance_data = analyze_pillar_performance(data, "Appearance")
     
-    # Single Arabic DOCX Report Generation and Download
-    if model and ai_summary:
-        st.sidebar.markdown("---")
-        st.sidebar.markdown("### تحميل التقرير العربي")
-        
-        # Single button that generates and downloads in one click
-        with st.spinner("جاري إنتاج التقرير العربي..."):
-            try:
-                # Step 1: Save all Streamlit data to text file
-                txt_file_path = save_streamlit_data_to_txt(
-                    data, overall_score, status_counts, 
-                    ai_summary, accessibility_analysis, 
-                    appearance_analysis, recommendations
-                )
-                
-                if txt_file_path:
-                    # Step 2: Generate DOCX from text file
-                    arabic_docx_buffer = generate_arabic_docx_from_txt(txt_file_path)
-                    
-                    if arabic_docx_buffer:
-                        # Step 3: Provide immediate download
-                        st.sidebar.download_button(
-                            label="تحميل التقرير العربي DOCX",
-                            data=arabic_docx_buffer,
-                            file_name=f"تقرير_عربي_مراكز_الخدمة_{datetime.now().strftime('%Y%m%d')}.docx",
-                            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                            type="primary",
-                            use_container_width=True
-                        )
-                        st.sidebar.success("تم إنتاج التقرير بنجاح! اضغط الزر أعلاه للتحميل")
-                    else:
-                        st.sidebar.error("فشل في إنتاج ملف DOCX")
-                else:
-                    st.sidebar.error("فشل في حفظ البيانات")
-                
-            except Exception as e:
-                st.sidebar.error(f"خطأ في إنتاج التقرير: {str(e)}")
-        
-    else:
-        st.sidebar.markdown("---")
-        st.sidebar.info("يتطلب تفعيل Gemini API لإنتاج التقرير")
+    # Placeholders for AI sections, filled in as each section finishes
+    section_placeholders = {}
+    generation_status = st.empty()
     
     # Create tabs
-    tab1, tab2, tab3, tab4 = st.tabs([
+    tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
         "الملخص التنفيذي", 
         "نتائج التقييم - محور سهولة الوصول",
         "نتائج التقييم - محور المظهر العام", 
-        "المقترحات التطويرية"
+        "المقترحات التطويرية",
+        "الاتجاهات عبر الزيارات",
+        "محاكاة السيناريوهات"
     ])
     
     # Tab 1: Executive Summary
@@ -2107,13 +3378,11 @@ def main():
             st.plotly_chart(fig, use_container_width=True)
         
         with col2:
-            if ai_summary:
-                formatted_summary = clean_and_format_text(ai_summary)
-                st.markdown(f'<div class="summary-text">{formatted_summary}</div>', unsafe_allow_html=True)
-            elif model:
-                st.info("جاري تحميل التحليل...")
+            section_placeholders['summary'] = st.empty()
+            if model:
+                section_placeholders['summary'].info("جاري تحميل التحليل...")
             else:
-                st.warning("يرجى إعداد مفتاح Gemini API لتوليد التحليل الذكي")
+                section_placeholders['summary'].warning("يرجى إعداد مفتاح Gemini API لتوليد التحليل الذكي")
         
         # Additional metrics
         st.markdown("---")
@@ -2150,24 +3419,21 @@ def main():
                 value=status_counts['NA'],
                 delta="عناصر"
             )
+        
+        if comparison is not None:
+            render_comparison(comparison)
     
     # Tab 2: Accessibility Analysis
     with tab2:
         st.markdown('<div class="tab-title" dir="rtl">نتائج التقييم - محور سهولة الوصول</div>', unsafe_allow_html=True)
         
-        accessibility_data = analyze_pillar_performance(data, "Accessibility")
         if accessibility_data and model:
             
             col1, col2 = st.columns([2, 1])
             
             with col1:
-                if accessibility_analysis:
-                    formatted_analysis = clean_and_format_text(accessibility_analysis)
-                    st.markdown(f'<div class="pillar-analysis">{formatted_analysis}</div>', unsafe_allow_html=True)
-                elif model:
-                    st.info("جاري تحميل التحليل...")
-                else:
-                    st.warning("يرجى إعداد مفتاح Gemini API")
+                section_placeholders['accessibility'] = st.empty()
+                section_placeholders['accessibility'].info("جاري تحميل التحليل...")
             
             with col2:
                 fig = create_pillar_status_chart(accessibility_data)
@@ -2203,19 +3469,13 @@ def main():
     with tab3:
         st.markdown('<div class="tab-title" dir="rtl">نتائج التقييم - محور المظهر العام</div>', unsafe_allow_html=True)
         
-        appearance_data = analyze_pillar_performance(data, "Appearance")
         if appearance_data and model:
             
             col1, col2 = st.columns([2, 1])
             
             with col1:
-                if appearance_analysis:
-                    formatted_analysis = clean_and_format_text(appearance_analysis)
-                    st.markdown(f'<div class="pillar-analysis">{formatted_analysis}</div>', unsafe_allow_html=True)
-                elif model:
-                    st.info("جاري تحميل التحليل...")
-                else:
-                    st.warning("يرجى إعداد مفتاح Gemini API")
+                section_placeholders['appearance'] = st.empty()
+                section_placeholders['appearance'].info("جاري تحميل التحليل...")
             
             with col2:
                 fig = create_pillar_status_chart(appearance_data)
@@ -2255,19 +3515,206 @@ def main():
             col1, col2 = st.columns([2, 1])
             
             with col1:
-                if recommendations:
-                    formatted_recommendations = clean_and_format_text(recommendations)
-                    st.markdown(f'<div class="recommendation-card">{formatted_recommendations}</div>', unsafe_allow_html=True)
-                elif model:
-                    st.info("جاري تحميل المقترحات...")
-                else:
-                    st.warning("يرجى إعداد مفتاح Gemini API")
+                section_placeholders['recommendations'] = st.empty()
+                section_placeholders['recommendations'].info("جاري تحميل المقترحات...")
             
             with col2:
                 fig = create_recommendations_flowchart()
                 st.plotly_chart(fig, use_container_width=True)
         else:
             st.warning("يرجى إعداد مفتاح Gemini API لتوليد المقترحات")
+    
+    # Tab 5: Trends from the historical visit store
+    with tab5:
+        st.markdown('<div class="tab-title" dir="rtl">تطور الأداء عبر الزيارات</div>', unsafe_allow_html=True)
+        render_trends(trend_center)
+    
+    # Tab 6: What-if simulator
+    with tab6:
+        st.markdown('<div class="tab-title" dir="rtl">ماذا لو؟ محاكاة أثر تغيير العناصر على النتائج</div>', unsafe_allow_html=True)
+        render_simulator(data, model)
+    
+    # Generate all analyses concurrently; each tab fills in as its section finishes
+    sections = {}
+    pending_sections = []
+    if model:
+        pillar_data_by_section = {'accessibility': accessibility_data, 'appearance': appearance_data}
+        
+        # Sections whose inputs are unchanged since the last generation in this session are reused
+        # Derived inputs are memoized on the evaluation, which the parse cache shares per file content
+        fingerprints = data.view(
+            ('section_fingerprints', model.model_name, hierarchical, comparison_key),
+            lambda: compute_section_fingerprints(model, data_summary, pillar_data_by_section, hierarchical)
+        )
+        previous_sections = st.session_state.get('report_sections', {})
+        reused_sections = {} if force_regenerate else {
+            section: previous_sections[section]['text']
+            for section, fingerprint in fingerprints.items()
+            if section in previous_sections and previous_sections[section]['fingerprint'] == fingerprint
+        }
+        
+        # In lazy mode only the summary and the sections the user asked for are generated. Asking for
+        # the one-shot report asks for every section: one request costs the same however many it holds
+        one_shot_report = one_shot and not hierarchical
+        if lazy_sections and not one_shot_report:
+            wanted_sections = {'summary'} | st.session_state.get('requested_sections', set())
+        else:
+            wanted_sections = set(fingerprints)
+        stale_sections = [
+            section for section in fingerprints
+            if section not in reused_sections and section in wanted_sections
+        ]
+        pending_sections = [
+            section for section in fingerprints
+            if section not in reused_sections and section not in wanted_sections
+        ]
+        # Sections generated eagerly without being asked for yield the rate limiter to interactive requests
+        background_sections = set(stale_sections) - {'summary'} - st.session_state.get('requested_sections', set())
+        # Lazy mode is off whenever the one-shot report is on (see above), so every section that is not
+        # reused is stale here and goes into the single request. When only one section is stale, e.g.
+        # after a change that touches a single pillar, its own per-section call is the cheaper request.
+        use_one_shot = one_shot_report and len(stale_sections) > 1
+        
+        if use_one_shot:
+            token_estimates = {'one_shot': estimate_tokens(build_one_shot_prompt(data_summary, pillar_data_by_section))}
+        else:
+            token_estimates = {
+                section: tokens
+                for section, tokens in data.view(
+                    ('prompt_token_estimates', hierarchical, comparison_key),
+                    lambda: estimate_section_prompt_tokens(data_summary, pillar_data_by_section, hierarchical)
+                ).items()
+                if section in stale_sections
+            }
+        with st.sidebar.expander("حجم المدخلات التقديري"):
+            for section, tokens in token_estimates.items():
+                st.caption(f"{SECTION_LABELS[section]}: ~{tokens} رمز")
+            if not token_estimates:
+                st.caption("لا توجد أقسام بحاجة إلى التوليد")
+        
+        with st.sidebar.expander("حالة الأقسام"):
+            for section in fingerprints:
+                if section in reused_sections:
+                    state = "♻️ أعيد استخدامه (لم تتغير بياناته)"
+                elif section in pending_sections:
+                    state = "⏸️ بانتظار الطلب"
+                else:
+                    state = "🆕 تم توليده"
+                st.caption(f"{SECTION_LABELS[section]}: {state}")
+        
+        formatters = {section: StreamingTextFormatter() for section in section_placeholders}
+        
+        def on_section_update(section, text):
+            if section in section_placeholders:
+                formatted_text = formatters[section].update(text)
+                section_placeholders[section].markdown(
+                    f'<div class="{SECTION_CSS_CLASSES[section]}">{formatted_text}</div>',
+                    unsafe_allow_html=True
+                )
+        
+        def on_section_done(section, text, errors):
+            if section in section_placeholders:
+                render_ai_section(section_placeholders[section], section, text, errors)
+            render_llm_stats(llm_stats_placeholder)
+        
+        sections.update(reused_sections)
+        for section, text in reused_sections.items():
+            on_section_done(section, text, [])
+        for section in pending_sections:
+            if section in section_placeholders:
+                render_pending_section(section_placeholders[section], section)
+        
+        with generation_status.container():
+            with st.spinner("جاري إعداد التقرير..."):
+                if use_one_shot:
+                    one_shot_sections = generate_report_one_shot(model, data_summary, pillar_data_by_section, force_regenerate) or {}
+                    for section, text in one_shot_sections.items():
+                        if section in stale_sections:
+                            sections[section] = text
+                            on_section_done(section, text, [])
+                
+                # Per-section calls cover everything that was neither reused nor in the one-shot response
+                missing_sections = [section for section in stale_sections if section not in sections]
+                if use_one_shot and missing_sections:
+                    st.sidebar.warning("تعذر استخدام استجابة الطلب الواحد لبعض الأقسام، تم توليدها بشكل منفصل")
+                
+                sections.update(generate_report_sections(
+                    model, data_summary,
+                    pillar_data_by_section,
+                    force_regenerate=force_regenerate,
+                    stream=stream_output,
+                    on_section_update=on_section_update,
+                    on_section_done=on_section_done,
+                    only_sections=missing_sections,
+                    hierarchical=hierarchical,
+                    background_sections=background_sections
+                ))
+        generation_status.empty()
+        
+        st.session_state['report_sections'] = {
+            section: {'fingerprint': fingerprints[section], 'text': text}
+            for section, text in sections.items() if text
+        }
+        render_llm_stats(llm_stats_placeholder)
+        render_performance_panel(performance_placeholder)
+    
+    ai_summary = sections.get('summary')
+    accessibility_analysis = sections.get('accessibility')
+    appearance_analysis = sections.get('appearance')
+    recommendations = sections.get('recommendations')
+    
+    # Single Arabic DOCX Report Generation and Download
+    if model and ai_summary and pending_sections:
+        # The report needs every section; generate the remaining ones on request
+        st.sidebar.markdown("---")
+        st.sidebar.markdown("### تحميل التقرير العربي")
+        st.sidebar.button(
+            "توليد الأقسام المتبقية وإعداد التقرير",
+            on_click=request_sections,
+            args=tuple(pending_sections),
+            type="primary",
+            use_container_width=True
+        )
+    elif model and ai_summary:
+        st.sidebar.markdown("---")
+        st.sidebar.markdown("### تحميل التقرير العربي")
+        
+        # Single button that generates and downloads in one click
+        with st.spinner("جاري إنتاج التقرير العربي..."):
+            try:
+                # Step 1: Save all Streamlit data to text file
+                txt_file_path = save_streamlit_data_to_txt(
+                    data, overall_score, status_counts, 
+                    ai_summary, accessibility_analysis, 
+                    appearance_analysis, recommendations
+                )
+                
+                if txt_file_path:
+                    # Step 2: Generate DOCX from text file
+                    arabic_docx_buffer = generate_arabic_docx_from_txt(txt_file_path)
+                    
+                    if arabic_docx_buffer:
+                        # Step 3: Provide immediate download
+                        st.sidebar.download_button(
+                            label="تحميل التقرير العربي DOCX",
+                            data=arabic_docx_buffer,
+                            file_name=f"تقرير_عربي_مراكز_الخدمة_{datetime.now().strftime('%Y%m%d')}.docx",
+                            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                            type="primary",
+                            use_container_width=True
+                        )
+                        st.sidebar.success("تم إنتاج التقرير بنجاح! اضغط الزر أعلاه للتحميل")
+                    else:
+                        st.sidebar.error("فشل في إنتاج ملف DOCX")
+                else:
+                    st.sidebar.error("فشل في حفظ البيانات")
+                
+            except Exception as e:
+                st.sidebar.error(f"خطأ في إنتاج التقرير: {str(e)}")
+        
+    else:
+        st.sidebar.markdown("---")
+        st.sidebar.info("يتطلب تفعيل Gemini API لإنتاج التقرير")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,48 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+import history_utils
+from evaluation_utils import compile_evaluation
+from history_utils import VisitStore
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def evaluation():
+    with open(os.path.join(REPO_ROOT, 'service_center_api_schema_RTL_FIXED.json'), encoding='utf-8') as file:
+        return compile_evaluation(json.load(file))
+
+
+def test_undated_visits_are_kept_out_of_the_trend(tmp_path, evaluation):
+    store = VisitStore(str(tmp_path / 'visits.sqlite3'))
+    store.record_visits([
+        ('new', 'مركز', '2026-03-01', 'new.json', evaluation),
+        ('undated', 'مركز', None, 'old-report.json', evaluation),
+        ('old', 'مركز', '2025-01-01', 'old.json', evaluation),
+    ])
+
+    assert store.center_history('مركز')['visit_date'].tolist() == ['2025-01-01', '2026-03-01']
+    assert set(store.pillar_history('مركز')['visit_date']) == {'2025-01-01', '2026-03-01'}
+    centers = store.centers()
+    assert (int(centers['visits'].iloc[0]), int(centers['undated'].iloc[0])) == (2, 1)
+
+
+def test_store_with_not_null_visit_dates_is_migrated_in_place(tmp_path, monkeypatch, evaluation):
+    path = str(tmp_path / 'visits.sqlite3')
+    with monkeypatch.context() as patch:
+        # A store created before undated visits were allowed
+        patch.setattr(history_utils, '_SCHEMA', history_utils._SCHEMA.replace('visit_date TEXT,', 'visit_date TEXT NOT NULL,'))
+        patch.setattr(history_utils, '_allow_undated_visits', lambda conn: None)
+        VisitStore(path).record_visits([('dated', 'مركز', '2026-01-01', 'a.json', evaluation)])
+    with sqlite3.connect(path) as conn:
+        assert [row[3] for row in conn.execute("PRAGMA table_info(visits)") if row[1] == 'visit_date'] == [1]
+
+    store = VisitStore(path)
+    store.record_visits([('undated', 'مركز', None, 'b.json', evaluation)])
+    assert store.center_history('مركز')['visit_date'].tolist() == ['2026-01-01']
+    assert len(store.pillar_history('مركز')) == len(evaluation.pillars)
+    assert store.stats() == {'visits': 2, 'centers': 1}
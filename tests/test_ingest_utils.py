@@ -0,0 +1,101 @@
+import io
+import json
+
+import pytest
+
+import ingest_utils
+from ingest_utils import ParseCache, create_parse_pool, evaluation_errors, load_visits, parse_visit
+from snapshot_utils import SnapshotStore
+
+
+def _visit():
+    return [{
+        'pillar_en': 'Accessibility',
+        'pillar_ar': 'سهولة الوصول',
+        'pillar_score': 0.8,
+        'sub_pillars': [{
+            'sub_pillar_en': 'Parking',
+            'sub_pillar_ar': 'المواقف',
+            'attributes': [{
+                'attribute_en': 'Parking is available',
+                'status': 'E',
+                'score': 1,
+                'weight': 0.5,
+                'notes_ar': None,
+                'report_notes_ar': None,
+            }],
+        }],
+    }]
+
+
+@pytest.mark.parametrize('path, parent', [
+    ('$[0].pillar_score', lambda visit: visit[0]),
+    ('$[0].sub_pillars', lambda visit: visit[0]),
+    ('$[0].sub_pillars[0].attributes', lambda visit: visit[0]['sub_pillars'][0]),
+    ('$[0].sub_pillars[0].attributes[0].status', lambda visit: visit[0]['sub_pillars'][0]['attributes'][0]),
+    ('$[0].sub_pillars[0].attributes[0].score', lambda visit: visit[0]['sub_pillars'][0]['attributes'][0]),
+    ('$[0].sub_pillars[0].attributes[0].weight', lambda visit: visit[0]['sub_pillars'][0]['attributes'][0]),
+])
+def test_null_in_required_field_is_a_type_error(path, parent):
+    visit = _visit()
+    parent(visit)[path.rsplit('.', 1)[1]] = None
+    assert [error_path for error_path, _ in evaluation_errors(visit)] == [path]
+
+
+def test_null_text_and_absent_fields_are_accepted():
+    visit = _visit()
+    visit[0]['sub_pillars'][0]['sub_pillar_ar'] = None
+    attribute = visit[0]['sub_pillars'][0]['attributes'][0]
+    del attribute['score'], attribute['weight']
+    assert evaluation_errors(visit) == []
+
+
+@pytest.mark.parametrize('streaming', [True, False])
+def test_streamed_snapshot_keeps_center_and_visit_date_for_batch_reuse(tmp_path, monkeypatch, streaming):
+    if not streaming:
+        monkeypatch.setattr(ingest_utils, 'ijson', None)
+    payload = json.dumps({'visit_date': '2026-03-01', 'pillars': _visit(), 'center_ar': 'مركز الشارقة'}).encode()
+    snapshots = SnapshotStore(str(tmp_path))
+
+    evaluation = ParseCache(snapshots=snapshots).load_stream(io.BytesIO(payload), 'upload.json', len(payload))
+    assert (evaluation.center, evaluation.visit_date) == ('مركز الشارقة', '2026-03-01')
+
+    visit = parse_visit('upload.json', payload, snapshots=snapshots)
+    assert visit.evaluation.__class__.__name__ == 'Snapshot'
+    assert (visit.center, visit.visit_date) == ('مركز الشارقة', '2026-03-01')
+
+
+def test_json_and_ndjson_parses_of_the_same_bytes_keep_separate_snapshots(tmp_path):
+    # One attribute row: valid both as a one-line NDJSON visit and, wrapped, as a JSON row file
+    row = {'pillar_en': 'Accessibility', 'sub_pillar_en': 'Parking', 'attribute_en': 'Parking', 'status': 'E',
+           'score': 1, 'weight': 1}
+    payload = json.dumps(row).encode()
+    snapshots = SnapshotStore(str(tmp_path))
+
+    ndjson = ParseCache(snapshots=snapshots).load_stream(io.BytesIO(payload), 'visit.ndjson', len(payload))
+    assert len(ndjson.pillars) == 1
+    assert snapshots.get(ndjson.content_hash, 'json') is None
+    assert snapshots.get(ndjson.content_hash, 'ndjson') is not None
+
+    with pytest.raises(ValueError):
+        ParseCache(snapshots=snapshots).load_stream(io.BytesIO(payload), 'visit.json', len(payload))
+
+
+def test_shared_spawn_pool_parses_batches_in_order():
+    sources = [(f"center-{index}.json", json.dumps(_visit()).encode(), None) for index in range(5)]
+    sources.append(('broken.json', b'{', None))
+    pool = create_parse_pool(2)
+    try:
+        assert pool._mp_context.get_start_method() == 'spawn'
+        for _ in range(2):
+            visits = load_visits(sources, max_workers=2, executor=pool)
+            assert [visit.center for visit in visits] == [f"center-{index}" for index in range(5)] + ['broken']
+            assert [bool(visit.error) for visit in visits] == [False] * 5 + [True]
+    finally:
+        pool.shutdown()
+
+
+def test_small_batches_and_single_worker_stay_in_process():
+    assert create_parse_pool(1) is None
+    visits = load_visits([('a.json', json.dumps(_visit()).encode(), None)], max_workers=4)
+    assert visits[0].error is None
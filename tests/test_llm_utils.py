@@ -0,0 +1,100 @@
+import threading
+import time
+
+import pytest
+
+import llm_utils
+from llm_utils import (PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, CallRecord, GeminiBackend, LLMTelemetry,
+                       ModelResolver, ModelUnavailableError, RateLimiter)
+
+
+class _DeadModel:
+    probes = 0
+
+    def __init__(self, name):
+        self.name = name
+
+    def generate_content(self, *args, **kwargs):
+        _DeadModel.probes += 1
+        raise RuntimeError("404 model not found")
+
+
+def test_model_resolver_backs_off_after_failed_round(monkeypatch):
+    monkeypatch.setattr(llm_utils.genai, "configure", lambda **kwargs: None)
+    monkeypatch.setattr(llm_utils.genai, "GenerativeModel", _DeadModel)
+    _DeadModel.probes = 0
+    now = [1000.0]
+    monkeypatch.setattr(llm_utils.time, "time", lambda: now[0])
+
+    resolver = ModelResolver("key", ["a", "b"], refresh_seconds=3600, retry_seconds=60)
+    assert resolver.get_model() is None
+    assert _DeadModel.probes == 2
+
+    # Reruns inside the retry delay do not probe again
+    assert resolver.get_model() is None
+    assert resolver.get_model() is None
+    assert _DeadModel.probes == 2
+
+    # After the delay one more round is probed, and the next delay is doubled
+    now[0] += 61
+    assert resolver.get_model() is None
+    assert _DeadModel.probes == 4
+    assert resolver.retry_at == now[0] + 120
+
+
+def test_backend_without_a_model_fails_fast_with_a_typed_error(monkeypatch):
+    monkeypatch.setattr(llm_utils.genai, "configure", lambda **kwargs: None)
+    monkeypatch.setattr(llm_utils.genai, "GenerativeModel", _DeadModel)
+    resolver = ModelResolver("key", ["a"], refresh_seconds=3600, retry_seconds=60)
+    backend = GeminiBackend(resolver)
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=1000000, max_retries=3, base_delay=0)
+    attempts = []
+
+    def generate():
+        attempts.append(1)
+        return backend.generate("prompt")
+
+    with pytest.raises(ModelUnavailableError, match="No Gemini model available"):
+        limiter.call(generate)
+    assert len(attempts) == 1
+    assert limiter.retries == 0
+
+
+def test_interactive_request_overtakes_queued_background_work():
+    limiter = RateLimiter(requests_per_minute=120, tokens_per_minute=1000000)
+    limiter._request_bucket = 0
+    served = []
+
+    def acquire(name, priority):
+        limiter.acquire(priority=priority)
+        served.append(name)
+
+    background = [threading.Thread(target=acquire, args=(f"background-{n}", PRIORITY_BACKGROUND)) for n in range(3)]
+    for thread in background:
+        thread.start()
+        while limiter.stats()["queue_depth"] < background.index(thread) + 1:
+            time.sleep(0.01)
+
+    interactive = threading.Thread(target=acquire, args=("interactive", PRIORITY_INTERACTIVE))
+    interactive.start()
+    for thread in background + [interactive]:
+        thread.join(timeout=10)
+
+    assert served == ["interactive", "background-0", "background-1", "background-2"]
+
+
+def test_telemetry_latency_and_tokens_only_cover_model_calls(tmp_path):
+    telemetry = LLMTelemetry(log_path=str(tmp_path / "telemetry.jsonl"))
+    for latency, prompt_tokens, cache_hit, coalesced in [(2.0, 900, False, False), (4.0, 1100, False, False),
+                                                         (0.001, None, True, False), (3.5, None, False, True)]:
+        record = CallRecord("summary", "model")
+        record.latency_seconds = latency
+        record.prompt_tokens = prompt_tokens
+        record.cache_hit = cache_hit
+        record.coalesced = coalesced
+        telemetry.record(record)
+
+    stats = telemetry.summary()["summary"]
+    assert (stats["calls"], stats["cache_hits"], stats["coalesced"]) == (4, 1, 1)
+    assert (stats["latency_p50"], stats["latency_p95"]) == (2.0, 4.0)
+    assert stats["prompt_tokens_avg"] == 1000
@@ -0,0 +1,40 @@
+import json
+import os
+
+import pytest
+
+from evaluation_utils import compile_evaluation
+from simulation_utils import WhatIfSimulation
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def simulation():
+    with open(os.path.join(REPO_ROOT, 'service_center_api_schema_RTL_FIXED.json'), encoding='utf-8') as file:
+        return WhatIfSimulation(compile_evaluation(json.load(file)))
+
+
+def test_status_change_alone_moves_pillar_and_overall_scores(simulation):
+    # Appearance: an R attribute scored 0 with weight 1 out of the pillar's 10
+    assert simulation.attribute(14) == ('R', 0.0, 1.0)
+    before = simulation.overall_score
+
+    simulation.set_attribute(14, status='E')
+    assert simulation.attribute(14) == ('E', pytest.approx(0.1), 1.0)
+    assert simulation.pillar_score(1) == pytest.approx(50.0)
+    assert simulation.overall_score > before
+
+    # Back to the evaluated status restores the reported score
+    simulation.set_attribute(14, status='R')
+    assert simulation.attribute(14) == ('R', 0.0, 1.0)
+    assert simulation.changes == []
+    assert simulation.overall_score == pytest.approx(before)
+
+
+def test_simulated_pillar_scores_stay_within_0_and_100(simulation):
+    simulation.set_attribute(0, score=5)
+    assert simulation.pillar_score(0) == 100.0
+    simulation.set_attribute(0, score=-5)
+    assert simulation.pillar_score(0) == 0.0
+    assert 0 <= simulation.overall_score <= 100
@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+
+from evaluation_utils import compile_evaluation
+from snapshot_utils import SnapshotStore
+
+
+def _evaluation():
+    evaluation = compile_evaluation([{
+        'pillar_en': 'Accessibility',
+        'pillar_score': 0.5,
+        'sub_pillars': [{'sub_pillar_en': 'Parking', 'attributes': [
+            {'attribute_en': 'Parking', 'status': 'E', 'score': 0.5, 'weight': 1},
+            {'attribute_en': 'Signs', 'status': 'N', 'score': 0, 'weight': 1},
+        ]}],
+    }])
+    evaluation.content_hash = 'abc'
+    return evaluation
+
+
+def test_put_keeps_an_existing_snapshot_that_is_being_read(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    snapshot = store.put('abc', _evaluation(), 'مركز', '2026-01-01')
+    scores = snapshot.column('attributes', 'score')
+    created_at = snapshot.meta['created_at']
+
+    again = store.put('abc', _evaluation())
+    assert again.meta['created_at'] == created_at
+    assert again.center == 'مركز'
+    assert np.array_equal(scores, [0.5, 0.0])
+
+
+def test_put_replaces_an_outdated_snapshot_without_leaving_temporary_directories(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    store.put('abc', _evaluation())
+    meta_path = os.path.join(store.path('abc'), 'meta.json')
+    with open(meta_path, 'w', encoding='utf-8') as file:
+        file.write('{"version": 1}')
+    assert store.get('abc') is None
+
+    assert store.put('abc', _evaluation()) is not None
+    assert sorted(os.listdir(str(tmp_path))) == [os.path.basename(store.path('abc'))]
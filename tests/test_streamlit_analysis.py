@@ -0,0 +1,40 @@
+import json
+import os
+import shutil
+
+from streamlit.testing.v1 import AppTest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_FILE = 'service_center_api_schema_RTL_FIXED.json'
+
+
+def _app():
+    import streamlit_analysis
+    streamlit_analysis.main()
+
+
+def test_pillar_tabs_render_attributes_with_null_notes(tmp_path, monkeypatch):
+    with open(os.path.join(REPO_ROOT, DEFAULT_FILE), encoding='utf-8') as file:
+        pillars = json.load(file)
+    for pillar in pillars:
+        for sub_pillar in pillar['sub_pillars']:
+            for attribute in sub_pillar['attributes']:
+                attribute['notes_ar'] = None
+                attribute['report_notes_ar'] = None
+    with open(tmp_path / DEFAULT_FILE, 'w', encoding='utf-8') as file:
+        json.dump(pillars, file, ensure_ascii=False)
+    shutil.copy(os.path.join(REPO_ROOT, 'abuDhabiCustomsLogo.png'), tmp_path)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('LLM_BACKEND', 'fake')
+    monkeypatch.setenv('LLM_FAKE_LATENCY_SCALE', '0')
+    monkeypatch.setenv('LLM_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('LLM_TELEMETRY_LOG', str(tmp_path / 'telemetry.jsonl'))
+    monkeypatch.setenv('SNAPSHOT_DIR', str(tmp_path / 'snapshots'))
+    monkeypatch.setenv('VISIT_STORE_PATH', str(tmp_path / 'visits.sqlite3'))
+
+    app = AppTest.from_function(_app, default_timeout=120)
+    app.run()
+
+    assert not app.exception
+    assert any('status-excellent' in markdown.value for markdown in app.markdown)